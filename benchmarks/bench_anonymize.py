@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""measure the per-packet cost of address anonymization
+
+Synthetic Ethernet/IPv4/TCP, Ethernet/IPv4/UDP and Ethernet/IPv6/TCP
+packets between a pool of hosts are run through
+anonymize.Anonymizer.apply() with empty caches (every address new),
+with only the prefix cache warm (new hosts in known networks), with
+warm caches, and with warm caches but without rewriting MAC
+addresses.  The cost of copying each packet into a bytearray, which
+apply() does anyway, is measured separately as the baseline.  Times
+are microseconds per packet.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import os
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fasguard_benign_traffic_collection.anonymize import Anonymizer
+from fasguard_benign_traffic_collection.decode import DLT_EN10MB, decode_en10mb
+
+def make_packets(count, hosts, payload_size, seed):
+    """return a list of (packet, decoded) tuples
+    """
+    rnd = random.Random(seed)
+    macs = [struct.pack('!HI', 0x0200, rnd.getrandbits(32))
+            for i in range(64)]
+    v4 = [struct.pack('!I', 0x0a000000 | rnd.getrandbits(20))
+          for i in range(hosts)]
+    v6 = [struct.pack('!QQ', 0x20010db800000000 | rnd.getrandbits(16),
+                      rnd.getrandbits(64)) for i in range(hosts)]
+    payload = b'x' * payload_size
+    ret = []
+    for i in range(count):
+        kind = i % 3
+        sport = rnd.randrange(1024, 65536)
+        if kind < 2:
+            proto = 6 if kind == 0 else 17
+            l4 = (struct.pack('!HHII', sport, 80, 1, 0)
+                  + b'\x50\x18\x20\x00\xab\xcd\x00\x00' if proto == 6
+                  else struct.pack('!HHHH', sport, 53, 8 + payload_size,
+                                   0xabcd))
+            ip = struct.pack('!BBHHHBBH', 0x45, 0, 20 + len(l4)
+                             + payload_size, 1, 0, 64, proto, 0x1234) \
+                + rnd.choice(v4) + rnd.choice(v4)
+            ethertype = b'\x08\x00'
+        else:
+            l4 = struct.pack('!HHII', sport, 443, 1, 0) \
+                + b'\x50\x18\x20\x00\xab\xcd\x00\x00'
+            ip = struct.pack('!IHBB', 0x60000000, len(l4) + payload_size,
+                             6, 64) + rnd.choice(v6) + rnd.choice(v6)
+            ethertype = b'\x86\xdd'
+        packet = rnd.choice(macs) + rnd.choice(macs) + ethertype + ip \
+            + l4 + payload
+        ret.append((packet, decode_en10mb(packet)))
+    return ret
+
+def per_packet(func, packets, repeat):
+    """best time of repeat runs of func over packets, in microseconds
+    """
+    best = min(timeit.repeat(lambda: func(packets), number=1,
+                             repeat=repeat))
+    return best / len(packets) * 1e6
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--packets', type=int, default=30000)
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--payload', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv[1:])
+
+    packets = make_packets(args.packets, args.hosts, args.payload,
+                           args.seed)
+
+    def copy(packets):
+        for packet, decoded in packets:
+            bytearray(packet)
+
+    def run(anonymizer):
+        apply = anonymizer.apply
+        def f(packets):
+            for packet, decoded in packets:
+                apply(packet, decoded, DLT_EN10MB)
+        return f
+
+    key = b'benchmark key'
+    def fresh(packets):
+        run(Anonymizer(key))(packets)
+    warm = Anonymizer(key)
+    run(warm)(packets)
+    ip_only = Anonymizer(key, mac=False)
+    run(ip_only)(packets)
+    prefixes = Anonymizer(key)
+    run(prefixes)(packets)
+    def known_prefixes(packets):
+        prefixes._addresses.clear()
+        run(prefixes)(packets)
+
+    print('%-34s %10s' % ('case', 'us/packet'))
+    for desc, func in [
+            ('copy to bytearray (baseline)', copy),
+            ('anonymize, empty caches', fresh),
+            ('anonymize, known prefixes', known_prefixes),
+            ('anonymize, warm caches', run(warm)),
+            ('anonymize IP only, warm caches', run(ip_only)),
+    ]:
+        print('%-34s %10.2f' % (desc, per_packet(func, packets,
+                                                 args.repeat)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
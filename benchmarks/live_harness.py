@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""replay packets into a veth pair and measure the live collector
+
+Needs Linux, root and iproute2.  A veth pair is created with one end
+in a new network namespace, where a sender process writes packets to
+it with a raw socket; the collector captures on the other end, with a
+generated config (merged into --config, if given) that saves every
+packet to one native-writer output.  IPv6 and ARP are turned off on
+both ends so that nothing but the replayed packets crosses the link.
+
+For each rate of a ramp (--start packets per second, multiplied by
+--factor up to --max), the collector is started, given --settle
+seconds to open its handle, sent --duration seconds of packets and
+--drain seconds to save them, and stopped with SIGINT.  Its output is
+then compared with what was sent.  Each line of the report has the
+rate the sender achieved (packets and megabits per second), the
+packets sent, saved and lost (dropped anywhere between the socket and
+the output file), the saved packets that don't match the sent ones
+in content and order, and the shutdown latency (SIGINT to exit).  The
+ramp stops at the first rate with losses or mismatches; the highest
+rate without either is the throughput ceiling of this build and
+config.
+
+Packets are synthetic Ethernet/IPv4/UDP packets of --size bytes
+carrying a sequence number, or the packets of a pcap file (--pcap),
+repeated as needed.  A Python sender tops out at a few hundred
+thousand packets per second; if the achieved rate falls short of the
+target, the ceiling found is the sender's, not the collector's.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import bisect
+import errno
+import os
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# collector and sender ends of the veth pair, and the sender's
+# namespace
+COLLECTOR_IFACE = 'fbtc0'
+SENDER_IFACE = 'fbtc1'
+NAMESPACE = 'fbtc-harness'
+# largest frame the default veth MTU passes
+MAX_FRAME = 1514
+
+def _ip_checksum(header):
+    s = sum(struct.unpack('!%iH' % (len(header) // 2), header))
+    while s >> 16:
+        s = (s & 0xffff) + (s >> 16)
+    return 0xffff - s
+
+class SyntheticTraffic(object):
+    """UDP packets of size bytes; packet k carries k after the headers
+    """
+    seq = struct.Struct('!Q')
+    offset = 42
+
+    def __init__(self, size):
+        size = max(60, min(size, MAX_FRAME))
+        ip = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, size - 14, 1,
+                                   0, 64, 17, 0, b'\x0a\x63\x00\x01',
+                                   b'\x0a\x63\x00\x02'))
+        struct.pack_into('!H', ip, 10, _ip_checksum(bytes(ip)))
+        self._header = b'\x02\x00\x00\x00\x00\x02\x02\x00\x00\x00\x00\x01' \
+            b'\x08\x00' + bytes(ip) \
+            + struct.pack('!HHHH', 40000, 9, size - 34, 0)
+        self._filler = b'\xa5' * (size - self.offset - self.seq.size)
+
+    def frame(self, k):
+        return self._header + self.seq.pack(k) + self._filler
+
+    def locate(self, data, start, count):
+        """return the index (at least start, below count) of the sent
+        packet data, or None
+        """
+        if len(data) < self.offset + self.seq.size:
+            return None
+        k = self.seq.unpack_from(data, self.offset)[0]
+        if start <= k < count and data == self.frame(k):
+            return k
+        return None
+
+class RecordedTraffic(object):
+    """the packets of a pcap file, repeated
+
+    Truncated packets and packets too large for the link are skipped.
+    """
+    def __init__(self, filename):
+        from fasguard_benign_traffic_collection.dumpfiles import PcapReader
+        self._pool = [rec[4] for rec in PcapReader(filename)
+                      if rec[2] == rec[3] and rec[2] <= MAX_FRAME]
+        if not self._pool:
+            raise ValueError('%s: no packets to replay' % filename)
+        # packet -> its indices in the pool
+        self._positions = {}
+        for i, data in enumerate(self._pool):
+            self._positions.setdefault(data, []).append(i)
+
+    def frame(self, k):
+        return self._pool[k % len(self._pool)]
+
+    def locate(self, data, start, count):
+        positions = self._positions.get(bytes(data))
+        if positions is None:
+            return None
+        n = len(self._pool)
+        base, r = divmod(start, n)
+        i = bisect.bisect_left(positions, r)
+        k = base * n + positions[i] if i < len(positions) \
+            else (base + 1) * n + positions[0]
+        return k if k < count else None
+
+def compare(traffic, count, saved):
+    """return (matched, unexpected) for the saved packets
+
+    A saved packet matches if it is one of the count packets sent,
+    later than the previous match; anything else is unexpected.
+    """
+    matched = unexpected = 0
+    start = 0
+    for data in saved:
+        k = traffic.locate(data, start, count)
+        if k is None:
+            unexpected += 1
+        else:
+            matched += 1
+            start = k + 1
+    return matched, unexpected
+
+def send(iface, traffic, rate, count, batch=64):
+    """send count packets at rate packets per second; returns the
+    seconds taken
+    """
+    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    try:
+        s.bind((iface, 0))
+        start = time.time()
+        for k in range(count):
+            if k % batch == 0:
+                delay = start + k / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            frame = traffic.frame(k)
+            while True:
+                try:
+                    s.send(frame)
+                    break
+                except socket.error as e:
+                    # the device queue is full; back off briefly
+                    if e.args[0] != errno.ENOBUFS:
+                        raise
+                    time.sleep(0.0001)
+        return time.time() - start
+    finally:
+        s.close()
+
+def _run(*cmd):
+    subprocess.check_call(cmd)
+
+class VethPair(object):
+    """the veth pair and namespace, removed on exit
+    """
+    def __enter__(self):
+        _run('ip', 'netns', 'add', NAMESPACE)
+        try:
+            _run('ip', 'link', 'add', COLLECTOR_IFACE, 'type', 'veth',
+                 'peer', 'name', SENDER_IFACE)
+            _run('ip', 'link', 'set', SENDER_IFACE, 'netns', NAMESPACE)
+            for prefix, iface in ((), COLLECTOR_IFACE), \
+                    (('ip', 'netns', 'exec', NAMESPACE), SENDER_IFACE):
+                # may fail if IPv6 is disabled altogether
+                subprocess.call(prefix + (
+                    'sysctl', '-qw',
+                    'net.ipv6.conf.%s.disable_ipv6=1' % iface))
+                _run(*(prefix + ('ip', 'link', 'set', 'dev', iface, 'arp',
+                                 'off', 'up')))
+        except:
+            self.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # deleting the namespace deletes the sender end and with it
+        # the pair, unless setup failed before the end was moved
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(('ip', 'link', 'del', COLLECTOR_IFACE),
+                            stderr=devnull)
+        subprocess.call(('ip', 'netns', 'del', NAMESPACE))
+
+def run_step(args, rate, config, workdir):
+    """measure one rate; returns a dict of results
+    """
+    output = os.path.join(workdir, 'out.pcap')
+    if os.path.exists(output):
+        os.remove(output)
+    settings = dict(config)
+    settings.update({
+        'interfaces': [COLLECTOR_IFACE],
+        'outputs': [(output, [()])],
+        'writer': dict(settings.get('writer', {}), type='native'),
+    })
+    config_file = os.path.join(workdir, 'collector.conf')
+    with open(config_file, 'w') as f:
+        f.write(repr(settings) + '\n')
+    count = max(1, int(rate * args.duration))
+    log = open(os.path.join(workdir, 'collector.log'), 'a')
+    try:
+        collector = subprocess.Popen(
+            [sys.executable,
+             os.path.join(ROOT, 'fasguard-benign-traffic-collection'),
+             '-c', config_file],
+            cwd=ROOT, stdout=log, stderr=log)
+        try:
+            time.sleep(args.settle)
+            if collector.poll() is not None:
+                raise RuntimeError('collector exited with %i; see %s'
+                                   % (collector.returncode, log.name))
+            sender = [sys.executable, os.path.abspath(__file__), '--send',
+                      '--rate', repr(rate), '--count', str(count)]
+            sender += ['--pcap', args.pcap] if args.pcap \
+                else ['--size', str(args.size)]
+            elapsed = float(subprocess.check_output(
+                ('ip', 'netns', 'exec', NAMESPACE) + tuple(sender)))
+            time.sleep(args.drain)
+        finally:
+            stop = time.time()
+            if collector.poll() is None:
+                collector.send_signal(signal.SIGINT)
+            collector.wait()
+            latency = time.time() - stop
+    finally:
+        log.close()
+    from fasguard_benign_traffic_collection.dumpfiles import PcapReader
+    saved = [rec[4] for rec in PcapReader(output)] \
+        if os.path.exists(output) else []
+    traffic = traffic_for(args)
+    matched, unexpected = compare(traffic, count, saved)
+    sample = min(count, 10000)
+    frame_size = float(sum(len(traffic.frame(k))
+                           for k in range(sample))) / sample
+    pps = count / max(elapsed, 1e-9)
+    return {
+        'rate': rate,
+        'sent': count,
+        'pps': pps,
+        'mbps': pps * frame_size * 8e-6,
+        'saved': len(saved),
+        'lost': count - matched,
+        'unexpected': unexpected,
+        'shutdown': latency,
+    }
+
+_traffic = {}
+
+def traffic_for(args):
+    key = (args.pcap, args.size)
+    if key not in _traffic:
+        _traffic[key] = RecordedTraffic(args.pcap) if args.pcap \
+            else SyntheticTraffic(args.size)
+    return _traffic[key]
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', metavar='<configfile>',
+                        help='collector config to merge the generated'
+                        ' settings into')
+    parser.add_argument('--start', type=float, default=10000,
+                        help='first rate in packets per second')
+    parser.add_argument('--factor', type=float, default=1.5)
+    parser.add_argument('--max', type=float, default=1000000)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--settle', type=float, default=2.0)
+    parser.add_argument('--drain', type=float, default=1.0)
+    parser.add_argument('--size', type=int, default=512,
+                        help='synthetic frame size in bytes')
+    parser.add_argument('--pcap', help='replay this file instead')
+    # used by the harness to run the sender inside the namespace
+    parser.add_argument('--send', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--rate', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--count', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv[1:])
+
+    if args.send:
+        print(send(SENDER_IFACE, traffic_for(args), args.rate, args.count))
+        return 0
+    if not sys.platform.startswith('linux') or os.geteuid() != 0:
+        print('%s: needs root on Linux' % argv[0], file=sys.stderr)
+        return 2
+
+    config = {}
+    if args.config:
+        import ast
+        with open(args.config) as f:
+            config = ast.literal_eval(f.read())
+    workdir = tempfile.mkdtemp(prefix='live_harness.')
+    best = None
+    done = False
+    print('%10s %10s %8s %9s %9s %8s %10s %9s' % (
+        'target pps', 'sent pps', 'Mbit/s', 'sent', 'saved', 'lost',
+        'unexpected', 'shutdown'))
+    try:
+        with VethPair():
+            rate = args.start
+            while rate <= args.max:
+                r = run_step(args, rate, config, workdir)
+                print('%10i %10i %8.1f %9i %9i %8i %10i %8.3fs' % (
+                    r['rate'], r['pps'], r['mbps'], r['sent'], r['saved'],
+                    r['lost'], r['unexpected'], r['shutdown']))
+                sys.stdout.flush()
+                if r['lost'] or r['unexpected']:
+                    break
+                best = r
+                rate *= args.factor
+        done = True
+    finally:
+        if done:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print('collector config and log kept in %s' % workdir,
+                  file=sys.stderr)
+    if best is None:
+        print('no rate was sustained without losses')
+        return 1
+    print('highest rate without losses: %i pps (%.1f Mbit/s)'
+          % (best['pps'], best['mbps']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
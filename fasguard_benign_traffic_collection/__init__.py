@@ -4,20 +4,32 @@ from __future__ import absolute_import
 
 # relative imports must go first; see
 # http://stackoverflow.com/q/28006766
+from .aggregator import Aggregator, AggregatorClient, AggregatorServer
 from .args import parse_args
 from .capture import CaptureParams, CaptureThread, CaptureThreadError
+from .checkpoint import Checkpointer, load_checkpoint
 from .config import parse_config, process_config
 from .dumpfiles import Dumpfiles
+from .eventloop import EventLoop
+from .fanout import run_fanout
 from .logging import config as logging_config
+from .plan import plan
+from .resources import ResourceMonitor
+from .ring import run_ring
+from .shedding import LoadShedder
+from .sketch import AnalysisOutput, merge_sketch_files
 from .stats import Stats, StatsLoggerThread
+from .util import dummy_context_manager, signal_event
 
 import logging
 try:
     import queue
 except ImportError:
     import Queue as queue
+import signal
 import sys
 import threading
+import time
 
 log = logging.getLogger(__name__)
 
@@ -29,89 +41,334 @@ def main(raw_args=sys.argv):
     if args.self_test:
         return self_test()
 
+    if args.merge_sketches:
+        try:
+            merged = merge_sketch_files(args.merge_sketches[0],
+                                        args.merge_sketches[1:])
+        except ValueError as e:
+            log.error('%s', e)
+            return 1
+        for line in merged.log_lines():
+            log.info(line)
+        return 0
+
     raw_config = parse_config(args.config)
     config = process_config(raw_config)
 
+    reload_config = None
+    if args.config != '-':
+        def reload_config():
+            return process_config(parse_config(args.config))
+
+    if args.resume and 'checkpoint' not in config:
+        log.error('--resume requires a checkpoint in the config')
+        return 1
+
+    # the workers would each see only some of the segments of a flow
+    splits_flows = 'ring' in config or (
+        config.get('fanout', {}).get('workers', 1) > 1
+        and config['fanout']['mode'] == 'lb')
+    if splits_flows and any('reassemble' in options for options
+                            in config.get('output_options', {}).values()):
+        log.error("'reassemble' is not supported with 'ring' or with"
+                  " fanout mode 'lb'")
+        return 1
+
+    if args.aggregate and 'aggregate' not in config:
+        log.error('--aggregate requires an aggregate setting in the'
+                  ' config')
+        return 1
+
+    if args.plan:
+        text, problems = plan(config, args.plan, args.hours,
+                              args.false_positive_rate)
+        sys.stdout.write(text)
+        return 1 if problems else 0
+
     try:
-        run(config)
+        if args.aggregate:
+            aggregate(config)
+        else:
+            run(config, reload_config, args.resume)
     except KeyboardInterrupt:
         return 1
     return 0
 
-def run(config):
-    capture_threads = set()
+def run(config, reload_config=None, resume=False):
+    """capture packets until interrupted or all inputs are exhausted
+
+    reload_config, if not None, is a function that rereads the config
+    file and returns a new processed config.  It is called whenever
+    SIGHUP is received, and the new 'outputs' table is swapped into
+    the running Dumpfiles without stopping capture.
+
+    If resume is true, the stats and outputs are restored from the
+    state file named in the 'checkpoint' config.
+    """
+    if config.get('fanout', {}).get('workers', 1) > 1:
+        for keyword in ('aggregator', 'analysis', 'checkpoint', 'rates',
+                        'resources', 'shedding'):
+            if keyword in config:
+                log.warning('%s is not supported with fanout; ignoring',
+                            keyword)
+        return run_fanout(config)
+    if 'ring' in config:
+        for keyword in ('aggregator', 'analysis', 'checkpoint', 'rates',
+                        'resources', 'shedding'):
+            if keyword in config:
+                log.warning('%s is not supported with ring; ignoring',
+                            keyword)
+        if config.get('engine', 'threads') != 'threads':
+            log.warning('ring always uses the threads engine')
+        return run_ring(config)
+
     shutdown_event = threading.Event()
-    # when a capture thread exits it will place a message on this
-    # queue (which might be an exception) to let the main thread know
-    # that it is done
-    status_q = queue.Queue()
-    stats = Stats()
+    reload_event = threading.Event()
+    rates = config.get('rates')
+    stats = Stats(rates=rates['buckets'] if rates else None)
+    resume_outputs = None
+    if resume:
+        state = load_checkpoint(config['checkpoint']['filename'])
+        resume_outputs = {}
+        if state is not None:
+            stats.set_snapshot(state['stats'])
+            resume_outputs = state['outputs']
 
-    # linktype must match among all pcap instances.  Packets from
-    # multiple packet capture threads might go to the same dumpfile,
-    # and each dumpfile has a specific linktype, so each capture
-    # thread's pcap instance must have a matching linktype.
+    # linktype of the output files.  Packets from multiple capture
+    # threads might go to the same dumpfile, and each dumpfile has a
+    # specific linktype, so packets from capture interfaces with a
+    # different linktype are converted (see decode.py).
     #
-    # linktype starts off as None until a capture interface is opened
-    # and its linktype is discovered.
-    capture_params = CaptureParams(
-        linktype = None,
-        snaplen = 65535,
-    )
-
-    with Dumpfiles(config, capture_params, stats) as dumpfiles:
+    # Unless set in the config, linktype starts off as None until a
+    # capture interface is opened and its linktype is discovered.
+    capture_settings = dict(linktype=None, snaplen=65535)
+    capture_settings.update(config.get('capture', {}))
+    capture_params = CaptureParams(**capture_settings)
+
+    analysis = None
+    if 'analysis' in config:
+        analysis = AnalysisOutput(**config['analysis'])
+
+    shedder = None
+    if 'shedding' in config:
+        shedder = LoadShedder(output_priorities(config),
+                              **config['shedding'])
+
+    with Dumpfiles(config, capture_params, stats,
+                   resume=resume_outputs) as dumpfiles, \
+         signal_event(signal.SIGHUP, reload_event):
+        checkpointer = None
+        if 'checkpoint' in config:
+            checkpointer = Checkpointer(stats=stats, dumpfiles=dumpfiles,
+                                        **config['checkpoint'])
+        monitor = None
+        if 'resources' in config:
+            monitor = ResourceMonitor(stats, dumpfiles,
+                                      **config['resources'])
+        client = None
+        if 'aggregator' in config:
+            client = AggregatorClient(stats=stats, dumpfiles=dumpfiles,
+                                      **config['aggregator'])
+            client.start()
+
+        # periodic work done by the main thread while packets are
+        # being captured
+        def housekeeping():
+            if reload_event.is_set():
+                reload_event.clear()
+                reload_outputs(reload_config, dumpfiles, shedder)
+            dumpfiles.flush_if_due()
+            if analysis is not None:
+                analysis.save_if_due()
+            if checkpointer is not None:
+                checkpointer.save_if_due()
+            if monitor is not None:
+                monitor.poll()
+
+        # SIGUSR1 logs an allocation trace (see resources.py)
+        trace_signal = dummy_context_manager(None)
+        if monitor is not None and monitor.tracing:
+            trace_signal = signal_event(signal.SIGUSR1, monitor.trace_event)
+
         stats_thread = StatsLoggerThread(stats, shutdown_event)
         stats_thread.start()
         try:
-            for iface in config.get('interfaces', (None,)):
-                log.info('reading packets from %s',
-                         iface if iface is not None else 'default interface')
-                # libpcap doesn't support capturing from multiple
-                # interfaces at the same time, so launch a separate
-                # thread for each interface.  It is possible to use
-                # select() or poll() to keep this single-threaded, but
-                # separate threads might help with performance on
-                # multi-core systems and it might help keep the
-                # packets in chronological order.  (The packets are
-                # still not guaranteed to be in chronoligical order
-                # for numerous reasons, but truly fixing this would
-                # require copying the packet data into a reorder
-                # buffer, plus sufficiently precise and accurate
-                # timestamps.)
-                ct = CaptureThread(
-                    iface, shutdown_event, dumpfiles, capture_params,
-                    status_q)
-                capture_threads.add(ct)
-                log.debug('thread %s starting...', ct.name)
-                ct.start()
-                log.debug('thread %s started', ct.name)
-            try:
-                log.debug('waiting for capture threads to exit...')
-                while capture_threads:
-                    try:
-                        # Python doesn't notice a SIGINT (generated by
-                        # Ctrl-C) until Queue.get() returns, so set a
-                        # timeout to a relatively short duration so that
-                        # the program is responsive to the user's Ctrl-C.
-                        (thread, exc_info) = status_q.get(timeout=0.25)
-                    except queue.Empty:
-                        continue
-                    log.debug('thread %s exited', thread.name)
-                    capture_threads.remove(thread)
-                    log.debug('still {:d} thread(s) remaining'.format(
-                        len(capture_threads)))
-                    if exc_info is not None:
-                        raise CaptureThreadError(
-                            'error in capture thread', exc_info)
-            except:
-                log.info('capture thread raised exception')
-                raise
-            finally:
-                log.info('shutting down')
-                shutdown_event.set()
+            inputs = config.get('interfaces', (None,))
+            with trace_signal:
+                if config.get('engine', 'threads') == 'select':
+                    run_event_loop(inputs, shutdown_event, dumpfiles,
+                                   capture_params, housekeeping, analysis,
+                                   shedder)
+                else:
+                    run_threads(inputs, shutdown_event, dumpfiles,
+                                capture_params, housekeeping, analysis,
+                                shedder)
         finally:
             log.debug('waiting for stats thread to exit')
             stats_thread.join()
+            if checkpointer is not None:
+                checkpointer.save()
+            if client is not None:
+                client.close()
+            if analysis is not None:
+                analysis.close()
+            if rates:
+                log_rates(stats)
+                if 'filename' in rates:
+                    stats.export_rates(rates['filename'], rates['format'])
+
+def aggregate(config):
+    """run the fleet aggregator until interrupted
+
+    See aggregator.py and config_handle_aggregate().
+    """
+    settings = config['aggregate']
+    rates = config.get('rates')
+    aggregator = Aggregator(settings['quotas'],
+                            rates['buckets'] if rates else None)
+    server = AggregatorServer(settings['listen'], aggregator)
+    start = time.time()
+    next_log = [start + settings['interval']]
+
+    def housekeeping():
+        now = time.time()
+        if now >= next_log[0]:
+            for line in aggregator.log_lines(now - start):
+                log.info(line)
+            next_log[0] = now + settings['interval']
+
+    try:
+        server.serve(threading.Event(), housekeeping)
+    finally:
+        server.close()
+        for line in aggregator.log_lines(time.time() - start):
+            log.info(line)
+        if rates:
+            log_rates(aggregator.stats)
+            if 'filename' in rates:
+                aggregator.stats.export_rates(rates['filename'],
+                                              rates['format'])
+
+def log_rates(stats):
+    """log a summary of each of the total's rate series
+    """
+    for series in stats.rates:
+        for field, unit in (('packets', 'pps'), ('bytes', 'Bps')):
+            s = series.summary(field)
+            if s is None:
+                continue
+            log.info('%s per %gs bucket over %i buckets: min %f, mean %f,'
+                     ' p50 %f, p95 %f, p99 %f, max %f %s',
+                     field, series.interval, s['buckets'], s['min'],
+                     s['mean'], s['p50'], s['p95'], s['p99'], s['max'],
+                     unit)
+
+def run_threads(inputs, shutdown_event, dumpfiles, capture_params,
+                housekeeping, analysis=None, shedder=None, ring=None):
+    """capture engine that runs one CaptureThread per input
+
+    If ring is not None, the capture threads only copy packets into
+    it (see ring.py).
+    """
+    capture_threads = set()
+    # when a capture thread exits it will place a message on this
+    # queue (which might be an exception) to let the main thread know
+    # that it is done
+    status_q = queue.Queue()
+    try:
+        for iface in inputs:
+            log.info('reading packets from %s',
+                     iface if iface is not None else 'default interface')
+            # libpcap doesn't support capturing from multiple
+            # interfaces at the same time, so launch a separate thread
+            # for each interface.  The 'select' engine (see
+            # eventloop.py) keeps this single-threaded instead, but
+            # separate threads might help with performance on
+            # multi-core systems and it might help keep the packets in
+            # chronological order.  (The packets are still not
+            # guaranteed to be in chronoligical order for numerous
+            # reasons, but truly fixing this would require copying the
+            # packet data into a reorder buffer, plus sufficiently
+            # precise and accurate timestamps.)
+            ct = CaptureThread(
+                iface, shutdown_event, dumpfiles, capture_params,
+                status_q, analysis, shedder, ring)
+            capture_threads.add(ct)
+            log.debug('thread %s starting...', ct.name)
+            ct.start()
+            log.debug('thread %s started', ct.name)
+        log.debug('waiting for capture threads to exit...')
+        while capture_threads:
+            housekeeping()
+            try:
+                # Python doesn't notice a SIGINT (generated by Ctrl-C)
+                # until Queue.get() returns, so set a timeout to a
+                # relatively short duration so that the program is
+                # responsive to the user's Ctrl-C.
+                (thread, exc_info) = status_q.get(timeout=0.25)
+            except queue.Empty:
+                continue
+            log.debug('thread %s exited', thread.name)
+            capture_threads.remove(thread)
+            log.debug('still {:d} thread(s) remaining'.format(
+                len(capture_threads)))
+            if exc_info is not None:
+                raise CaptureThreadError(
+                    'error in capture thread', exc_info)
+    except:
+        log.info('capture thread raised exception')
+        raise
+    finally:
+        log.info('shutting down')
+        shutdown_event.set()
+
+def run_event_loop(inputs, shutdown_event, dumpfiles, capture_params,
+                   housekeeping, analysis=None, shedder=None):
+    """capture engine that multiplexes all inputs in the main thread
+    """
+    loop = EventLoop(inputs, shutdown_event, dumpfiles, capture_params,
+                     housekeeping=housekeeping, analysis=analysis,
+                     shedder=shedder)
+    try:
+        loop.run()
+    finally:
+        shutdown_event.set()
+
+def output_priorities(config):
+    """the output priorities LoadShedder chooses among (0 included)
+    """
+    return [0] + [options.get('priority', 0) for options
+                  in config.get('output_options', {}).values()]
+
+def reload_outputs(reload_config, dumpfiles, shedder=None):
+    """reparse the config and swap its outputs into dumpfiles
+
+    Errors in the new config are logged and the old config is kept.
+    The shedder, if any, gets the new config's output priorities.
+    """
+    if reload_config is None:
+        log.warning('ignoring SIGHUP: config was read from stdin')
+        return
+    log.info('SIGHUP received, reloading config')
+    old_config = dumpfiles.config
+    try:
+        new_config = reload_config()
+        dumpfiles.reload(new_config)
+    except Exception:
+        log.exception('failed to reload config; keeping the old outputs')
+        return
+    if shedder is not None:
+        shedder.set_priorities(output_priorities(new_config))
+    for keyword in set(old_config) | set(new_config):
+        if keyword == 'outputs' \
+           or old_config.get(keyword) == new_config.get(keyword):
+            continue
+        if keyword in ('output_options', 'writer'):
+            log.warning('change to %s only applies to outputs opened'
+                        ' from now on', keyword)
+        else:
+            log.warning('change to %s takes effect only on restart',
+                        keyword)
 
 def self_test():
     import unittest
@@ -0,0 +1,471 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""fleet-wide stats and quotas for collectors on several sensors
+
+Each collector with an 'aggregator' config setting runs an
+AggregatorClient, which periodically sends the change in its stats
+since its last report (see stats.subtract_snapshots()) to an
+aggregator process started with --aggregate.  The aggregator
+(Aggregator and AggregatorServer) merges the reports into one fleet
+Stats tree, with rate series if configured, and checks the fleet-wide
+quotas of each output.  Once an output's quota is met across the
+fleet, every connected sensor (and every sensor that connects later)
+is told to stop collecting it, and closes the output as if its own
+quota had been met.
+
+The protocol is JSON, one message per line, over TCP:
+  * sensor to aggregator:  {"type": "delta", "sensor": <name>,
+    "stats": <stats delta>}
+  * aggregator to sensor:  {"type": "stop", "outputs": [<output
+    filename>, ...]}
+
+Output filenames are those in the stats, i.e., without partition
+suffixes, so all sensors (and fanout workers) writing an output count
+towards the same quota.  Output files stay on the sensors.  Sensors
+that can't reach the aggregator keep collecting and report the
+accumulated change once they reconnect; a restarted aggregator
+starts its totals from zero.
+"""
+
+from __future__ import absolute_import
+
+from .stats import Stats, empty_snapshot, subtract_snapshots
+
+import errno
+import fnmatch
+import json
+import logging
+import select
+import six
+import socket
+import threading
+import time
+import unittest
+
+log = logging.getLogger(__name__)
+
+def parse_address(address):
+    """return 'host:port' (or a (host, port) pair) as a (host, port) tuple
+
+    IPv6 addresses may be written in brackets ('[::1]:5555').
+    """
+    if isinstance(address, six.string_types):
+        host, sep, port = address.rpartition(':')
+        if not sep:
+            raise ValueError('address must be host:port: ' + repr(address))
+        host = host.strip('[]')
+    else:
+        host, port = address
+    return (host, int(port))
+
+def _send(sock, msg):
+    sock.sendall((json.dumps(msg, sort_keys=True) + '\n').encode('utf-8'))
+
+def _split_messages(buf, data):
+    """return (messages, rest) for data received after buf
+    """
+    lines = (buf + data).split(b'\n')
+    rest = lines.pop()
+    return [json.loads(line.decode('utf-8')) for line in lines], rest
+
+def _check_delta(msg):
+    """raise ValueError unless msg is a well-formed delta message
+
+    Checked before merging so that a bad report can't be half added
+    to the fleet stats.
+    """
+    def check_snapshot(snap):
+        if not isinstance(snap, dict):
+            raise ValueError('stats node is not an object')
+        for k in ('packets', 'bytes'):
+            if not isinstance(snap.get(k), six.integer_types):
+                raise ValueError('%r is not an integer' % (k,))
+        counters = snap.get('counters')
+        if not isinstance(counters, dict) or not all(
+                isinstance(v, six.integer_types + (float,))
+                for v in counters.values()):
+            raise ValueError('bad counters')
+        children = snap.get('children')
+        if not isinstance(children, dict):
+            raise ValueError('bad children')
+        for name, child in children.items():
+            if not isinstance(name, six.string_types):
+                raise ValueError('bad child name')
+            check_snapshot(child)
+    if not isinstance(msg.get('sensor'), six.string_types):
+        raise ValueError('missing or bad sensor name')
+    check_snapshot(msg.get('stats'))
+
+def _readable(socks, timeout):
+    try:
+        return select.select(socks, [], [], timeout)[0]
+    except (IOError, OSError, select.error) as e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return []
+
+class Aggregator(object):
+    """merges the stats deltas of sensors and checks fleet-wide quotas
+
+    quotas is an iterable of (glob, quota) pairs, where quota is a
+    dict with 'max_packets' and/or 'max_bytes'.  Each output whose
+    filename matches glob (see fnmatch) is limited separately.  rates
+    is passed to the fleet Stats (see Stats); reports go into the
+    rate series buckets of the time they are received.
+    """
+    def __init__(self, quotas=(), rates=None):
+        self.stats = Stats(rates=rates)
+        # sensor name -> [packets, bytes, time of last report]
+        self.sensors = {}
+        # outputs whose quota was met
+        self.stopped = set()
+        self._quotas = list(quotas)
+
+    def merge(self, sensor, delta, now=None):
+        """add a sensor's stats delta
+
+        Returns a sorted list of the outputs whose quota was met by
+        this delta.
+        """
+        if now is None:
+            now = time.time()
+        self.stats.add_snapshot(delta, now)
+        totals = self.sensors.setdefault(sensor, [0, 0, now])
+        totals[0] += delta['packets']
+        totals[1] += delta['bytes']
+        totals[2] = now
+        newly = sorted(name for name in delta['children']
+                       if name not in self.stopped
+                       and self._over_quota(name))
+        for name in newly:
+            node = self.stats.get_child(name)
+            log.info('%s: fleet-wide quota met (%i packets, %i bytes)',
+                     name, node.packets, node.bytes)
+            self.stopped.add(name)
+        return newly
+
+    def _over_quota(self, name):
+        node = self.stats.get_child(name)
+        for glob, quota in self._quotas:
+            if not fnmatch.fnmatchcase(name, glob):
+                continue
+            if node.packets >= quota.get('max_packets', float('inf')) \
+               or node.bytes >= quota.get('max_bytes', float('inf')):
+                return True
+        return False
+
+    def log_lines(self, elapsed):
+        lines = list(self.stats.log_lines(elapsed, prefix='fleet '))
+        now = time.time()
+        for sensor in sorted(self.sensors):
+            packets, nbytes, last = self.sensors[sensor]
+            lines.append('sensor %s: %i packets (%i bytes), last report'
+                         ' %.0f seconds ago' % (sensor, packets, nbytes,
+                                                now - last))
+        return lines
+
+class AggregatorServer(object):
+    """accepts sensor connections and feeds their reports to an Aggregator
+
+    Runs in a single thread; see serve().  If the port of address is
+    0, a free port is chosen (see the 'address' attribute).
+    """
+    def __init__(self, address, aggregator):
+        self.aggregator = aggregator
+        host, port = parse_address(address)
+        family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM)[0]
+        self._listener = socket.socket(family, socktype, proto)
+        try:
+            self._listener.setsockopt(socket.SOL_SOCKET,
+                                      socket.SO_REUSEADDR, 1)
+            self._listener.bind(sockaddr)
+            self._listener.listen(16)
+        except:
+            self._listener.close()
+            raise
+        self.address = self._listener.getsockname()[:2]
+        # socket -> [receive buffer, sensor name]
+        self._conns = {}
+        log.info('aggregator listening on %s:%i', *self.address)
+
+    def serve(self, shutdown_event, housekeeping=None, timeout=0.25):
+        """handle sensors until shutdown_event is set
+
+        housekeeping, if not None, is called between polls.
+        """
+        while not shutdown_event.is_set():
+            self.poll(timeout)
+            if housekeeping is not None:
+                housekeeping()
+
+    def poll(self, timeout=0.0):
+        """handle whatever is ready within timeout seconds
+        """
+        socks = [self._listener] + list(self._conns)
+        for sock in _readable(socks, timeout):
+            if sock is self._listener:
+                self._accept()
+            elif sock in self._conns:
+                self._receive(sock)
+
+    def _accept(self):
+        conn, peer = self._listener.accept()
+        # reads only happen once select() says so; the timeout
+        # bounds how long a stuck sensor can hold up a send
+        conn.settimeout(5.0)
+        self._conns[conn] = [b'', None]
+        log.info('sensor connected from %s', peer[0])
+        if self.aggregator.stopped:
+            self._send(conn, {'type': 'stop',
+                              'outputs': sorted(self.aggregator.stopped)})
+
+    def _receive(self, sock):
+        state = self._conns[sock]
+        try:
+            data = sock.recv(65536)
+        except (socket.error, IOError, OSError) as e:
+            log.warning('sensor %s: %s', state[1], e)
+            data = b''
+        if not data:
+            self._drop(sock)
+            return
+        try:
+            messages, state[0] = _split_messages(state[0], data)
+        except ValueError:
+            log.warning('sensor %s: malformed message; disconnecting',
+                        state[1])
+            self._drop(sock)
+            return
+        for msg in messages:
+            try:
+                if msg.get('type') != 'delta':
+                    log.warning('sensor %s: ignoring message of type %r',
+                                state[1], msg.get('type'))
+                    continue
+                _check_delta(msg)
+                state[1] = msg['sensor']
+                newly = self.aggregator.merge(msg['sensor'], msg['stats'])
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                log.warning('sensor %s: invalid message (%s);'
+                            ' disconnecting', state[1], e)
+                self._drop(sock)
+                return
+            if newly:
+                for conn in list(self._conns):
+                    self._send(conn, {'type': 'stop', 'outputs': newly})
+
+    def _send(self, sock, msg):
+        try:
+            _send(sock, msg)
+        except (socket.error, IOError, OSError) as e:
+            log.warning('sensor %s: %s', self._conns[sock][1], e)
+            self._drop(sock)
+
+    def _drop(self, sock):
+        state = self._conns.pop(sock, None)
+        if state is not None:
+            log.info('sensor %s disconnected', state[1])
+        sock.close()
+
+    def close(self):
+        for sock in list(self._conns):
+            self._drop(sock)
+        self._listener.close()
+
+class AggregatorClient(object):
+    """reports a collector's stats to the aggregator and obeys it
+
+    poll() sends the change in stats since the last successful report
+    every 'interval' seconds and handles the aggregator's stop
+    commands, which close the named outputs (see
+    Dumpfiles.stop_output()).  start() calls it from a thread of its
+    own, since connecting to an unreachable aggregator can take
+    seconds that the thread doing the capturing can't spare.  sensor
+    defaults to the host name.
+    """
+    def __init__(self, address, stats, dumpfiles, sensor=None,
+                 interval=5.0):
+        self._address = parse_address(address)
+        self._stats = stats
+        self._dumpfiles = dumpfiles
+        self.sensor = sensor if sensor is not None else socket.gethostname()
+        self._interval = interval
+        self._sock = None
+        self._buf = b''
+        self._sent = empty_snapshot()
+        self._next = 0.0
+        self._closing = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """poll from a background thread until close()
+        """
+        self._thread = threading.Thread(target=self._run,
+                                        name='aggregator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._closing.is_set():
+            try:
+                self.poll()
+            except Exception:
+                log.exception('aggregator client error')
+                self._disconnect()
+            self._closing.wait(0.25)
+
+    def poll(self, now=None):
+        if now is None:
+            now = time.time()
+        self._receive()
+        if now >= self._next:
+            self.report()
+            self._next = now + self._interval
+
+    def report(self):
+        """send the stats delta; returns False if it couldn't be sent
+        """
+        snap = self._stats.snapshot()
+        msg = {
+            'type': 'delta',
+            'sensor': self.sensor,
+            'stats': subtract_snapshots(snap, self._sent),
+        }
+        try:
+            if self._sock is None:
+                self._sock = socket.create_connection(self._address, 5.0)
+                log.info('connected to aggregator at %s:%i', *self._address)
+            _send(self._sock, msg)
+        except (socket.error, IOError, OSError) as e:
+            log.warning('cannot report to aggregator at %s:%i: %s',
+                        self._address[0], self._address[1], e)
+            self._disconnect()
+            return False
+        self._sent = snap
+        return True
+
+    def _receive(self):
+        while self._sock is not None and _readable([self._sock], 0):
+            try:
+                data = self._sock.recv(65536)
+            except (socket.error, IOError, OSError):
+                data = b''
+            if not data:
+                log.warning('aggregator closed the connection')
+                self._disconnect()
+                return
+            messages, self._buf = _split_messages(self._buf, data)
+            for msg in messages:
+                if msg.get('type') == 'stop':
+                    for filename in msg['outputs']:
+                        self._dumpfiles.stop_output(filename)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._buf = b''
+
+    def close(self):
+        """stop the thread, send a final report and disconnect
+        """
+        self._closing.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+        self._disconnect()
+
+class Tests(unittest.TestCase):
+    def test_quotas(self):
+        a = Aggregator(quotas=[('*.pcap', {'max_packets': 3})])
+        delta = {'packets': 2, 'bytes': 20, 'counters': {}, 'children': {
+            'http.pcap': {'packets': 2, 'bytes': 20, 'counters': {},
+                          'children': {}}}}
+        self.assertEqual(a.merge('s1', delta), [])
+        self.assertEqual(a.merge('s2', delta), ['http.pcap'])
+        self.assertEqual(a.merge('s1', delta), [])
+        self.assertEqual(a.stats.get_child('http.pcap').packets, 6)
+        self.assertEqual(a.sensors['s1'][:2], [4, 40])
+
+    def test_loopback(self):
+        class FakeDumpfiles(object):
+            stopped = []
+            def stop_output(self, filename):
+                self.stopped.append(filename)
+                return True
+        server = AggregatorServer(('127.0.0.1', 0), Aggregator(
+            quotas=[('dns.pcap', {'max_bytes': 100})]))
+        clients = []
+        try:
+            for i in range(2):
+                stats = Stats()
+                stats.get_child('dns.pcap').got_packet(60, 0.0)
+                clients.append(AggregatorClient(
+                    server.address, stats, FakeDumpfiles(), 's%i' % i))
+            for c in clients:
+                self.assertTrue(c.report())
+            deadline = time.time() + 5
+            while len(server.aggregator.stopped) < 1 \
+                  and time.time() < deadline:
+                server.poll(0.1)
+            self.assertEqual(server.aggregator.stopped, set(['dns.pcap']))
+            # the stop command reaches both sensors
+            deadline = time.time() + 5
+            while len(FakeDumpfiles.stopped) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+                for c in clients:
+                    c.poll(0)
+            self.assertEqual(FakeDumpfiles.stopped, ['dns.pcap'] * 2)
+            # only the change since the last report is sent
+            clients[0]._stats.get_child('dns.pcap').got_packet(10, 1.0)
+            clients[0].report()
+            deadline = time.time() + 5
+            while server.aggregator.stats.bytes < 130 \
+                  and time.time() < deadline:
+                server.poll(0.1)
+            self.assertEqual(server.aggregator.stats.bytes, 130)
+        finally:
+            for c in clients:
+                c._disconnect()
+            server.close()
+
+    def test_invalid_messages(self):
+        server = AggregatorServer(('127.0.0.1', 0), Aggregator())
+        try:
+            for bad in (b'[1, 2]\n', b'{"type": "delta", "sensor": "x"}\n',
+                        b'{"type": "delta", "sensor": "x", "stats":'
+                        b' {"packets": 1, "bytes": "y", "counters": {},'
+                        b' "children": {}}}\n'):
+                sock = socket.create_connection(server.address, 5.0)
+                try:
+                    server.poll(1.0)
+                    sock.sendall(bad)
+                    # the sensor is dropped and the server keeps going
+                    deadline = time.time() + 5
+                    while server._conns and time.time() < deadline:
+                        server.poll(0.1)
+                    self.assertEqual(server._conns, {})
+                finally:
+                    sock.close()
+            self.assertEqual(server.aggregator.stats.packets, 0)
+        finally:
+            server.close()
+
+    def test_thread(self):
+        server = AggregatorServer(('127.0.0.1', 0), Aggregator())
+        stats = Stats()
+        stats.get_child('dns.pcap').got_packet(60, 0.0)
+        client = AggregatorClient(server.address, stats, None, 's0',
+                                  interval=0.1)
+        try:
+            client.start()
+            deadline = time.time() + 5
+            while server.aggregator.stats.packets < 1 \
+                  and time.time() < deadline:
+                server.poll(0.1)
+            self.assertEqual(server.aggregator.stats.bytes, 60)
+        finally:
+            client.close()
+            server.close()
+        self.assertFalse(client._thread.is_alive())
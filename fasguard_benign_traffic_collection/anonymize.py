@@ -0,0 +1,227 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""keyed prefix-preserving address anonymization of saved packets
+
+Addresses are mapped with the Crypto-PAn construction, using
+HMAC-SHA256 as the pseudorandom function instead of AES (which the
+standard library lacks):  bit i of the anonymized address is bit i of
+the original XOR a keyed function of the original's first i bits.
+Two addresses sharing a k-bit prefix therefore map to addresses
+sharing a k-bit prefix, and the same key gives the same mapping on
+every sensor and run.
+
+A new address costs one HMAC per bit, so the anonymized value of
+every byte-aligned prefix is cached; an address in a known /24 only
+needs its last 8 bits computed.  Complete addresses are cached too,
+together with the change they make to a checksum, so that a packet
+between known hosts costs a few dictionary lookups.  Both caches are
+cleared when they exceed their size limit.
+
+IPv4 and IPv6 source and destination addresses are rewritten, as are
+Ethernet MAC addresses (keeping the broadcast address and the
+multicast and locally-administered bits intact).  The IPv4 header
+checksum and the TCP and UDP checksums, which cover the addresses
+through the pseudo-header, are updated incrementally (RFC 1624).
+Other checksums over the pseudo-header (ICMPv6) become invalid, and
+addresses inside payloads (ARP, DNS, ...) are not touched.
+"""
+
+from __future__ import absolute_import
+
+from .decode import DLT_EN10MB, ETHERTYPE_IPV4, ETHERTYPE_IPV6
+
+import binascii
+import hashlib
+import hmac
+import logging
+import struct
+import unittest
+
+log = logging.getLogger(__name__)
+
+# offset of the checksum in the L4 header, by IP protocol
+_l4_checksums = {6: 16, 17: 6}
+_u16 = struct.Struct('!H')
+_prf_input = struct.Struct('!BB')
+
+def _words(data):
+    return sum(struct.unpack('!%iH' % (len(data) // 2), bytes(data)))
+
+def checksum_delta(old, new):
+    """return the change in the ones' complement sum of some data when
+    bytes old are replaced by new
+
+    old and new have the same even length and start at an even offset
+    of the data.
+    """
+    return _words(new) - _words(old)
+
+def adjust_checksum(csum, delta):
+    """return checksum csum adjusted by a checksum_delta() (RFC 1624)
+    """
+    s = (0xffff - csum + delta) % 0xffff
+    return 0xffff - (s or 0xffff)
+
+class Anonymizer(object):
+    """rewrites the addresses of packets with a keyed mapping
+
+    key is the secret (bytes); keep it to map later collections the
+    same way, or discard it to make the mapping irreversible.  If mac
+    is false, link-layer addresses are left alone.  cache_size limits
+    each of the two caches (see the module docstring).
+    """
+    def __init__(self, key, mac=True, cache_size=1 << 20):
+        if not key:
+            raise ValueError('anonymization requires a key')
+        self._hmac = hmac.new(key, digestmod=hashlib.sha256)
+        self._mac = mac
+        self._cache_size = cache_size
+        # address bytes -> (anonymized address bytes, checksum delta)
+        self._addresses = {}
+        # (bits, prefix length, prefix) -> anonymized prefix
+        self._prefixes = {}
+
+    def _prf(self, bits, length, prefix):
+        msg = _prf_input.pack(bits, length) \
+            + struct.pack('!QQ', prefix >> 64, prefix & (2 ** 64 - 1))
+        h = self._hmac.copy()
+        h.update(msg)
+        return bytearray(h.digest()[:1])[0] & 1
+
+    def map(self, address, bits):
+        """return the anonymized value of a bits-bit integer address
+        """
+        prefixes = self._prefixes
+        start = out = 0
+        for length in range(bits - 8 - (bits % 8), 0, -8):
+            hit = prefixes.get((bits, length, address >> (bits - length)))
+            if hit is not None:
+                start, out = length, hit
+                break
+        if len(prefixes) > self._cache_size:
+            prefixes.clear()
+        for i in range(start, bits):
+            prefix = address >> (bits - i)
+            bit = (address >> (bits - 1 - i)) & 1
+            out = (out << 1) | (bit ^ self._prf(bits, i, prefix))
+            if (i + 1) % 8 == 0 and i + 1 < bits:
+                prefixes[(bits, i + 1, address >> (bits - i - 1))] = out
+        return out
+
+    def _lookup(self, data):
+        """return (anonymized bytes, checksum delta) for address bytes
+
+        Addresses of different families have different lengths, so
+        they share the cache without colliding.
+        """
+        data = bytes(data)
+        ret = self._addresses.get(data)
+        if ret is not None:
+            return ret
+        value = self.map(int(binascii.hexlify(data), 16), len(data) * 8)
+        new = bytearray(binascii.unhexlify('%0*x' % (len(data) * 2,
+                                                     value)))
+        if len(data) == 6:
+            if data == b'\xff' * 6:
+                new = bytearray(data)
+            else:
+                # keep the multicast and locally-administered bits
+                new[0] = (new[0] & 0xfc) | (bytearray(data)[0] & 0x03)
+        if len(self._addresses) > self._cache_size:
+            self._addresses.clear()
+        ret = (bytes(new), checksum_delta(data, new))
+        self._addresses[data] = ret
+        return ret
+
+    def apply(self, packet, decoded, linktype):
+        """return packet (a copy, unless a bytearray) with its
+        addresses rewritten
+
+        decoded is the packet's decode.Decoded tuple and linktype is
+        the link type of the packet's output.
+        """
+        buf = packet if isinstance(packet, bytearray) else bytearray(packet)
+        lookup = self._lookup
+        if self._mac and linktype == DLT_EN10MB and len(buf) >= 12:
+            buf[0:6] = lookup(buf[0:6])[0]
+            buf[6:12] = lookup(buf[6:12])[0]
+        if decoded is None or decoded.l3 is None:
+            return buf
+        ethertype = decoded.service[0]
+        l3 = decoded.l3
+        if ethertype == ETHERTYPE_IPV4 and len(buf) >= l3 + 20:
+            start, size = l3 + 12, 4
+        elif ethertype == ETHERTYPE_IPV6 and len(buf) >= l3 + 40:
+            start, size = l3 + 8, 16
+        else:
+            return buf
+        mid, end = start + size, start + 2 * size
+        src, src_delta = lookup(buf[start:mid])
+        dst, dst_delta = lookup(buf[mid:end])
+        buf[start:mid] = src
+        buf[mid:end] = dst
+        delta = src_delta + dst_delta
+        if ethertype == ETHERTYPE_IPV4:
+            _u16.pack_into(buf, l3 + 10, adjust_checksum(
+                _u16.unpack_from(buf, l3 + 10)[0], delta))
+        self._fix_l4_checksum(buf, decoded, delta)
+        return buf
+
+    @staticmethod
+    def _fix_l4_checksum(buf, decoded, delta):
+        service, l4 = decoded.service, decoded.l4
+        if l4 is None or len(service) < 2:
+            return
+        off = _l4_checksums.get(service[1])
+        # no L4 header in non-first fragments
+        if off is None or (len(service) > 2 and service[2] == -1) \
+           or len(buf) < l4 + off + 2:
+            return
+        csum = _u16.unpack_from(buf, l4 + off)[0]
+        if service[1] == 17 and csum == 0:
+            # UDP over IPv4 without a checksum
+            return
+        csum = adjust_checksum(csum, delta)
+        if service[1] == 17 and csum == 0:
+            csum = 0xffff
+        _u16.pack_into(buf, l4 + off, csum)
+
+class Tests(unittest.TestCase):
+    @staticmethod
+    def _checksum(data):
+        if len(data) % 2:
+            data = data + b'\0'
+        s = _words(data)
+        while s >> 16:
+            s = (s & 0xffff) + (s >> 16)
+        return 0xffff - s
+
+    def test_prefix_preserving(self):
+        a = Anonymizer(b'secret')
+        x = a.map(0x0a000001, 32)
+        y = a.map(0x0a0000ff, 32)
+        z = a.map(0x0a800001, 32)
+        self.assertEqual(x >> 8, y >> 8)
+        self.assertEqual(x >> 24, z >> 24)
+        self.assertNotEqual(x >> 23, z >> 23)
+        self.assertEqual(x, Anonymizer(b'secret').map(0x0a000001, 32))
+        self.assertNotEqual(x, Anonymizer(b'other').map(0x0a000001, 32))
+
+    def test_checksums(self):
+        from .decode import Decoded
+        ip = bytearray(b'\x45\x00\x00\x2c\x00\x01\x00\x00\x40\x06\x00\x00'
+                       b'\xc0\xa8\x01\x02\x0a\x00\x00\x07')
+        _u16.pack_into(ip, 10, self._checksum(ip))
+        tcp = bytearray(b'\xc0\x00\x00\x50' + b'\0' * 8 + b'\x50\x18\x20\x00'
+                        + b'\0' * 4) + b'hello'
+        pseudo = ip[12:20] + b'\x00\x06' + _u16.pack(len(tcp))
+        _u16.pack_into(tcp, 16, self._checksum(pseudo + tcp))
+        packet = bytes(b'\x02' * 6 + b'\x01' * 6 + b'\x08\x00' + ip + tcp)
+        decoded = Decoded((0x800, 6, 80), 14, 34, 54)
+        out = Anonymizer(b'key').apply(packet, decoded, DLT_EN10MB)
+        self.assertNotEqual(out[26:34], packet[26:34])
+        self.assertEqual(out[0] & 3, 2)
+        self.assertEqual(self._checksum(out[14:34]), 0)
+        pseudo = out[26:34] + b'\x00\x06' + _u16.pack(len(tcp))
+        self.assertEqual(self._checksum(pseudo + out[34:]), 0)
+        self.assertEqual(out[54:], b'hello')
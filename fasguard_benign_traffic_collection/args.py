@@ -20,12 +20,47 @@ def parse_args(raw_args=sys.argv):
         description='Capture packets and save to a pcap file for future\
  use in a FASGuard bloom filter.',
     )
+    parser.add_argument('--aggregate',
+                        action='store_true',
+                        help='run the fleet aggregator configured by' \
+                            + ' the "aggregate" config instead of' \
+                            + ' capturing')
     parser.add_argument('-c', '--config',
                         type=Filename,
                         default='-',
                         metavar='<configfile>',
                         help='specify the configuration file pathname,' \
                             + ' or "-" for standard input (default)')
+    parser.add_argument('--false-positive-rate',
+                        type=float,
+                        default=0.001,
+                        metavar='<rate>',
+                        help='Bloom filter false positive rate for' \
+                            + ' --plan (default 0.001)')
+    parser.add_argument('--hours',
+                        type=float,
+                        default=24.0,
+                        metavar='<hours>',
+                        help='planned collection time for --plan' \
+                            + ' (default 24)')
+    parser.add_argument('--merge-sketches',
+                        nargs='+',
+                        metavar='<file>',
+                        help='merge the traffic rate analysis sketch' \
+                            + ' files given after the first into the' \
+                            + ' first, print the result and exit')
+    parser.add_argument('--plan',
+                        type=Filename,
+                        metavar='<rate report>',
+                        help='plan a collection of --hours from the' \
+                            + ' traffic rate analysis file given,' \
+                            + ' check it against the config, print' \
+                            + ' suggested outputs and quotas and exit')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='restore the state saved by the' \
+                            + ' "checkpoint" config and append to' \
+                            + ' existing output files')
     parser.add_argument('--self-test',
                         action='store_true',
                         help='run diagnostic self tests and exit')
@@ -0,0 +1,230 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""vectorized classification of packet batches
+
+Instead of classifying each packet in its own libpcap callback, a
+Capture in batch mode only copies the packets of a dispatch() call
+into a PacketBatch (one contiguous buffer plus an offsets array).
+classify() then pulls the ethertype, IP version and protocol,
+fragment offset and ports out of every packet at once with NumPy
+gather operations, and group() sorts the packets by service so that
+each output is looked up once per batch and receives its packets in
+a single Dumpfile.save_batch() call.
+
+Only link types with a fixed-size header carrying an ethertype are
+vectorized (see layouts).  Packets the vectorized path doesn't handle
+(VLAN tags, MPLS, 802.3/SNAP frames, IPv6 extension headers and
+packets too short for the headers) are flagged and classified with
+the scalar decoder instead, so the results always match decode.py.
+"""
+
+from __future__ import absolute_import
+
+from .decode import (DLT_EN10MB, DLT_LINUX_SLL, DLT_LINUX_SLL2,
+                     ETHERTYPE_IPV4, ETHERTYPE_IPV6, Decoded, Header,
+                     decoder_for_linktype, ipv6_ext_hdrs, mpls_ethertypes,
+                     vlan_ethertypes)
+
+import array
+import logging
+import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# linktype -> (link header length, offset of the ethertype)
+layouts = {
+    DLT_EN10MB: (14, 12),
+    DLT_LINUX_SLL: (16, 14),
+    DLT_LINUX_SLL2: (20, 0),
+}
+
+# zero bytes after the last packet so that gathers of header fields
+# past the end of a short packet stay inside the buffer
+_PAD = 128
+# stand-in for offsets and service fields that don't apply
+NONE = -2
+
+def supported(linktype):
+    """True if packets of linktype can be classified in batches
+    """
+    return numpy is not None and linktype in layouts
+
+class PacketBatch(object):
+    """packets copied out of libpcap's buffer during one dispatch()
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.data = bytearray()
+        self.starts = array.array('l')
+        self.headers = []
+
+    def __len__(self):
+        return len(self.headers)
+
+    def add(self, header, packet):
+        # both the packet and the header may live in libpcap's static
+        # buffer, so copy them
+        self.starts.append(len(self.data))
+        self.data += packet
+        self.headers.append(
+            Header(header.sec, header.nsec, header.caplen, header.len))
+
+    def packet(self, i):
+        end = self.starts[i + 1] if i + 1 < len(self.starts) \
+            else len(self.data)
+        return self.data[self.starts[i]:end]
+
+def classify(buf, starts, caplens, l2_len, ethertype_offset):
+    """classify a batch of packets with a fixed-size link header
+
+    buf is a uint8 array holding the packets (followed by at least
+    _PAD bytes of padding), starts and caplens are int64 arrays.
+    Returns a dict of int64 arrays:  'ethertype', 'proto', 'port',
+    'l3', 'l4' and 'payload' (offsets within each packet), with NONE
+    where a field doesn't apply, and the boolean 'fallback' array
+    flagging packets that need the scalar decoder.
+    """
+    def u8(off):
+        return buf[off].astype(numpy.int64)
+    def u16(off):
+        return (u8(off) << 8) | buf[off + 1]
+
+    n = len(starts)
+    l3 = l2_len
+    ethertype = u16(starts + ethertype_offset)
+    fallback = (caplens < ethertype_offset + 2) | (ethertype <= 1500) \
+        | numpy.isin(ethertype, list(vlan_ethertypes | mpls_ethertypes))
+    ipv4 = (ethertype == ETHERTYPE_IPV4)
+    ipv6 = (ethertype == ETHERTYPE_IPV6)
+    fallback |= ipv4 & (caplens < l3 + 10)
+    fallback |= ipv6 & (caplens < l3 + 7)
+    proto6 = u8(starts + l3 + 6)
+    fallback |= ipv6 & numpy.isin(proto6, list(ipv6_ext_hdrs))
+    ipv4 &= ~fallback
+    ipv6 &= ~fallback
+    ip = ipv4 | ipv6
+
+    proto = numpy.where(ipv4, u8(starts + l3 + 9),
+                        numpy.where(ipv6, proto6, NONE))
+    l4 = numpy.where(ipv4, l3 + (u8(starts + l3) & 0xf) * 4,
+                     numpy.where(ipv6, l3 + 40, NONE))
+    frag_offset = numpy.where(ipv4, u16(starts + l3 + 6) & 0x1fff, 0)
+
+    tcp = ip & (proto == 6)
+    udp = ip & (proto == 17)
+    tcpudp = tcp | udp
+    unknown_port = tcpudp & ((frag_offset != 0) | (caplens < l4 + 4))
+    has_ports = tcpudp & ~unknown_port
+    l4_abs = starts + numpy.where(ip, l4, 0)
+    port = numpy.where(
+        has_ports, numpy.minimum(u16(l4_abs), u16(l4_abs + 2)),
+        numpy.where(unknown_port, -1, NONE))
+    tcp_payload = numpy.where(caplens < l4 + 13, NONE,
+                              l4 + (u8(l4_abs + 12) >> 4) * 4)
+    payload = numpy.where(
+        has_ports & tcp, tcp_payload,
+        numpy.where(has_ports & udp, l4 + 8,
+                    numpy.where(ip & ~tcpudp, l4, NONE)))
+    return {
+        'ethertype': ethertype,
+        'proto': proto,
+        'port': port,
+        'l3': numpy.full(n, l3, dtype=numpy.int64),
+        'l4': l4,
+        'payload': payload,
+        'fallback': fallback,
+    }
+
+def _opt(value):
+    return None if value == NONE else value
+
+class BatchClassifier(object):
+    """classifies the PacketBatch of a capture handle
+
+    See classify() and group().
+    """
+    def __init__(self, linktype):
+        self._layout = layouts[linktype]
+        self._decode = decoder_for_linktype(linktype)
+
+    def classify(self, batch):
+        """return a list with the decode.Decoded of each packet
+
+        Packets of the same service share one service tuple.
+        """
+        n = len(batch)
+        starts = numpy.array(batch.starts, dtype=numpy.int64)
+        caplens = numpy.diff(numpy.append(starts, len(batch.data)))
+        buf = numpy.frombuffer(bytes(batch.data) + b'\0' * _PAD,
+                               dtype=numpy.uint8)
+        c = classify(buf, starts, caplens, *self._layout)
+        fields = [c[k].tolist() for k in
+                  ('ethertype', 'proto', 'port', 'l3', 'l4', 'payload')]
+        fallback = c['fallback'].tolist()
+        services = {}
+        decoded = [None] * n
+        for i, (ethertype, proto, port, l3, l4, payload) \
+                in enumerate(zip(*fields)):
+            if fallback[i]:
+                decoded[i] = self._decode(bytes(batch.packet(i)))
+                continue
+            key = (ethertype, proto, port)
+            try:
+                service = services[key]
+            except KeyError:
+                service = services[key] = tuple(
+                    x for x in key if x != NONE)
+            decoded[i] = Decoded(service, l3, _opt(l4), _opt(payload))
+        return decoded
+
+    @staticmethod
+    def group(decoded):
+        """return [(service, [packet index, ...]), ...]
+
+        Indices are in increasing order within each group.
+        """
+        groups = {}
+        for i, d in enumerate(decoded):
+            try:
+                groups[d.service].append(i)
+            except KeyError:
+                groups[d.service] = [i]
+        return list(groups.items())
+
+class Tests(unittest.TestCase):
+    @unittest.skipIf(numpy is None, 'numpy not available')
+    def test_matches_scalar_decoder(self):
+        from .decode import Tests as DecodeTests
+        eth = b'\x00' * 12
+        ip4 = DecodeTests.tcp
+        frag = ip4[:6] + b'\x00\x10' + ip4[8:]
+        ip6 = (b'\x60\x00\x00\x00\x00\x08\x11\x40' + b'\x00' * 32
+               + b'\x00\x35\x04\x00\x00\x08\x00\x00')
+        ip6ext = ip6[:6] + b'\x00' + ip6[7:40] + b'\x11\x00' + b'\x00' * 6 \
+            + ip6[40:]
+        packets = [
+            eth + b'\x08\x00' + ip4,
+            eth + b'\x08\x00' + frag,
+            eth + b'\x08\x00' + ip4[:22],
+            eth + b'\x86\xdd' + ip6,
+            eth + b'\x86\xdd' + ip6ext,
+            eth + b'\x81\x00\x00\x01\x08\x00' + ip4,
+            eth + b'\x08\x06' + b'\x00' * 28,
+            eth + b'\x00\x20' + b'\x00' * 32,
+            eth + b'\x08\x00' + ip4[:9] + b'\x2f' + ip4[10:],
+        ]
+        batch = PacketBatch()
+        for p in packets:
+            batch.add(Header(0, 0, len(p), len(p)), p)
+        classifier = BatchClassifier(DLT_EN10MB)
+        decoded = classifier.classify(batch)
+        scalar = decoder_for_linktype(DLT_EN10MB)
+        self.assertEqual(decoded, [scalar(p) for p in packets])
+        groups = dict(classifier.group(decoded))
+        self.assertEqual(groups[(ETHERTYPE_IPV4, 6, 80)], [0, 5])
@@ -2,23 +2,49 @@
 
 from __future__ import absolute_import
 
+from .batch import BatchClassifier, PacketBatch, supported as batch_supported
+from .decode import decoder_for_linktype, reframer_for_linktypes
+from .fanout import join_fanout
 from .util import close_when_done
 
 import fasguard_pcap as pcap
-import dpkt
+import errno
 import logging
 import os
+import select
 import stat
 import sys
 import threading
+import time
 import traceback
+import unittest
 
 log = logging.getLogger(__name__)
 
+# a BPF filter that matches no packet (none is 0 bytes long), set on
+# live handles while no output is collecting; see
+# Dumpfiles.poll_schedules()
+IDLE_FILTER = 'less 0'
+
 class CaptureParams(object):
-    def __init__(self, linktype, snaplen):
+    """settings shared by all capture handles
+
+    See config_handle_capture() in config.py for the meaning of the
+    keyword arguments.
+    """
+    def __init__(self, linktype, snaplen, buffer_size=None, timeout_ms=250,
+                 immediate=False, dispatch_count=-1, fanout=None,
+                 batch=False):
         self._snaplen = snaplen
         self._linktype = linktype
+        self._buffer_size = buffer_size
+        self._timeout_ms = timeout_ms
+        self._immediate = immediate
+        self._dispatch_count = dispatch_count
+        # (group, mode) of the PACKET_FANOUT group live handles join,
+        # or None; see fanout.py
+        self._fanout = fanout
+        self._batch = batch
         self.lock = threading.RLock()
     @property
     def linktype(self):
@@ -31,6 +57,24 @@ class CaptureParams(object):
     @property
     def snaplen(self):
         return self._snaplen
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+    @property
+    def timeout_ms(self):
+        return self._timeout_ms
+    @property
+    def immediate(self):
+        return self._immediate
+    @property
+    def dispatch_count(self):
+        return self._dispatch_count
+    @property
+    def fanout(self):
+        return self._fanout
+    @property
+    def batch(self):
+        return self._batch
 
 class CaptureThreadError(Exception):
     cause = None
@@ -40,31 +84,64 @@ class CaptureThreadError(Exception):
         super(CaptureThreadError, self).__init__(message)
         self.cause = cause
 
-class CaptureThread(threading.Thread):
+class Capture(object):
+    """a single pcap input (interface or file) and its packet handling
+
+    This owns one pcap handle and classifies and saves every packet
+    read from it.  It does not decide when to read; that is up to the
+    caller (CaptureThread or EventLoop), which calls open(), then
+    dispatch() repeatedly, then close().
+    """
     def __init__(self, iface_or_filename, shutdown_event,
-                 dumpfiles, capture_params, status_q):
-        name = iface_or_filename or '(default)'
-        super(CaptureThread, self).__init__(name='capture.'+name)
+                 dumpfiles, capture_params, analysis=None, shedder=None,
+                 ring=None):
+        """
+        analysis, if not None, is updated with every captured packet
+        (see sketch.AnalysisOutput).  shedder, if not None, is told
+        how long each dispatch call on a live handle takes and decides
+        which outputs to shed (see shedding.LoadShedder).  ring, if
+        not None, is a ring.RingSet that packets are copied into
+        instead of being classified and saved here; dumpfiles is not
+        used then.
+        """
+        self.name = iface_or_filename or '(default)'
         self._iface = iface_or_filename
+        self._analysis = analysis
+        self._shedder = shedder
+        self._ring = ring
         self._shutdown = shutdown_event
         self._dumpfiles = dumpfiles
         self._capture_params = capture_params
-        self._status_q = status_q
-        self._log = log.getChild(name)
-        self._log.debug('created')
+        self._log = log.getChild(self.name)
         self._pcap = None
-    def run(self):
-        status = [self, None]
-        try:
-            self._run()
-        except:
-            self._log.debug('exception')
-            status[1] = sys.exc_info()
-        finally:
-            self._status_q.put(status)
-    def _run(self):
-        self._log.debug('running')
-        if os.path.isfile(self._iface):
+        # we need to know whether this is a live capture or we are
+        # reading from a file because the meaning of dispatch()'s
+        # return value differs between the two cases
+        self.live = None
+        self.nonblocking = False
+        self._next_stats = 0.0
+        # chosen in open() from the handle's linktype
+        self._decode = None
+        self._reframe = None
+        # packets of the current dispatch call and their classifier,
+        # if batch classification is enabled; see batch.py
+        self._batch = None
+        self._classifier = None
+        # input and output linktypes recorded with each packet put in
+        # the ring
+        self._linktypes = None
+        # whether IDLE_FILTER is set
+        self._idle = False
+    def open(self, nonblock=False):
+        """open the pcap handle
+
+        If nonblock is true, live handles are put in nonblocking mode
+        so that dispatch() returns immediately when no packets are
+        buffered; the caller is then expected to wait for fileno() to
+        become readable.
+        """
+        params = self._capture_params
+        if self._iface is not None and os.path.isfile(self._iface):
             self._pcap = pcap.pcap.open_offline(self._iface)
             # TODO: it is unclear what happens if self._pcap.snaplen
             # doesn't equal the output file's snaplen (which is the
@@ -73,81 +150,178 @@ class CaptureThread(threading.Thread):
             # everywhere (which makes me wonder why it exists), and
             # that it's only the per-packet snaplen that matters.
         else:
+            kwargs = {}
+            if params.buffer_size is not None:
+                kwargs['buffer_size'] = params.buffer_size
+            if params.immediate:
+                kwargs['immediate'] = True
             self._pcap = pcap.pcap.open_live(
                 self._iface,
-                snaplen=self._capture_params.snaplen,
-                to_ms=250)
+                snaplen=params.snaplen,
+                to_ms=params.timeout_ms,
+                **kwargs)
         linktype = self._pcap.datalink()
         assert linktype is not None
+        self._decode = decoder_for_linktype(linktype)
+        # packets from multiple inputs might go to the same dumpfile,
+        # and each dumpfile has a specific linktype.  the first input
+        # to open decides the output linktype (unless it is set in the
+        # config); packets from inputs with a different linktype are
+        # converted to it.
         with self._capture_params.lock:
             if self._capture_params.linktype is None:
                 self._capture_params.linktype = linktype
-            if self._capture_params.linktype != linktype:
-                raise RuntimeError('mixed link types not supported')
-        with close_when_done(self._pcap):
-            # we need to know whether this is a live capture or we are
-            # reading from a file because the meaning of dispatch()'s
-            # return value differs between the two cases
-            live = self._pcap.type == 'live'
+            out_linktype = self._capture_params.linktype
+        if out_linktype != linktype:
+            self._log.info('converting link type %i to output link type %i',
+                           linktype, out_linktype)
+            self._reframe = reframer_for_linktypes(linktype, out_linktype)
+        self._linktypes = (linktype, out_linktype)
+        if params.batch and self._ring is None:
+            if self._reframe is not None:
+                self._log.info('not classifying in batches because the'
+                               ' link type is converted')
+            elif not batch_supported(linktype):
+                self._log.info('batch classification of link type %i is'
+                               ' not supported (or numpy is missing)',
+                               linktype)
+            else:
+                self._batch = PacketBatch()
+                self._classifier = BatchClassifier(linktype)
+        self.live = self._pcap.type == 'live'
+        if self.live and params.fanout is not None:
+            group, mode = params.fanout
+            join_fanout(self._pcap.fileno(), group, mode)
+        if self.live and self._shedder is not None:
+            # a blocking dispatch call includes time spent waiting for
+            # packets, which would look like load
+            nonblock = True
+        else:
+            self._shedder = None
+        if nonblock and self.live:
+            self._pcap.setnonblock(True)
+            self.nonblocking = True
+    def close(self):
+        if self._pcap is not None:
+            self._pcap.close()
+            self._pcap = None
+    def fileno(self):
+        """selectable file descriptor of a live handle
+        """
+        return self._pcap.fileno()
+    @property
+    def timeout(self):
+        """seconds to wait for fileno() to become readable, or None
+        """
+        return self._capture_params.timeout_ms / 1000.0
+    def drops(self):
+        """number of packets dropped by the kernel so far, or None
 
-            while not self._shutdown.is_set():
-                # the documentation of pcap.pcap.dispatch() is
-                # wrong:
-                #   * return value:  it returns the number of packets
-                #     read, -1 on error, and -2 on breakloop().  if 0
-                #     and a live capture, this means that the read
-                #     timed out before any packets arrived and we
-                #     should continue trying to get packets.  if 0 and
-                #     reading from a saved file, there are no more
-                #     packets in the file and we're done.
-                #   * cnt argument:  -1 and 0 are the same, and mean
-                #     "process all packets in the buffer (live
-                #     capture) or in the file (offline)".  if cnt is
-                #     greater than the number of packets in the buffer
-                #     (live) or file (offline), it will process what
-                #     is can and return.  for -1/0 with live captures,
-                #     the function won't necessarily return until
-                #     "enough" packets have filled the buffer (it
-                #     doesn't return right away if there are no
-                #     packets in the buffer yet).
-                #
-                # use dispatch() because:
-                #   * loop() doesn't provide a way to check for
-                #     shutdown when no packets have arrived within the
-                #     timeout period (so shutdown can only be checked
-                #     once a packet arrives, which may be never)
-                #   * next() doesn't provide a way to distinguish live
-                #     capture timeout from an error, so there's no way
-                #     to know whether we should continue reading
-                #     packets or raise an exception
-                #
-                # note that pcap.pcap.dispatch() will block in a
-                # system call until the timeout (set in pcap's
-                # constructor) is reached or the buffer is full,
-                # whichever comes first.  there's no easy way to break
-                # the system call when it's time to shut down, so the
-                # timeout should be relatively short to ensure a
-                # timely shutdown.
-                n = self._pcap.dispatch(-1, self._handle_packet)
-
-                if n == 0:
-                    if live:
-                        # timeout waiting for a packet; check for
-                        # shutdown and try again
-                        continue
-                    else:
-                        # no more packets in the pcap file
-                        break
-                elif n == -1:
-                    raise IOError(self._pcap.geterr())
-                elif n == -2:
-                    # breakloop() was called and there was no
-                    # exception; must be time to shut down
-                    continue
-                else:
-                    # pcap doesn't document other negative values
-                    assert n > 0
-            self._log.debug('shutting down')
+        For live handles this is only refreshed about once a second
+        because querying it costs a system call.
+        """
+        if not self.live:
+            return None
+        now = time.time()
+        if now < self._next_stats:
+            return None
+        self._next_stats = now + 1.0
+        return self._pcap.stats()[1]
+    def wait(self):
+        """block until fileno() is readable or the timeout expires
+        """
+        try:
+            select.select([self.fileno()], [], [], self.timeout)
+        except (IOError, OSError, select.error) as e:
+            # a signal arrived; the caller will just dispatch early
+            if e.args[0] != errno.EINTR:
+                raise
+    def dispatch(self, cnt=None):
+        """process up to cnt packets and return the number processed
+
+        If cnt is None, the count comes from the 'dispatch_count'
+        capture setting.
+
+        Returns 0 if no packets were available (live capture timeout
+        or, in nonblocking mode, an empty buffer), None if a saved
+        file has no more packets, and raises IOError on error.
+        """
+        # the documentation of pcap.pcap.dispatch() is wrong:
+        #   * return value:  it returns the number of packets read, -1
+        #     on error, and -2 on breakloop().  if 0 and a live
+        #     capture, this means that the read timed out before any
+        #     packets arrived and we should continue trying to get
+        #     packets.  if 0 and reading from a saved file, there are
+        #     no more packets in the file and we're done.
+        #   * cnt argument:  -1 and 0 are the same, and mean "process
+        #     all packets in the buffer (live capture) or in the file
+        #     (offline)".  if cnt is greater than the number of
+        #     packets in the buffer (live) or file (offline), it will
+        #     process what is can and return.  for -1/0 with live
+        #     captures, the function won't necessarily return until
+        #     "enough" packets have filled the buffer (it doesn't
+        #     return right away if there are no packets in the buffer
+        #     yet).
+        #
+        # use dispatch() because:
+        #   * loop() doesn't provide a way to check for shutdown when
+        #     no packets have arrived within the timeout period (so
+        #     shutdown can only be checked once a packet arrives,
+        #     which may be never)
+        #   * next() doesn't provide a way to distinguish live capture
+        #     timeout from an error, so there's no way to know whether
+        #     we should continue reading packets or raise an exception
+        if cnt is None:
+            cnt = self._capture_params.dispatch_count
+        if self._ring is None:
+            idle = self._dumpfiles.poll_schedules()
+            # the analysis wants every packet
+            if idle != self._idle and self.live and self._analysis is None:
+                self._set_idle(idle)
+        if self._shedder is not None:
+            start = time.time()
+        if self._ring is not None:
+            n = self._pcap.dispatch(cnt, self._ring_packet)
+        elif self._batch is not None:
+            n = self._pcap.dispatch(cnt, self._batch_packet)
+            self._save_batch()
+        else:
+            n = self._pcap.dispatch(cnt, self._handle_packet)
+        if n >= 0 and self._shedder is not None:
+            now = time.time()
+            self._shedder.update(self, now - start, now, self.drops())
+
+        if n == 0:
+            if self.live:
+                # timeout waiting for a packet
+                return 0
+            # no more packets in the pcap file
+            return None
+        elif n == -1:
+            raise IOError(self._pcap.geterr())
+        elif n == -2:
+            # breakloop() was called and there was no exception; must
+            # be time to shut down
+            return 0
+        # pcap doesn't document other negative values
+        assert n > 0
+        return n
+
+    def _set_idle(self, idle):
+        """set or clear IDLE_FILTER
+
+        Packets already buffered are still delivered, and dropped by
+        their (idle) outputs.  If the pcap module can't set filters,
+        packets keep being captured and dropped.
+        """
+        self._idle = idle
+        setfilter = getattr(self._pcap, 'setfilter', None)
+        if setfilter is None:
+            self._log.debug('cannot set a filter; capturing while idle')
+            return
+        self._log.info('%s capture while no output is collecting',
+                       'pausing' if idle else 'resuming')
+        setfilter(IDLE_FILTER if idle else '')
 
     def _handle_packet(self, header, packet):
         # WARNING:  packet is a pointer to static C memory and must be
@@ -165,7 +339,7 @@ class CaptureThread(threading.Thread):
 
         try:
             assert len(packet) == header.caplen
-            service = self._extract_service(packet)
+            decoded = self._decode(packet)
         except:
             self._log.critical('failed to decode packet')
             self._log.critical('raw packet data: ' \
@@ -178,76 +352,163 @@ class CaptureThread(threading.Thread):
             self._log.critical('  caplen = ' + str(header.caplen))
             self._log.critical('  len = ' + str(header.len))
             raise
+        if self._shedder is not None and self._shedder.shed_below is not None:
+            try:
+                dumpfile = self._dumpfiles[decoded.service]
+            except KeyError:
+                pass
+            else:
+                if dumpfile.priority < self._shedder.shed_below:
+                    dumpfile.shed(header)
+                    return
+        if self._reframe is not None:
+            reframed = self._reframe(packet, header, decoded)
+            if reframed is None:
+                self._log.debug('discarding packet: %f len=%i %s'
+                                ' (not representable in output link type)',
+                                timestamp, len(packet), decoded.service)
+                return
+            packet, header, decoded = reframed
+        service = decoded.service
+        if self._analysis is not None:
+            self._analysis.update(packet, header.len, decoded)
         try:
             dumpfile = self._dumpfiles[service]
         except KeyError:
             self._log.debug('discarding packet: %f len=%i %s',
                             timestamp, len(packet), service)
             return
-        dumpfile.save(packet, header)
-
-    def _extract_service(self, packet):
-        eth = dpkt.ethernet.Ethernet(packet)
-        ethertype = eth.type
-        if ethertype <= 1500:
-            # in this case the ethertype field is actually a length
-            # and there is no ethertype, so combine these all into the
-            # non-existant ethertype 0
-            #
-            # TODO: dpkt should really do this; fix in our dpkt and
-            # send a patch upstream
-            ethertype = 0
-        if ethertype in (0x800, 0x86dd):
-            ip = eth.data
-            if ethertype == 0x800:
-                assert isinstance(ip, dpkt.ip.IP)
-                assert (4 == ip.v)
-                # TODO: dpkt should split the .off property into
-                # offset and flags.  fix in our dpkt and send a patch
-                # upstream
-                frag_offset = ip.off & (2**13 - 1)
-                flags = ip.off >> 13
-                dont_frag = bool(flags & 2)
-                more_frag = bool(flags & 1)
-                assert (not dont_frag) or (frag_offset == 0)
-                assert (not dont_frag) or (not more_frag)
-                is_frag = more_frag or (frag_offset != 0)
-            else:
-                assert isinstance(ip, dpkt.ip6.IP6)
-                assert (6 == ip.v)
-                # note: dpkt fills the extension_hdrs dict with Nones;
-                # it should just omit an entry if the extension header
-                # isn't present.  it'd be nice if we fixed this in our
-                # dpkt and submitted a patch upstream.
-                #
-                # note: dpkt doesn't support more than one extension
-                # header of the same type, but we don't care here
-                #
-                # note: dpkt doesn't preserve the extension header
-                # order, but we don't care here
-                frag_hdr = ip.extension_hdrs.get(dpkt.ip.IP_PROTO_FRAGMENT)
-                frag_offset = 0
-                is_frag = False
-                if frag_hdr is not None:
-                    frag_offset = frag_hdr.frag_off
-                    is_frag = (frag_offset != 0) or (frag_hdr.m_flag)
-            proto = ip.p
-            if proto in (6, 17):
-                if frag_offset != 0:
-                    # TODO: dpkt doesn't bother checking the fragment
-                    # offset before attempting to decode the payload,
-                    # resulting in garbage values for large enough
-                    # fragments.  fix in our dpkt and send a patch
-                    # upstream
-                    port = -1
-                else:
-                    t = ip.data
-                    if not isinstance(t, dpkt.tcp.TCP) \
-                       and not isinstance(t, dpkt.udp.UDP):
-                        assert is_frag
-                        port = -1
-                    else:
-                        port = t.sport if t.sport < t.dport else t.dport
-                return (ethertype, proto, port)
-            return (ethertype, proto)
-        return (ethertype,)
+        dumpfile.save(packet, header, decoded)
+
+    def _ring_packet(self, header, packet):
+        if self._shutdown.is_set():
+            self._pcap.breakloop()
+            return
+        # this copies the packet, and the worker on the other side of
+        # the ring does the rest
+        self._ring.put(header, packet, *self._linktypes)
+
+    def _batch_packet(self, header, packet):
+        if self._shutdown.is_set():
+            self._pcap.breakloop()
+            return
+        self._batch.add(header, packet)
+
+    def _save_batch(self):
+        """classify and save the packets collected by _batch_packet()
+        """
+        batch = self._batch
+        if not batch:
+            return
+        try:
+            decoded = self._classifier.classify(batch)
+            shed_below = None
+            if self._shedder is not None:
+                shed_below = self._shedder.shed_below
+            # several services may share an output; its packets must
+            # still be written in capture order
+            outputs = {}
+            for service, indices in self._classifier.group(decoded):
+                try:
+                    dumpfile = self._dumpfiles[service]
+                except KeyError:
+                    dumpfile = None
+                    self._log.debug('discarding %i packets: %s',
+                                    len(indices), service)
+                if dumpfile is not None and shed_below is not None \
+                   and dumpfile.priority < shed_below:
+                    for i in indices:
+                        dumpfile.shed(batch.headers[i])
+                    continue
+                entry = outputs.setdefault(id(dumpfile), (dumpfile, []))
+                entry[1].append(indices)
+            for dumpfile, groups in outputs.values():
+                indices = groups[0] if len(groups) == 1 \
+                    else sorted(i for g in groups for i in g)
+                items = [(batch.packet(i), batch.headers[i], decoded[i])
+                         for i in indices]
+                if self._analysis is not None:
+                    for packet, header, d in items:
+                        self._analysis.update(packet, header.len, d)
+                if dumpfile is not None:
+                    dumpfile.save_batch(items)
+        finally:
+            batch.clear()
+
+class CaptureThread(threading.Thread):
+    def __init__(self, iface_or_filename, shutdown_event,
+                 dumpfiles, capture_params, status_q, analysis=None,
+                 shedder=None, ring=None):
+        name = iface_or_filename or '(default)'
+        super(CaptureThread, self).__init__(name='capture.'+name)
+        self._capture = Capture(iface_or_filename, shutdown_event,
+                                dumpfiles, capture_params, analysis,
+                                shedder, ring)
+        self._shutdown = shutdown_event
+        self._status_q = status_q
+        self._log = log.getChild(name)
+        self._log.debug('created')
+    def run(self):
+        status = [self, None]
+        try:
+            self._run()
+        except:
+            self._log.debug('exception')
+            status[1] = sys.exc_info()
+        finally:
+            self._status_q.put(status)
+    def _run(self):
+        self._log.debug('running')
+        self._capture.open()
+        with close_when_done(self._capture):
+            while not self._shutdown.is_set():
+                if self._capture.nonblocking:
+                    self._capture.wait()
+                # note that dispatch() will block in a system call
+                # until the timeout (set when the handle was opened)
+                # is reached or the buffer is full, whichever comes
+                # first.  there's no easy way to break the system call
+                # when it's time to shut down, so the timeout should
+                # be relatively short to ensure a timely shutdown.
+                # (the 'select' engine in eventloop.py doesn't have
+                # this problem.)
+                if self._capture.dispatch() is None:
+                    break
+            self._log.debug('shutting down')
+
+class Tests(unittest.TestCase):
+    class FakePcap(object):
+        def __init__(self):
+            self.filters = []
+        def setfilter(self, expression):
+            self.filters.append(expression)
+        def dispatch(self, cnt, callback):
+            return 0
+
+    class FakeDumpfiles(object):
+        def __init__(self, states):
+            self.states = list(states)
+        def poll_schedules(self):
+            return self.states.pop(0)
+
+    def _capture(self, states, analysis=None):
+        capture = Capture('eth0', threading.Event(),
+                          self.FakeDumpfiles(states),
+                          CaptureParams(linktype=1, snaplen=65535),
+                          analysis=analysis)
+        capture._pcap = self.FakePcap()
+        capture.live = True
+        return capture
+
+    def test_idle_filter(self):
+        capture = self._capture([False, True, True, False])
+        for i in range(4):
+            self.assertEqual(capture.dispatch(), 0)
+        self.assertEqual(capture._pcap.filters, [IDLE_FILTER, ''])
+
+    def test_idle_filter_analysis(self):
+        # the analysis wants every packet, so capture never pauses
+        capture = self._capture([True, False], analysis=object())
+        for i in range(2):
+            capture.dispatch()
+        self.assertEqual(capture._pcap.filters, [])
@@ -0,0 +1,131 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+from .capture import CaptureParams
+from .decode import Header
+from .dumpfiles import Dumpfile, PcapReader
+from .stats import Stats
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+class Checkpointer(object):
+    """periodically save collection state so a run can be resumed
+
+    The state file is a JSON object holding the Stats snapshot and
+    the per-output state returned by Dumpfiles.checkpoint() (file
+    length, packet and byte counts, whether the quota is met).  It is
+    replaced atomically, so a crash leaves either the old or the new
+    state behind.  See load_checkpoint().
+    """
+    def __init__(self, filename, stats, dumpfiles, interval=60.0):
+        self._filename = filename
+        self._stats = stats
+        self._dumpfiles = dumpfiles
+        self._interval = interval
+        self._next = time.time() + interval
+
+    def save_if_due(self, now=None):
+        if now is None:
+            now = time.time()
+        if now >= self._next:
+            self.save()
+
+    def save(self):
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'time': time.time(),
+            # outputs first so that every packet counted in an output
+            # is also in the snapshot
+            'outputs': self._dumpfiles.checkpoint(),
+        }
+        state['stats'] = self._stats.snapshot()
+        tmp = self._filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._filename)
+        self._next = time.time() + self._interval
+        log.debug('saved checkpoint to %s', self._filename)
+
+def load_checkpoint(filename):
+    """return the state saved by Checkpointer, or None if there is none
+    """
+    try:
+        f = open(filename)
+    except IOError:
+        log.warning('no checkpoint in %s; starting from scratch', filename)
+        return None
+    with f:
+        state = json.load(f)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError('%s: unsupported checkpoint version %r'
+                         % (filename, state.get('version')))
+    log.info('resuming from checkpoint saved at %s',
+             time.strftime('%Y-%m-%d %H:%M:%S',
+                           time.localtime(state['time'])))
+    return state
+
+class Tests(unittest.TestCase):
+    def test_save_load(self):
+        class FakeDumpfiles(object):
+            def checkpoint(self):
+                return {'a.pcap': {'length': 24, 'packets': 0, 'bytes': 0,
+                                   'quota_met': False}}
+        stats = Stats()
+        stats.get_child('a.pcap').got_packet(60, 0.0)
+        d = tempfile.mkdtemp()
+        filename = os.path.join(d, 'state')
+        try:
+            self.assertEqual(load_checkpoint(filename), None)
+            Checkpointer(filename, stats, FakeDumpfiles()).save()
+            state = load_checkpoint(filename)
+            self.assertEqual(state['outputs']['a.pcap']['length'], 24)
+            restored = Stats()
+            restored.set_snapshot(state['stats'])
+            self.assertEqual(restored.get_child('a.pcap').bytes, 60)
+            self.assertEqual(restored.packets, 1)
+        finally:
+            os.remove(filename)
+            os.rmdir(d)
+
+    def test_resume(self):
+        params = CaptureParams(linktype=1, snaplen=65535)
+        d = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(d, 'out.pcap')
+            stats = Stats()
+            df = Dumpfile(filename, params, stats.get_child('out'),
+                          {'type': 'native'}, {'max_packets': 5})
+            for sec in range(3):
+                df.save(b'x' * 10, Header(sec, 0, 10, 10))
+            checkpoint = df.checkpoint()
+            snapshot = stats.snapshot()
+            df.save(b'x' * 10, Header(3, 0, 10, 10))
+            df.close()
+            # a partial record left by a crash
+            with open(filename, 'ab') as f:
+                f.write(b'\x04\0\0')
+            stats = Stats()
+            stats.set_snapshot(snapshot)
+            df = Dumpfile(filename, params, stats.get_child('out'), None,
+                          {'max_packets': 5}, checkpoint)
+            self.assertEqual(stats.packets, 4)
+            for sec in range(4, 7):
+                df.save(b'y' * 10, Header(sec, 0, 10, 10))
+            self.assertTrue(df.quota_met)
+            self.assertEqual([rec[0] for rec in PcapReader(filename)],
+                             list(range(5)))
+        finally:
+            shutil.rmtree(d)
@@ -2,6 +2,12 @@
 
 from __future__ import absolute_import
 
+from .aggregator import parse_address
+from .decode import linktype_names
+from .fanout import fanout_modes
+from .novelty import NoveltyEstimator
+from .payloadfilter import PayloadFilter
+from .schedule import Schedule
 from .util import dummy_context_manager, ensure_tuple, iterable_not_string
 
 import ast
@@ -37,7 +43,7 @@ def process_config(raw_config):
     config = {}
     if raw_config is None:
         raw_config = {}
-    for keyword, obj in raw_config.iteritems():
+    for keyword, obj in raw_config.items():
         try:
             handler = config_handlers[keyword]
         except KeyError:
@@ -77,6 +83,347 @@ def config_handle_interfaces(raw):
     """
     return set(raw)
 
+capture_defaults = {
+    'linktype': None,
+    'buffer_size': None,
+    'timeout_ms': 250,
+    'immediate': False,
+    'dispatch_count': -1,
+    'batch': False,
+}
+
+@config_handler()
+def config_handle_capture(raw):
+    """libpcap capture handle settings
+
+    The 'capture' keyword is mapped to a dict with any of the
+    following keys:
+      * 'linktype':  link type of the output files, either a DLT
+        number or one of the names in decode.linktype_names (e.g.,
+        'ethernet', 'linux_sll', 'raw').  Packets from inputs with a
+        different link type are converted, which discards their
+        link-layer addresses.  Default: the link type of the first
+        input opened.
+      * 'buffer_size':  size of the kernel capture buffer in bytes.
+        The libpcap default (typically 2 MiB) overflows quickly during
+        bursts while the packet callback is busy, so busy links
+        benefit from something much larger.  Default: libpcap's
+        default.
+      * 'timeout_ms':  libpcap read timeout in milliseconds.  With the
+        'threads' engine this also bounds how long shutdown takes.
+        Default: 250.
+      * 'immediate':  if True, packets are delivered as soon as they
+        arrive instead of being batched by the kernel until a buffer
+        block fills or the timeout expires.  Default: False.
+      * 'dispatch_count':  maximum number of packets processed per
+        dispatch call, or -1 for everything buffered.  Default: -1.
+      * 'batch':  if True, the packets of each dispatch call are
+        copied into one buffer and classified together with NumPy
+        instead of one callback at a time, and each output receives
+        its share in a single write (see batch.py).  Only Ethernet
+        and Linux cooked captures are batched; other link types,
+        inputs whose link type is converted and hosts without numpy
+        fall back to per-packet classification.  Default: False.
+
+    Settings that are not specified are left out of the returned dict
+    (see capture_defaults for their defaults).
+    """
+    unknown = set(raw) - set(capture_defaults)
+    if unknown:
+        raise ValueError('unknown capture settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = dict(raw)
+    if ret.get('linktype') is not None:
+        ret['linktype'] = linktype_names.get(ret['linktype'],
+                                             ret['linktype'])
+        ret['linktype'] = int(ret['linktype'])
+    if ret.get('buffer_size') is not None:
+        ret['buffer_size'] = int(ret['buffer_size'])
+    if 'timeout_ms' in ret:
+        ret['timeout_ms'] = int(ret['timeout_ms'])
+    if 'dispatch_count' in ret:
+        ret['dispatch_count'] = int(ret['dispatch_count'])
+    for k in ('immediate', 'batch'):
+        if k in ret:
+            ret[k] = bool(ret[k])
+    return ret
+
+writer_defaults = {
+    'type': 'libpcap',
+    'block_size': 1 << 20,
+    'flush_interval': 5.0,
+    'durability': 'none',
+    'fsync_interval': 60.0,
+    'fadvise': False,
+    'preallocate': 0,
+    'segment_size': 1 << 28,
+}
+
+@config_handler()
+def config_handle_writer(raw):
+    """how packets are written to the output pcap files
+
+    The 'writer' keyword is mapped to a dict with any of the following
+    keys:
+      * 'type':  'libpcap' (the default) to write with libpcap's
+        pcap_dump(), 'native' to use the coalescing writer in
+        dumpfiles.PcapWriter, or 'records' to write only the L4
+        payloads, service descriptions and timestamps to payload
+        record segment files (see records.py).  The remaining keys
+        only apply to the native and records writers.
+      * 'block_size':  number of bytes buffered per output before they
+        are written with writev() (one call per IOV_MAX 64 KiB
+        chunks).  Default: 1 MiB.
+      * 'flush_interval':  maximum number of seconds data may stay
+        buffered, so that low-rate outputs still reach the disk.
+        Default: 5.
+      * 'durability':  'none' (the default) to leave syncing to the
+        operating system, 'periodic' to fsync() at most every
+        'fsync_interval' seconds (default 60) and on close, or 'close'
+        to fsync() only on close.
+      * 'fadvise':  if True, give the kernel sequential-write and
+        don't-cache hints.  Default: False.
+      * 'preallocate':  if nonzero, reserve disk space this many bytes
+        at a time.  Default: 0.
+      * 'segment_size':  the records writer starts a new segment file
+        once the current one reaches this many bytes.  Default: 256
+        MiB; at most 4 GiB.
+
+    With the records writer, each output filename is the prefix of
+    its segment files, which are numbered from .000000.
+
+    writev(), 'fadvise' and 'preallocate' need Python 3.3 or later;
+    on Python 2 the buffered data is joined and written with write()
+    and the two hints are skipped.
+    """
+    unknown = set(raw) - set(writer_defaults)
+    if unknown:
+        raise ValueError('unknown writer settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = dict(writer_defaults)
+    ret.update(raw)
+    if ret['type'] not in ('libpcap', 'native', 'records'):
+        raise ValueError('unknown writer type: ' + repr(ret['type']))
+    if ret['durability'] not in ('none', 'periodic', 'close'):
+        raise ValueError('unknown durability policy: '
+                         + repr(ret['durability']))
+    if ret['type'] == 'libpcap':
+        return {'type': 'libpcap'}
+    for k in ('block_size', 'preallocate', 'segment_size'):
+        ret[k] = int(ret[k])
+    if ret['block_size'] < 1:
+        raise ValueError('writer block_size must be positive')
+    if ret['preallocate'] < 0:
+        raise ValueError('writer preallocate must not be negative')
+    if ret['type'] == 'native':
+        del ret['segment_size']
+    for k in ('flush_interval', 'fsync_interval'):
+        ret[k] = float(ret[k])
+    ret['fadvise'] = bool(ret['fadvise'])
+    return ret
+
+@config_handler()
+def config_handle_fanout(raw):
+    """spread each live interface across several worker processes
+
+    The 'fanout' keyword is mapped to a dict with the following keys:
+      * 'workers':  number of worker processes (required).  Each
+        worker opens its own capture handle on every interface and
+        the kernel distributes packets among them with Linux
+        PACKET_FANOUT, so one busy interface isn't limited to what a
+        single Python process can decode and write.
+      * 'mode':  'hash' (the default) to keep each flow on one worker,
+        'lb' for round-robin, or 'cpu' to follow the receiving CPU.
+        'lb' splits flows, so outputs can't use 'reassemble' with it.
+      * 'group':  fanout group id; must be unique per interface among
+        running collectors.  Default: derived from the process id.
+      * 'merge':  each worker writes its own partition of every output
+        (the output filename plus '.part<N>').  If True (the
+        default), the partitions are merged in timestamp order into
+        the output file after capture stops, and their '.windows'
+        files (see 'output_options') into the output's.
+
+    The 'max_packets' and 'max_bytes' quotas of 'output_options'
+    apply to the sum over all workers:  the workers report their
+    counts about once a second, and once an output's total meets its
+    quota every worker closes its partition, so the output can
+    overshoot by a second or two of its traffic.  'novelty' is
+    judged by each worker on its own share of the packets.
+
+    Only live interfaces are supported, the 'engine' setting is
+    ignored (each worker uses the 'threads' engine), and the config
+    isn't reloaded:  a SIGHUP is logged and otherwise ignored.
+    """
+    unknown = set(raw) - set(('workers', 'mode', 'group', 'merge'))
+    if unknown:
+        raise ValueError('unknown fanout settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = dict(raw)
+    ret['workers'] = int(ret['workers'])
+    if ret['workers'] < 1:
+        raise ValueError('fanout workers must be at least 1')
+    if ret.setdefault('mode', 'hash') not in fanout_modes:
+        raise ValueError('unknown fanout mode: ' + repr(ret['mode']))
+    if 'group' in ret:
+        ret['group'] = int(ret['group'])
+    ret['merge'] = bool(ret.get('merge', True))
+    return ret
+
+@config_handler()
+def config_handle_ring(raw):
+    """decouple capture from processing with shared-memory rings
+
+    The 'ring' keyword is mapped to a dict (which may be empty) with
+    the following keys:
+      * 'workers':  number of worker processes, each draining its own
+        ring (default 2)
+      * 'size':  bytes of packet data each ring can hold (default
+        64 MiB).  Packets arriving while a ring is full are dropped
+        and counted in the 'ring_overruns' counter.
+      * 'directory':  where the ring files are created (default
+        /dev/shm if it exists, else the temporary directory)
+      * 'merge':  as for 'fanout':  each worker writes its own
+        partition of every output, and if True (the default) the
+        partitions are merged in timestamp order after capture stops
+
+    The capture threads only copy packets into the rings (round-robin)
+    so that bursts are absorbed by memory instead of by the kernel
+    buffer; the workers classify and write them.  The
+    'ring_occupancy' and 'ring_high_water' counters in the logged
+    stats give the bytes held in the rings now and at most so far.
+    Since consecutive packets go to different workers, each worker
+    sees a share of every output:  quotas apply to the sum over all
+    workers as for 'fanout' (and may overshoot by a second or two of
+    traffic), while 'novelty' is judged by each worker on its own
+    share.  Outputs can't use 'reassemble', since no worker would see
+    all the segments of a flow.  See ring.py.  Not supported together
+    with 'fanout'; the 'engine' setting is ignored and the config
+    isn't reloaded (a SIGHUP is logged and otherwise ignored).
+    """
+    unknown = set(raw) - set(('workers', 'size', 'directory', 'merge'))
+    if unknown:
+        raise ValueError('unknown ring settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = {
+        'workers': int(raw.get('workers', 2)),
+        'size': int(raw.get('size', 64 << 20)),
+        'merge': bool(raw.get('merge', True)),
+    }
+    if ret['workers'] < 1:
+        raise ValueError('ring workers must be at least 1')
+    if ret['size'] < 1 << 17:
+        # must hold at least a couple of maximum-size packets
+        raise ValueError('ring size must be at least 128 KiB')
+    if raw.get('directory') is not None:
+        ret['directory'] = raw['directory']
+    return ret
+
+@config_handler()
+def config_handle_analysis(raw):
+    """traffic rate analysis of all captured packets
+
+    The 'analysis' keyword is mapped to a dict with the following
+    keys:
+      * 'filename':  where the analysis is saved (required).  The file
+        is rewritten every 'interval' seconds (default 60) and when
+        capture stops.
+      * 'width', 'depth':  dimensions of the count-min sketches that
+        count packets and bytes per service (default 2048 and 4).
+      * 'top_k':  number of services tracked by packets and by bytes
+        (default 100).  Distinct source and destination addresses are
+        estimated for each tracked service.
+      * 'hll_precision':  each distinct-address estimate uses
+        2**hll_precision bytes (default 10, about 3% error).
+      * 'merge_existing':  if True and the file already exists, the
+        previous analysis is merged into this one (default False).
+
+    Every captured packet is counted, whether or not it matches an
+    output, and memory use is fixed regardless of how many services
+    appear.  Analysis files with the same dimensions from several runs
+    or collectors can be combined with --merge-sketches.  Not
+    supported with 'fanout'.
+    """
+    known = ('filename', 'interval', 'merge_existing', 'width', 'depth',
+             'top_k', 'hll_precision')
+    unknown = set(raw) - set(known)
+    if unknown:
+        raise ValueError('unknown analysis settings: '
+                         + ', '.join(sorted(unknown)))
+    if 'filename' not in raw:
+        raise ValueError('analysis requires a filename')
+    ret = dict(raw)
+    for k in ('width', 'depth', 'top_k', 'hll_precision'):
+        if k in ret:
+            ret[k] = int(ret[k])
+    if 'interval' in ret:
+        ret['interval'] = float(ret['interval'])
+    return ret
+
+rates_defaults = {
+    'buckets': [[1, 3600], [60, 1440], [3600, 168]],
+}
+
+@config_handler()
+def config_handle_rates(raw):
+    """record packet and byte rates over time
+
+    The 'rates' keyword is mapped to a dict with the following keys:
+      * 'buckets':  a list of [interval, length] pairs.  For each
+        pair, the packets and bytes of each output (and of the
+        discarded packets and the total) are counted in buckets of
+        'interval' seconds, and the most recent 'length' buckets are
+        kept.  The default, [[1, 3600], [60, 1440], [3600, 168]],
+        keeps an hour of per-second counts, a day of per-minute counts
+        and a week of per-hour counts in about 83 KB per output.
+      * 'filename':  if set, the buckets are written to this file when
+        capture stops.
+      * 'format':  'csv' or 'binary' (see stats.read_rates()).  The
+        default is 'csv' if the filename ends in '.csv', otherwise
+        'binary'.
+
+    Packets are placed in buckets by their capture timestamp.  The
+    minimum, mean, maximum and percentile rates of the total are
+    logged when capture stops.  Not supported with 'fanout'.
+    """
+    known = ('buckets', 'filename', 'format')
+    unknown = set(raw) - set(known)
+    if unknown:
+        raise ValueError('unknown rates settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = dict(rates_defaults)
+    ret.update(raw)
+    buckets = []
+    for interval, length in ret['buckets']:
+        if float(interval) <= 0 or int(length) < 1:
+            raise ValueError('invalid rates bucket: %r'
+                             % ([interval, length],))
+        buckets.append((float(interval), int(length)))
+    ret['buckets'] = buckets
+    if 'filename' in ret:
+        ret.setdefault('format', 'csv' if ret['filename'].endswith('.csv')
+                       else 'binary')
+    if ret.get('format', 'csv') not in ('csv', 'binary'):
+        raise ValueError('unknown rates format: ' + repr(ret['format']))
+    return ret
+
+@config_handler()
+def config_handle_engine(raw):
+    """select how the inputs are read
+
+    The 'engine' keyword is mapped to one of the following strings:
+      * 'threads' (the default):  a separate capture thread is
+        created for each input.  Each thread blocks in libpcap for up
+        to the read timeout, so shutdown can take that long.
+      * 'select':  all inputs are read from the main thread.  Live
+        handles are put in nonblocking mode and multiplexed with
+        epoll (or select() if epoll is unavailable), and packets are
+        dispatched in batches from whichever handles are ready.
+        Shutdown takes effect immediately.
+    """
+    if raw not in ('threads', 'select'):
+        raise ValueError('unknown engine: ' + repr(raw))
+    return raw
+
 @config_handler()
 def config_handle_outputs(raw):
     """construct a nested dict matching packet properties to output filename
@@ -253,6 +600,371 @@ def config_handle_outputs(raw):
     log.debug('outputs = %s', repr(outputs))
     return outputs
 
+@config_handler()
+def config_handle_output_options(raw):
+    """per-output settings
+
+    The 'output_options' keyword is mapped to an iterable of (filename
+    pattern, options) tuples.  The filename pattern must be written
+    exactly as in 'outputs'; the options apply to every output file
+    generated from that pattern.  options is a dict with the following
+    keys:
+      * 'max_packets':  stop saving to an output file once this many
+        packets have been saved to it
+      * 'max_bytes':  stop saving to an output file once this many
+        bytes (original packet lengths, as in the logged stats) have
+        been saved to it
+      * 'priority':  an integer (default 0); when the collector is
+        overloaded, outputs with lower priorities are shed first
+        (see the 'shedding' keyword)
+      * 'payload_filter':  a dict of payloadfilter.PayloadFilter
+        settings (which may be empty) to keep encrypted payloads out
+        of the output.  Packets whose payload starts with a TLS
+        application data record ('tls', default True), or whose
+        first 'prefix' payload bytes (default 256) have a byte
+        entropy above 'max_entropy' bits per byte (default 6.5), are
+        dropped ('action': 'drop', the default) or cut to their first
+        'keep' payload bytes ('action': 'truncate').  Payloads shorter
+        than 'min_length' bytes (default 32) are always kept.  The
+        'payload_accepted', 'payload_skipped' and 'payload_truncated'
+        counters of each output record the outcome.
+      * 'reassemble':  True, or a dict with a 'depth' key, to save
+        reassembled TCP stream chunks instead of the raw segments
+        (see the 'reassembly' keyword).  'depth' overrides the
+        per-flow depth for this output.
+      * 'novelty':  a dict of novelty.NoveltyEstimator settings
+        (which may be empty) to stop saving to an output file once
+        its payloads stop adding new n-grams.  One in 'every' payloads
+        (default 4) is examined:  one in 'sample' (default 16) of its
+        'n'-byte n-grams (default 4) is looked up in a Bloom filter
+        of 'bits' bits (default 8 Mi) with 'hashes' hash functions
+        (default 3).  Every 'window' sampled n-grams (default 10000)
+        the fraction that was new is measured; once 'windows'
+        (default 3) consecutive measurements are below 'threshold'
+        (default 0.01), the output is closed as if its quota had
+        been met, its 'saturated' counter is set and the novelty of
+        each window is logged.
+      * 'schedule':  a dict of schedule.Schedule settings saying when
+        the output collects.  'windows' is a list of (start, end)
+        times of day such as ('08:00', '08:30') or ('23:00',
+        '01:00'), in local time unless 'utc' is True; 'period' and
+        'duration' (seconds) collect for the first 'duration' seconds
+        of every 'period', counted from 'offset' seconds after the
+        epoch (default 0).  With both, the duty cycle only runs
+        inside the windows.  Outside its schedule the output's
+        packets are dropped and its file is left open but idle; the
+        start and end of each window it was collecting in are
+        appended to a '.windows' file next to it.  While no output
+        is in its schedule (and every output has one), live inputs
+        get a filter that matches nothing, so idle periods cost
+        almost nothing.
+
+    Once a quota is met the output file is closed and its packets are
+    dropped.  Quotas carry over when a run is resumed from a
+    checkpoint (see the 'checkpoint' keyword).
+    """
+    known = ('max_packets', 'max_bytes', 'priority', 'payload_filter',
+             'reassemble', 'novelty', 'schedule')
+    ret = {}
+    for filename_pattern, options in raw:
+        unknown = set(options) - set(known)
+        if unknown:
+            raise ValueError('unknown output options for %s: %s'
+                             % (filename_pattern, ', '.join(sorted(unknown))))
+        options = dict(options)
+        for k in ('max_packets', 'max_bytes', 'priority'):
+            if k in options:
+                options[k] = int(options[k])
+        if 'payload_filter' in options:
+            options['payload_filter'] = dict(options['payload_filter'])
+            try:
+                PayloadFilter(**options['payload_filter'])
+            except TypeError as e:
+                raise ValueError('bad payload_filter for %s: %s'
+                                 % (filename_pattern, e))
+        if 'novelty' in options:
+            options['novelty'] = dict(options['novelty'])
+            try:
+                NoveltyEstimator(**options['novelty'])
+            except (TypeError, ValueError) as e:
+                raise ValueError('bad novelty settings for %s: %s'
+                                 % (filename_pattern, e))
+        if 'schedule' in options:
+            options['schedule'] = dict(options['schedule'])
+            try:
+                Schedule(**options['schedule'])
+            except (TypeError, ValueError) as e:
+                raise ValueError('bad schedule for %s: %s'
+                                 % (filename_pattern, e))
+        if 'reassemble' in options:
+            reassemble = options.pop('reassemble')
+            if isinstance(reassemble, dict):
+                unknown = set(reassemble) - set(('depth',))
+                if unknown:
+                    raise ValueError('unknown reassemble settings for %s: %s'
+                                     % (filename_pattern,
+                                        ', '.join(sorted(unknown))))
+                options['reassemble'] = dict(
+                    (k, int(v)) for k, v in reassemble.items())
+            elif reassemble:
+                options['reassemble'] = {}
+        ret[filename_pattern] = options
+    return ret
+
+@config_handler()
+def config_handle_shedding(raw):
+    """shed low-priority outputs when capture falls behind
+
+    The 'shedding' keyword is mapped to a dict (which may be empty)
+    with the following keys:
+      * 'busy_high':  a capture handle is overloaded if it spends at
+        least this fraction of the time processing packets (default
+        0.9), or if the kernel drops packets
+      * 'busy_low':  shedding is relaxed when a handle is below this
+        fraction (default 0.5) and nothing has been overloaded for
+        'hold' seconds
+      * 'window':  seconds over which the load is measured, and the
+        minimum time between raising the shedding level (default 1)
+      * 'hold':  seconds without overload before the shedding level
+        is lowered, and between lowering it (default 10)
+
+    Each time the level rises, outputs with the next lowest distinct
+    priority (see 'output_options') are shed, so that classification
+    and writing time goes to the more valuable outputs before the
+    kernel drops packets indiscriminately.  Outputs with the highest
+    priority are never shed.  Shed packets are counted in each
+    output's 'shed' and 'shed_bytes' counters so that the collected
+    rates can be corrected.  Only live inputs are monitored, and they
+    are read in nonblocking mode.  Not supported with 'fanout'.
+    """
+    known = ('busy_high', 'busy_low', 'window', 'hold')
+    unknown = set(raw) - set(known)
+    if unknown:
+        raise ValueError('unknown shedding settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = dict((k, float(v)) for k, v in raw.items())
+    if not 0 < ret.get('busy_low', 0.5) < ret.get('busy_high', 0.9):
+        raise ValueError('shedding requires 0 < busy_low < busy_high')
+    return ret
+
+@config_handler()
+def config_handle_checkpoint(raw):
+    """periodically save state so that a run can be resumed
+
+    The 'checkpoint' keyword is mapped to a dict with the following
+    keys:
+      * 'filename':  the state file (required)
+      * 'interval':  seconds between checkpoints (default 60).  A
+        checkpoint is also saved when capture stops.
+
+    The state file records the stats and, for each output, the file
+    length, the packets and bytes saved and whether its quota was met.
+    When started with --resume, the state is restored and existing
+    output files are appended to instead of overwritten:  any partial
+    record left at the end of a file by a crash is truncated, and the
+    stats are corrected to match what is actually in the files.
+    Outputs written by libpcap are recounted in full and continue
+    with the 'native' writer, because libpcap can't append.  Not
+    supported with 'fanout'.
+    """
+    unknown = set(raw) - set(('filename', 'interval'))
+    if unknown:
+        raise ValueError('unknown checkpoint settings: '
+                         + ', '.join(sorted(unknown)))
+    if 'filename' not in raw:
+        raise ValueError('checkpoint requires a filename')
+    return {
+        'filename': raw['filename'],
+        'interval': float(raw.get('interval', 60.0)),
+    }
+
+@config_handler()
+def config_handle_resources(raw):
+    """periodically report resource usage
+
+    The 'resources' keyword is mapped to a dict (which may be empty)
+    with the following keys:
+      * 'interval':  seconds between reports (default 60)
+      * 'filename':  if given, each report is also saved to this file
+        as JSON, together with a stats snapshot and the most recent
+        allocation trace
+      * 'tracemalloc':  if a positive number, allocations are traced
+        with tracemalloc keeping that many stack frames (default 0,
+        meaning off; needs Python 3.4 or later).  Tracing slows
+        capture down noticeably.
+      * 'top':  number of allocation sites in a trace (default 10)
+
+    Each report gives the resident set size, the number of open file
+    descriptors, cached service lookups, outputs (open and total),
+    stats nodes, threads and the garbage collector's generation
+    counts.  When allocations are traced, SIGUSR1 logs the allocation
+    sites that grew the most since the previous SIGUSR1 (or since
+    startup) and triggers a report.  See resources.py.
+    """
+    unknown = set(raw) - set(('interval', 'filename', 'tracemalloc', 'top'))
+    if unknown:
+        raise ValueError('unknown resources settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = {
+        'interval': float(raw.get('interval', 60.0)),
+        'tracemalloc': int(raw.get('tracemalloc', 0)),
+        'top': int(raw.get('top', 10)),
+    }
+    if raw.get('filename') is not None:
+        ret['filename'] = raw['filename']
+    return ret
+
+@config_handler()
+def config_handle_aggregator(raw):
+    """report stats to a fleet aggregator
+
+    The 'aggregator' keyword is mapped to a dict with the following
+    keys:
+      * 'address':  'host:port' of the aggregator (required)
+      * 'sensor':  name of this collector in the aggregator's log
+        (default: the host name)
+      * 'interval':  seconds between reports (default 5)
+
+    Every report holds the change in the stats since the previous
+    one.  When the aggregator says an output's fleet-wide quota has
+    been met (see the 'aggregate' keyword), the output is closed as
+    if its own quota had been met.  Not supported with 'fanout'.
+    """
+    unknown = set(raw) - set(('address', 'sensor', 'interval'))
+    if unknown:
+        raise ValueError('unknown aggregator settings: '
+                         + ', '.join(sorted(unknown)))
+    if 'address' not in raw:
+        raise ValueError('aggregator requires an address')
+    ret = {
+        'address': parse_address(raw['address']),
+        'interval': float(raw.get('interval', 5.0)),
+    }
+    if raw.get('sensor') is not None:
+        ret['sensor'] = str(raw['sensor'])
+    return ret
+
+@config_handler()
+def config_handle_aggregate(raw):
+    """settings of the fleet aggregator started with --aggregate
+
+    The 'aggregate' keyword is mapped to a dict with the following
+    keys:
+      * 'listen':  'host:port' to accept sensor connections on
+        (required)
+      * 'quotas':  an iterable of (glob, quota) tuples.  Each output
+        filename (as in the stats) matching the glob (see the fnmatch
+        module) is limited to the quota, a dict with 'max_packets'
+        and/or 'max_bytes', summed over all sensors.  Default: no
+        quotas.
+      * 'interval':  seconds between logging the fleet stats
+        (default 60)
+
+    If the config also has 'rates', the aggregator keeps fleet rate
+    series as configured there.  See aggregator.py.
+    """
+    unknown = set(raw) - set(('listen', 'quotas', 'interval'))
+    if unknown:
+        raise ValueError('unknown aggregate settings: '
+                         + ', '.join(sorted(unknown)))
+    if 'listen' not in raw:
+        raise ValueError('aggregate requires a listen address')
+    quotas = []
+    for glob, quota in raw.get('quotas', ()):
+        unknown = set(quota) - set(('max_packets', 'max_bytes'))
+        if unknown:
+            raise ValueError('unknown quota settings for %s: %s'
+                             % (glob, ', '.join(sorted(unknown))))
+        quotas.append((glob, dict((k, int(v)) for k, v in quota.items())))
+    return {
+        'listen': parse_address(raw['listen']),
+        'quotas': quotas,
+        'interval': float(raw.get('interval', 60.0)),
+    }
+
+@config_handler()
+def config_handle_reassembly(raw):
+    """limits of TCP stream reassembly
+
+    Outputs with the 'reassemble' option (see 'output_options') get
+    the in-order payload bytes of each TCP flow direction, without
+    retransmissions, as stream chunks instead of the raw segments, so
+    that n-grams spanning segment boundaries are seen.  The
+    'reassembly' keyword is mapped to a dict (which may be empty)
+    with the following keys:
+      * 'memory':  bytes of buffered payload, over all flows, before
+        the least recently active flows are evicted (default 64 MiB)
+      * 'depth':  payload bytes kept from the start of each flow
+        direction (default 1 MiB)
+      * 'chunk':  a flow's buffered bytes are saved as one chunk once
+        there are this many (default 16384), when the flow ends, when
+        it is evicted and after 'idle' seconds without a segment
+      * 'idle':  see 'chunk' (default 30)
+
+    A chunk is saved as a packet with the headers of the segment it
+    starts in and that segment's timestamp; the IP length is adjusted
+    but the checksums are not.  Each output counts the
+    'retransmitted_bytes' dropped, 'gap_bytes' lost to missing
+    segments, 'depth_skipped_bytes' beyond the depth and
+    'evicted_flows'.  Buffered chunks are not part of checkpoints.
+    See reassembly.py.
+    """
+    known = ('memory', 'depth', 'chunk', 'idle')
+    unknown = set(raw) - set(known)
+    if unknown:
+        raise ValueError('unknown reassembly settings: '
+                         + ', '.join(sorted(unknown)))
+    ret = {}
+    for k in ('memory', 'depth', 'chunk'):
+        if k in raw:
+            ret[k] = int(raw[k])
+            if ret[k] <= 0:
+                raise ValueError('reassembly %s must be positive' % k)
+    if 'idle' in raw:
+        ret['idle'] = float(raw['idle'])
+    return ret
+
+@config_handler()
+def config_handle_anonymize(raw):
+    """rewrite addresses before packets are saved
+
+    The 'anonymize' keyword is mapped to a dict with the following
+    keys:
+      * 'key':  the secret key, a string
+      * 'key_file':  a file holding the secret key, instead of 'key'
+      * 'mac':  if False, Ethernet addresses are left alone (default
+        True)
+      * 'cache_size':  entries in each of the address and prefix
+        caches (default 1048576)
+
+    The IPv4 and IPv6 addresses (and, unless 'mac' is False, Ethernet
+    addresses) of every saved packet are replaced using a keyed
+    prefix-preserving mapping, and the IP, TCP and UDP checksums are
+    updated to match.  The same key gives the same mapping, so
+    collections from several sensors or runs can be correlated;
+    anyone with the key can undo the mapping.  Addresses in payloads
+    are not rewritten.  Changes are not picked up by a SIGHUP reload.
+    See anonymize.py.
+    """
+    unknown = set(raw) - set(('key', 'key_file', 'mac', 'cache_size'))
+    if unknown:
+        raise ValueError('unknown anonymize settings: '
+                         + ', '.join(sorted(unknown)))
+    if ('key' in raw) == ('key_file' in raw):
+        raise ValueError('anonymize requires either key or key_file')
+    if 'key_file' in raw:
+        with open(raw['key_file'], 'rb') as f:
+            key = f.read()
+    else:
+        key = raw['key'].encode('utf-8')
+    if not key:
+        raise ValueError('anonymize key is empty')
+    return {
+        'key': key,
+        'mac': bool(raw.get('mac', True)),
+        'cache_size': int(raw.get('cache_size', 1 << 20)),
+    }
+
 def handle_protomatch(outputs, filename_pattern, protomatch):
     protomatch = list(protomatch)
     if len(protomatch):
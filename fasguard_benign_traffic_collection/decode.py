@@ -0,0 +1,321 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""link-type specific packet decoders
+
+Each decoder takes the raw captured bytes of one packet and returns a
+Decoded tuple holding the packet's service description tuple (see
+README.txt) and the offsets of its L3 header, L4 header and L4
+payload.  Offsets that don't apply (or couldn't be determined) are
+None.
+
+The decoder for a capture handle is chosen once, when the handle is
+opened, with decoder_for_linktype().  The decoders only look at the
+few header fields needed for classification, using precompiled
+struct unpackers, instead of building a full dpkt object tree for
+every packet.  802.1Q/802.1ad/QinQ VLAN tags and MPLS label stacks
+are skipped so that tagged traffic is classified by what it carries.
+
+Packets from inputs with different link types can be written to the
+same output file by converting them to the output's link type with a
+reframer (see reframer_for_linktypes()).
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import struct
+import unittest
+
+log = logging.getLogger(__name__)
+
+# DLT_* values as returned by pcap_datalink()
+DLT_NULL = 0
+DLT_EN10MB = 1
+DLT_RAW = 12
+DLT_LINKTYPE_RAW = 101  # some libpcap builds don't map this to DLT_RAW
+DLT_LOOP = 108
+DLT_LINUX_SLL = 113
+DLT_IPV4 = 228
+DLT_IPV6 = 229
+DLT_LINUX_SLL2 = 276
+
+linktype_names = {
+    'null': DLT_NULL,
+    'en10mb': DLT_EN10MB,
+    'ethernet': DLT_EN10MB,
+    'raw': DLT_RAW,
+    'loop': DLT_LOOP,
+    'linux_sll': DLT_LINUX_SLL,
+    'ipv4': DLT_IPV4,
+    'ipv6': DLT_IPV6,
+    'linux_sll2': DLT_LINUX_SLL2,
+}
+
+ETHERTYPE_IPV4 = 0x800
+ETHERTYPE_IPV6 = 0x86dd
+vlan_ethertypes = frozenset((0x8100, 0x88a8, 0x9100))
+mpls_ethertypes = frozenset((0x8847, 0x8848))
+# extension headers that may precede the upper-layer header in IPv6
+ipv6_ext_hdrs = frozenset((0, 43, 44, 51, 60))
+
+Decoded = collections.namedtuple('Decoded', 'service l3 l4 payload')
+
+_u8 = struct.Struct('!B').unpack_from
+_u16 = struct.Struct('!H').unpack_from
+_u32 = struct.Struct('!I').unpack_from
+_u16_pair = struct.Struct('!HH').unpack_from
+_ipv4_hdr = struct.Struct('!B5xHxB').unpack_from
+_ipv6_ext = struct.Struct('!BB').unpack_from
+
+def _strip_tags(packet, ethertype, off):
+    """skip VLAN tags and MPLS labels starting at off
+
+    Returns (ethertype, offset of the encapsulated header).  The
+    label stack of an MPLS packet doesn't say what it carries, so the
+    IP version nibble of the payload is used to guess.
+    """
+    while ethertype in vlan_ethertypes:
+        ethertype, = _u16(packet, off + 2)
+        off += 4
+    if ethertype in mpls_ethertypes:
+        while True:
+            label, = _u32(packet, off)
+            off += 4
+            if label & 0x100:
+                # bottom of stack
+                break
+        version = _u8(packet, off)[0] >> 4
+        if version == 4:
+            ethertype = ETHERTYPE_IPV4
+        elif version == 6:
+            ethertype = ETHERTYPE_IPV6
+    return ethertype, off
+
+def decode_l3(packet, ethertype, l3):
+    """classify a packet given its ethertype and L3 header offset
+    """
+    if ethertype == ETHERTYPE_IPV4:
+        vhl, frag, proto = _ipv4_hdr(packet, l3)
+        l4 = l3 + (vhl & 0xf) * 4
+        frag_offset = frag & 0x1fff
+    elif ethertype == ETHERTYPE_IPV6:
+        proto = _u8(packet, l3 + 6)[0]
+        l4 = l3 + 40
+        frag_offset = 0
+        while proto in ipv6_ext_hdrs:
+            nxt, hlen = _ipv6_ext(packet, l4)
+            if proto == 44:
+                frag_offset = _u16(packet, l4 + 2)[0] >> 3
+                hlen = 8
+            elif proto == 51:
+                hlen = (hlen + 2) * 4
+            else:
+                hlen = (hlen + 1) * 8
+            proto = nxt
+            l4 += hlen
+    else:
+        return Decoded((ethertype,), l3, None, None)
+
+    if proto == 6 or proto == 17:
+        if frag_offset != 0 or len(packet) < l4 + 4:
+            # a non-first fragment (or a first fragment too short to
+            # hold the ports):  the port is unknown
+            return Decoded((ethertype, proto, -1), l3, l4, None)
+        sport, dport = _u16_pair(packet, l4)
+        port = sport if sport < dport else dport
+        if proto == 6:
+            if len(packet) < l4 + 13:
+                payload = None
+            else:
+                payload = l4 + (_u8(packet, l4 + 12)[0] >> 4) * 4
+        else:
+            payload = l4 + 8
+        return Decoded((ethertype, proto, port), l3, l4, payload)
+    return Decoded((ethertype, proto), l3, l4, l4)
+
+def decode_en10mb(packet):
+    ethertype, = _u16(packet, 12)
+    l3 = 14
+    if ethertype <= 1500:
+        # in this case the ethertype field is actually a length and
+        # there is an 802.2 LLC header.  SNAP frames carry an
+        # ethertype after the LLC header; the rest have none, so
+        # combine these all into the non-existant ethertype 0
+        if packet[14:17] == b'\xaa\xaa\x03':
+            ethertype, = _u16(packet, 20)
+            l3 = 22
+        else:
+            return Decoded((0,), l3, None, None)
+    ethertype, l3 = _strip_tags(packet, ethertype, l3)
+    return decode_l3(packet, ethertype, l3)
+
+def _decode_sll_protocol(packet, ethertype, l3):
+    if ethertype <= 1500:
+        # Linux uses small values for non-ethertype protocols (e.g.,
+        # 0x0004 for 802.2 LLC); treat them like non-SNAP 802.2
+        return Decoded((0,), l3, None, None)
+    ethertype, l3 = _strip_tags(packet, ethertype, l3)
+    return decode_l3(packet, ethertype, l3)
+
+def decode_linux_sll(packet):
+    return _decode_sll_protocol(packet, _u16(packet, 14)[0], 16)
+
+def decode_linux_sll2(packet):
+    return _decode_sll_protocol(packet, _u16(packet, 0)[0], 20)
+
+def _decode_by_version(packet, l3):
+    version = _u8(packet, l3)[0] >> 4
+    if version == 4:
+        return decode_l3(packet, ETHERTYPE_IPV4, l3)
+    if version == 6:
+        return decode_l3(packet, ETHERTYPE_IPV6, l3)
+    return Decoded((0,), l3, None, None)
+
+def decode_raw(packet):
+    return _decode_by_version(packet, 0)
+
+def decode_loopback(packet):
+    # the 4-byte address family header of DLT_NULL is in the
+    # capturing host's byte order and AF_INET6 differs between
+    # operating systems, so go by the IP version nibble instead
+    return _decode_by_version(packet, 4)
+
+def decode_unknown(packet):
+    return Decoded((0,), None, None, None)
+
+decoders = {
+    DLT_NULL: decode_loopback,
+    DLT_EN10MB: decode_en10mb,
+    DLT_RAW: decode_raw,
+    DLT_LINKTYPE_RAW: decode_raw,
+    DLT_LOOP: decode_loopback,
+    DLT_LINUX_SLL: decode_linux_sll,
+    DLT_IPV4: decode_raw,
+    DLT_IPV6: decode_raw,
+    DLT_LINUX_SLL2: decode_linux_sll2,
+}
+
+def decoder_for_linktype(linktype):
+    try:
+        return decoders[linktype]
+    except KeyError:
+        log.warning('no decoder for link type %i; all packets will be'
+                    ' classified as non-IP', linktype)
+        return decode_unknown
+
+class Header(object):
+    """stand-in for a pcap packet header after reframing
+    """
+    __slots__ = ('sec', 'nsec', 'caplen', 'len')
+    def __init__(self, sec, nsec, caplen, len):
+        self.sec = sec
+        self.nsec = nsec
+        self.caplen = caplen
+        self.len = len
+
+def _ethertype_of(decoded, l3_len):
+    ethertype = decoded.service[0]
+    # non-ethertype frames get an 802.3 length field
+    return ethertype if ethertype > 1500 else min(l3_len, 1500)
+
+def _to_en10mb(packet, decoded):
+    body = packet[decoded.l3:]
+    return struct.pack('!6x6xH', _ethertype_of(decoded, len(body))) + body
+
+def _to_linux_sll(packet, decoded):
+    body = packet[decoded.l3:]
+    # packet type 0 (to us), ARPHRD_ETHER, no link-layer address
+    return struct.pack('!HHH8xH', 0, 1, 0,
+                       _ethertype_of(decoded, len(body))) + body
+
+def _to_raw(*ethertypes):
+    def f(packet, decoded):
+        if decoded.service[0] not in ethertypes:
+            return None
+        return packet[decoded.l3:]
+    return f
+
+_reframers = {
+    DLT_EN10MB: _to_en10mb,
+    DLT_LINUX_SLL: _to_linux_sll,
+    DLT_RAW: _to_raw(ETHERTYPE_IPV4, ETHERTYPE_IPV6),
+    DLT_LINKTYPE_RAW: _to_raw(ETHERTYPE_IPV4, ETHERTYPE_IPV6),
+    DLT_IPV4: _to_raw(ETHERTYPE_IPV4),
+    DLT_IPV6: _to_raw(ETHERTYPE_IPV6),
+}
+
+def reframer_for_linktypes(from_linktype, to_linktype):
+    """return a function converting packets between link types
+
+    The returned function takes (packet, header, decoded) and returns
+    a new (packet, header, decoded) triple with the link-layer header
+    replaced by one of to_linktype, or None if the packet can't be
+    represented in to_linktype (e.g., ARP in a raw IP file).  Link
+    layer addresses are not preserved.  Raises ValueError if
+    to_linktype isn't a supported output link type.
+    """
+    try:
+        convert = _reframers[to_linktype]
+    except KeyError:
+        raise ValueError('cannot convert link type %i to %i'
+                         % (from_linktype, to_linktype))
+    def reframe(packet, header, decoded):
+        if decoded.l3 is None:
+            return None
+        new = convert(packet, decoded)
+        if new is None:
+            return None
+        delta = len(new) - len(packet)
+        header = Header(header.sec, header.nsec,
+                        header.caplen + delta, header.len + delta)
+        decoded = Decoded(*([decoded.service] + [
+            None if off is None else off + delta
+            for off in decoded[1:]]))
+        return new, header, decoded
+    return reframe
+
+class Tests(unittest.TestCase):
+    tcp = (b'\x45\x00\x00\x28\x00\x01\x00\x00\x40\x06\x00\x00'
+           b'\x0a\x00\x00\x01\x0a\x00\x00\x02'
+           b'\xc0\x00\x00\x50\x00\x00\x00\x00\x00\x00\x00\x00'
+           b'\x50\x02\x20\x00\x00\x00\x00\x00')
+
+    def test_ethernet_vlan_qinq(self):
+        pkt = (b'\x00' * 12 + b'\x88\xa8\x00\x01\x81\x00\x00\x02\x08\x00'
+               + self.tcp)
+        d = decode_en10mb(pkt)
+        self.assertEqual(d.service, (0x800, 6, 80))
+        self.assertEqual(d.l3, 22)
+        self.assertEqual(d.payload, 62)
+
+    def test_mpls(self):
+        pkt = (b'\x00' * 12 + b'\x88\x47\x00\x01\x00\x40\x00\x02\x01\x40'
+               + self.tcp)
+        self.assertEqual(decode_en10mb(pkt).service, (0x800, 6, 80))
+
+    def test_llc(self):
+        pkt = b'\x00' * 12 + b'\x00\x20\x42\x42\x03' + b'\x00' * 40
+        self.assertEqual(decode_en10mb(pkt).service, (0,))
+
+    def test_linux_sll(self):
+        pkt = b'\x00' * 14 + b'\x08\x00' + self.tcp
+        self.assertEqual(decode_linux_sll(pkt).service, (0x800, 6, 80))
+
+    def test_fragment(self):
+        pkt = bytearray(self.tcp)
+        pkt[6:8] = b'\x00\x10'
+        self.assertEqual(decode_raw(bytes(pkt)).service, (0x800, 6, -1))
+
+    def test_ipv6_ext_hdr(self):
+        pkt = (b'\x60\x00\x00\x00\x00\x10\x00\x40' + b'\x00' * 32
+               + b'\x11\x00' + b'\x00' * 6
+               + b'\x00\x35\xc0\x00\x00\x08\x00\x00')
+        self.assertEqual(decode_raw(pkt).service, (0x86dd, 17, 53))
+
+    def test_reframe_raw_to_en10mb(self):
+        reframe = reframer_for_linktypes(DLT_RAW, DLT_EN10MB)
+        header = Header(0, 0, len(self.tcp), len(self.tcp))
+        pkt, header, d = reframe(self.tcp, header, decode_raw(self.tcp))
+        self.assertEqual(header.caplen, len(self.tcp) + 14)
+        self.assertEqual(decode_en10mb(pkt), d)
@@ -2,11 +2,26 @@
 
 from __future__ import absolute_import
 
+from .anonymize import Anonymizer
+from .novelty import NoveltyEstimator
+from .payloadfilter import PayloadFilter
+from .reassembly import Reassembler
+from .schedule import Schedule
+from .records import (FOOTER_MAGIC, SEGMENT_MAGIC, SEGMENT_VERSION,
+                      footer_trailer, offsets_to_bytes, pack_record_header,
+                      record_header, segment_filename, segment_header)
 from .util import KeyDefaultDict
 
+import array
 import fasguard_pcap as pcap
 import logging
+import os
+import shutil
+import struct
+import tempfile
 import threading
+import time
+import unittest
 
 log = logging.getLogger(__name__)
 
@@ -16,91 +31,1202 @@ class Dumpfiles(KeyDefaultDict):
     If a service isn't in this (KeyError), the packet shouldn't be
     saved.
     """
-    def __init__(self, config, capture_params, stats):
+    def __init__(self, config, capture_params, stats, partition=None,
+                 resume=None):
+        """
+        If partition is not None, each output is written to a
+        separate per-partition file (see partition_filename()) so
+        that several processes can collect the same outputs.  The
+        Stats nodes are still named after the unpartitioned filename.
+
+        If resume is not None, existing output files are appended to
+        instead of overwritten.  resume is the 'outputs' dict of a
+        checkpoint (see checkpoint()), which may be empty; the stats
+        are expected to have been restored from the same checkpoint.
+        """
         super(Dumpfiles, self).__init__(self._factory)
         self._config = config
+        self._partition = partition
+        self._resume = resume
         self._capture_params = capture_params
         self._stats = stats
         self._dumpfiles_by_filename = {}
+        # filename -> Dumpfile.checkpoint() of outputs closed by
+        # reload(), so that they are appended to if they come back
+        self._closed = {}
         self._discard_dumpfile = DiscardDumpfile(
             self._stats.get_child('(discard)'))
+        # shared by the outputs with the 'reassemble' option so that
+        # the memory cap covers all of them
+        self._reassembler = Reassembler(**config.get('reassembly', {}))
+        # likewise shared so that addresses map the same in every
+        # output; not replaced by reload()
+        self._anonymizer = None
+        if 'anonymize' in config:
+            self._anonymizer = Anonymizer(**config['anonymize'])
+        # see poll_schedules()
+        self._idle_schedules = _idle_schedules(config)
+        self._next_schedule_check = 0.0
+        self._idle = False
+    @property
+    def config(self):
+        """the config currently in effect (see reload())
+        """
+        return self._config
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_value, tb):
         self.close()
     def close(self):
+        _save_chunks(self._reassembler.flush_all())
         for df in self._dumpfiles_by_filename:
             self._dumpfiles_by_filename[df].close()
-    def _factory(self, service):
-        ethertype, proto, port = (list(service) + [None, None])[0:3]
+    def reload(self, config):
+        """atomically swap in a new config without stopping capture
+
+        Every service seen so far is resolved again against the new
+        'outputs' table.  Dumpfile objects whose filenames are still
+        produced by the new config are carried over (and left open);
+        the rest are closed once the new table is in place.  Services
+        not seen yet are resolved lazily as usual.  New outputs get
+        the new 'writer' and 'output_options' settings; outputs that
+        were carried over keep theirs.  An output that a later
+        reload brings back is appended to, not overwritten.
+
+        If resolving fails, the old config is left untouched and any
+        Dumpfile objects opened during the attempt are closed.
+        """
+        with self._lock:
+            old_by_filename = self._dumpfiles_by_filename
+            new_by_filename = {}
+            data = {}
+            try:
+                for service in self._data:
+                    try:
+                        data[service] = self._resolve(
+                            config, new_by_filename, service,
+                            reuse=old_by_filename)
+                    except KeyError:
+                        pass
+            except:
+                for filename, df in new_by_filename.items():
+                    if filename not in old_by_filename:
+                        df.close()
+                raise
+            self._config = config
+            self._dumpfiles_by_filename = new_by_filename
+            self._data = data
+            self._idle_schedules = _idle_schedules(config)
+            self._next_schedule_check = 0.0
+        for filename, df in old_by_filename.items():
+            if filename not in new_by_filename:
+                log.info('closing %s (no longer in config)', filename)
+                df.close()
+                self._closed[filename] = df.checkpoint()
+        log.info('reloaded outputs: %i file(s) kept, %i closed',
+                 len(set(old_by_filename) & set(new_by_filename)),
+                 len(set(old_by_filename) - set(new_by_filename)))
+    def checkpoint(self):
+        """return the state of each open output as plain data
+
+        The returned dict maps output filenames to the dicts returned
+        by Dumpfile.checkpoint().  Buffered data is flushed first so
+        that the recorded file lengths match the recorded counts.
+        """
+        with self._lock:
+            dumpfiles = list(self._dumpfiles_by_filename.items())
+        return dict((filename, df.checkpoint())
+                    for filename, df in dumpfiles)
+    def stop_output(self, filename):
+        """close an output because a quota was met elsewhere
+
+        filename is the output's unpartitioned filename, as in the
+        stats.  Returns False if no such output is open.
+        """
+        with self._lock:
+            dumpfile = self._dumpfiles_by_filename.get(filename)
+        if dumpfile is None or not dumpfile.is_open:
+            return False
+        dumpfile.stop()
+        return True
+    def quotas(self):
+        """return the quota of each output that has one
+
+        The returned dict maps output filenames (as in the stats) to
+        dicts with 'max_packets' and/or 'max_bytes'.
+        """
+        with self._lock:
+            dumpfiles = list(self._dumpfiles_by_filename.items())
+        return dict((filename, df.quota) for filename, df in dumpfiles
+                    if df.quota)
+    def resource_counts(self):
+        """return the sizes of the lookup tables as a dict
+
+        'services' is the number of cached service lookups,
+        'outputs' the number of Dumpfile objects and 'open_outputs'
+        the number of those that are still open.
+        """
+        with self._lock:
+            outputs = list(self._dumpfiles_by_filename.values())
+            services = len(self._data)
+        return {
+            'services': services,
+            'outputs': len(outputs),
+            'open_outputs': sum(1 for df in outputs if df.is_open),
+        }
+    def flush_if_due(self):
+        """flush output buffers that have been waiting too long
+
+        Called periodically so that low-rate outputs don't sit on
+        buffered packets indefinitely.
+        """
+        now = time.time()
+        _save_chunks(self._reassembler.flush_idle(now))
+        with self._lock:
+            dumpfiles = list(self._dumpfiles_by_filename.values())
+        for df in dumpfiles:
+            df.flush_if_due(now)
+    def poll_schedules(self, now=None):
+        """open and close the collection windows of scheduled outputs
 
+        Called once per dispatch batch; unless a window may have
+        opened or closed since the last call, this is a single
+        comparison.  Returns True while every output has a 'schedule'
+        and none is in it, when the capture can stop delivering
+        packets altogether.
+        """
+        if now is None:
+            now = time.time()
+        if now < self._next_schedule_check:
+            return self._idle
+        with self._lock:
+            next_check = float('inf')
+            for df in self._dumpfiles_by_filename.values():
+                next_check = min(next_check, df.poll_schedule(now))
+            idle = self._idle_schedules is not None
+            for schedule in self._idle_schedules or ():
+                active, change = schedule.state(now)
+                idle = idle and not active
+                next_check = min(next_check, change)
+            if idle != self._idle:
+                log.info('all outputs %s', 'idle' if idle else 'resumed')
+            self._idle = idle
+            self._next_schedule_check = next_check
+        return idle
+    def _factory(self, service):
+        return self._resolve(
+            self._config, self._dumpfiles_by_filename, service)
+    def _resolve(self, config, by_filename, service, reuse=None):
         try:
-            pattern = self._config['outputs'][ethertype]
-            if proto is not None:
-                pattern = pattern[proto]
-            if port is not None:
-                pattern = pattern[port]
+            filename, pattern = output_for_service(config, service)
         except KeyError:
-            log.debug('no filename pattern in config for %s', service)
             if self._discard_dumpfile is not None:
                 return self._discard_dumpfile
             raise
 
-        if pattern is None:
-            log.debug('filename pattern is None for %s', service)
-            if self._discard_dumpfile is not None:
-                return self._discard_dumpfile
-            # pretend as if an entry wasn't found so that the packet
-            # is dropped
-            raise KeyError()
-
-        filename = pattern.format(
-            ethertype=ethertype,
-            proto=proto,
-            port=port,
-        )
-
         try:
-            return self._dumpfiles_by_filename[filename]
+            return by_filename[filename]
         except KeyError:
             pass
 
-        dumpfile = Dumpfile(filename, self._capture_params,
-                            self._stats.get_child(filename))
-        self._dumpfiles_by_filename[filename] = dumpfile
+        if reuse is not None and filename in reuse:
+            dumpfile = reuse[filename]
+        else:
+            path = filename
+            if self._partition is not None:
+                path = partition_filename(filename, self._partition)
+            resume = None if self._resume is None \
+                else self._resume.get(filename, {})
+            if filename in self._closed:
+                # closed by an earlier reload; its stats node still
+                # counts what the file holds
+                resume = self._closed[filename]
+            dumpfile = Dumpfile(
+                path, self._capture_params,
+                self._stats.get_child(filename),
+                config.get('writer'),
+                config.get('output_options', {}).get(pattern),
+                resume, self._reassembler, self._anonymizer)
+            if dumpfile.scheduled:
+                # its next window change is not known to
+                # poll_schedules() yet
+                self._next_schedule_check = 0.0
+        by_filename[filename] = dumpfile
         return dumpfile
 
+def output_for_service(config, service):
+    """return the (filename, filename pattern) of a service's output
+
+    Raises KeyError if the 'outputs' config discards the service's
+    packets.
+    """
+    ethertype, proto, port = (list(service) + [None, None])[0:3]
+
+    try:
+        pattern = config['outputs'][ethertype]
+        if proto is not None:
+            pattern = pattern[proto]
+        if port is not None:
+            pattern = pattern[port]
+    except KeyError:
+        log.debug('no filename pattern in config for %s', service)
+        raise
+
+    if pattern is None:
+        log.debug('filename pattern is None for %s', service)
+        # pretend as if an entry wasn't found so that the packet is
+        # dropped
+        raise KeyError(service)
+
+    filename = pattern.format(
+        ethertype=ethertype,
+        proto=proto,
+        port=port,
+    )
+    return filename, pattern
+
+def output_patterns(outputs):
+    """return the set of filename patterns in an 'outputs' table
+    """
+    ret = set()
+    stack = [outputs]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            stack.extend(node.values())
+            factory = getattr(node, 'default_factory', None)
+            if factory is not None:
+                stack.append(factory())
+        elif node is not None:
+            ret.add(node)
+    return ret
+
+def _idle_schedules(config):
+    """return the Schedule of every output pattern, or None if some
+    output lacks one (or there are no outputs) and so never idles
+    """
+    options = config.get('output_options', {})
+    ret = []
+    for pattern in output_patterns(config.get('outputs', {})):
+        schedule = options.get(pattern, {}).get('schedule')
+        if schedule is None:
+            return None
+        ret.append(Schedule(**schedule))
+    return ret or None
+
+def partition_filename(filename, partition):
+    return '%s.part%i' % (filename, partition)
+
+def _save_chunks(chunks):
+    for dumpfile, packet, header, decoded in chunks:
+        dumpfile._save(packet, header, decoded)
+
 class Dumpfile(object):
-    _pcap = None
-    _dumper = None
-    def __init__(self, filename, capture_params, stats):
+    def __init__(self, filename, capture_params, stats, writer_config=None,
+                 options=None, resume=None, reassembler=None,
+                 anonymizer=None):
+        """
+        options is the output's entry in the 'output_options' config
+        (see config_handle_output_options()).  Once the output's
+        max_packets or max_bytes quota is met, or once its 'novelty'
+        estimate says it is saturated (see novelty.py), the file is
+        closed and further packets are dropped.
+
+        If resume is not None and the file exists, it is appended to
+        (see _resume()); resume is the output's entry in a checkpoint,
+        or an empty dict if the checkpoint doesn't mention it.
+
+        If options has 'reassemble', TCP segments go through
+        reassembler (a reassembly.Reassembler; a private one if None)
+        and the resulting stream chunks are saved instead.
+
+        If anonymizer is not None, the addresses of every saved packet
+        are rewritten with it (see anonymize.Anonymizer).
+
+        If options has a 'schedule', packets are only saved inside it
+        (see poll_schedule()).
+        """
+        self._filename = filename
+        self._lock = threading.RLock()
+        self._stats = stats
+        options = options or {}
+        self._max_packets = options.get('max_packets')
+        self._max_bytes = options.get('max_bytes')
+        # see shedding.LoadShedder
+        self.priority = options.get('priority', 0)
+        self._filter = None
+        if 'payload_filter' in options:
+            self._filter = PayloadFilter(**options['payload_filter'])
+        self._novelty = None
+        if 'novelty' in options:
+            self._novelty = NoveltyEstimator(**options['novelty'])
+        # whether each saved packet has to be checked (see _check())
+        self._per_packet = self._max_packets is not None \
+            or self._max_bytes is not None or self._novelty is not None
+        self._reassembler = None
+        if 'reassemble' in options:
+            self._reassembler = reassembler
+            if reassembler is None:
+                self._reassembler = Reassembler()
+            self._depth = options['reassemble'].get('depth')
+        self._anonymizer = anonymizer
+        self._linktype = capture_params.linktype
+        self._schedule = None
+        # start of the current collection window, or None
+        self._window = None
+        self._off_schedule = False
+        if 'schedule' in options:
+            self._schedule = Schedule(**options['schedule'])
+            active, self._schedule_change = self._schedule.state(
+                time.time())
+            self._off_schedule = not active
+        self._writer = None
+        self.quota_met = self._over_quota() \
+            or (resume or {}).get('quota_met', False)
+        if self.quota_met:
+            log.info('%s: quota already met; not reopening', filename)
+            return
+        if self._schedule is not None and not self._off_schedule:
+            self._window = time.time()
         linktype = capture_params.linktype
         assert linktype is not None
         assert capture_params.snaplen is not None
-        self._pcap = pcap.pcap.open_dead(linktype, capture_params.snaplen)
-        self._dumper = pcap.dumper(self._pcap, filename)
-        self._lock = threading.RLock()
-        self._stats = stats
+        writer_config = dict(writer_config or {})
+        writer_type = writer_config.pop('type', 'libpcap')
+        if writer_type == 'records':
+            # each run starts a new segment, so there is nothing to
+            # resume and the checkpointed counts are kept
+            self._writer = RecordWriter(filename, stats, **writer_config)
+            return
+        resumable = resume is not None and os.path.exists(filename) \
+            and os.path.getsize(filename) >= pcap_file_header.size
+        if resume is not None and not resumable and self._stats.packets:
+            log.warning('%s: missing; discarding its %i checkpointed'
+                        ' packets', filename, self._stats.packets)
+            self._stats.add_totals(-self._stats.packets, -self._stats.bytes)
+        if resumable:
+            self._resume(resume)
+            # libpcap can't append, so resumed outputs always use the
+            # native writer
+            if writer_type != 'native':
+                writer_config = {}
+            self._writer = PcapWriter(filename, linktype,
+                                      capture_params.snaplen, stats,
+                                      append=True, **writer_config)
+        elif writer_type == 'native':
+            self._writer = PcapWriter(filename, linktype,
+                                      capture_params.snaplen, stats,
+                                      **writer_config)
+        else:
+            self._writer = LibpcapWriter(filename, linktype,
+                                         capture_params.snaplen)
+    def _resume(self, checkpoint):
+        """prepare an existing output file for appending
+
+        Any partial record at the end of the file is truncated.  The
+        records after the checkpointed length are counted and the
+        stats are corrected to match the file; if the file is shorter
+        than checkpointed (data lost in a crash), the whole file is
+        recounted.
+        """
+        start = checkpoint.get('length')
+        packets = checkpoint.get('packets', 0)
+        nbytes = checkpoint.get('bytes', 0)
+        if start is None or os.path.getsize(self._filename) < start:
+            start = packets = nbytes = 0
+        reader = PcapReader(self._filename, offset=start or None)
+        try:
+            for rec in reader:
+                packets += 1
+                nbytes += rec[3]
+            end = reader.offset
+        finally:
+            reader.close()
+        if end < os.path.getsize(self._filename):
+            log.warning('%s: truncating partial record at offset %i',
+                        self._filename, end)
+            with open(self._filename, 'r+b') as f:
+                f.truncate(end)
+        log.info('%s: resuming after %i packets (%i bytes)',
+                 self._filename, packets, nbytes)
+        self._stats.add_totals(packets - self._stats.packets,
+                               nbytes - self._stats.bytes)
+    def _over_quota(self):
+        return (self._max_packets is not None
+                and self._stats.packets >= self._max_packets) \
+            or (self._max_bytes is not None
+                and self._stats.bytes >= self._max_bytes)
+    def _check_quota(self):
+        if self._over_quota():
+            log.info('%s: quota met (%i packets, %i bytes); closing',
+                     self._filename, self._stats.packets, self._stats.bytes)
+            self.quota_met = True
+            self.close()
+    def _check(self, packet, decoded):
+        """close the output if its quota is met or it is saturated
+        """
+        self._check_quota()
+        if self._novelty is None or self._writer is None \
+           or decoded is None or decoded.payload is None \
+           or decoded.payload >= len(packet):
+            return
+        if self._novelty.add(packet[decoded.payload:], self._stats.packets,
+                             self._stats.bytes):
+            log.info('%s: saturated (%i packets, %i bytes); closing',
+                     self._filename, self._stats.packets, self._stats.bytes)
+            self._novelty.log_curve(self._filename)
+            self._stats.count('saturated')
+            self.quota_met = True
+            self.close()
+    @property
+    def quota(self):
+        """the max_packets and max_bytes options that are set, as a dict
+        """
+        ret = {}
+        if self._max_packets is not None:
+            ret['max_packets'] = self._max_packets
+        if self._max_bytes is not None:
+            ret['max_bytes'] = self._max_bytes
+        return ret
+    @property
+    def scheduled(self):
+        return self._schedule is not None
+    def poll_schedule(self, now):
+        """start or stop saving packets if the schedule says so
+
+        Returns the time of the next possible change.  The start and
+        end of each window the output was collecting in are appended
+        to filename + '.windows' as a line of two timestamps.
+        """
+        if self._schedule is None:
+            return float('inf')
+        with self._lock:
+            if now < self._schedule_change:
+                return self._schedule_change
+            active, self._schedule_change = self._schedule.state(now)
+            if active and self._window is None \
+               and self._writer is not None:
+                log.info('%s: collection window opens', self._filename)
+                self._window = now
+            elif not active and self._window is not None:
+                self._end_window(now)
+            self._off_schedule = not active
+            return self._schedule_change
+    def _end_window(self, now):
+        log.info('%s: collection window closes', self._filename)
+        if self._writer is not None:
+            self._writer.flush()
+        with open(self._filename + '.windows', 'a') as f:
+            f.write('%.6f %.6f\n' % (self._window, now))
+        self._window = None
+    def stop(self):
+        """mark the quota as met and close the output
+        """
+        with self._lock:
+            if self._writer is not None:
+                log.info('%s: quota met elsewhere; closing', self._filename)
+                self.quota_met = True
+                self.close()
+    def shed(self, header):
+        """count a packet dropped by load shedding
+        """
+        if self._writer is None:
+            # closed; the packet would have been dropped anyway
+            return
+        self._stats.count('shed')
+        self._stats.count('shed_bytes', header.len)
+    def checkpoint(self):
+        """flush and return the state of this output as plain data
+
+        The dict holds the file 'length' (None if unknown), the
+        'packets' and 'bytes' saved and whether the quota is met.
+        """
+        with self._lock:
+            length = None
+            if self._writer is not None:
+                self._writer.flush()
+                length = self._writer.length
+            elif self.quota_met and os.path.exists(self._filename):
+                length = os.path.getsize(self._filename)
+            return {
+                'length': length,
+                'packets': self._stats.packets,
+                'bytes': self._stats.bytes,
+                'quota_met': self.quota_met,
+            }
     def __enter__(self):
         return self
     def __exit__(self, exc_type, exc_value, tb):
         self.close()
     def close(self):
         with self._lock:
-            if self._dumper is not None:
-                self._dumper.close()
-                self._dumper = None
-            if self._pcap is not None:
-                self._pcap.close()
-                self._pcap = None
-    def save(self, packet, header):
-        # record the original packet length, not the capture length
-        self._stats.got_packet(header.len)
+            if self._window is not None:
+                self._end_window(time.time())
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+    @property
+    def is_open(self):
+        return self._writer is not None
+    def flush_if_due(self, now):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.flush_if_due(now)
+    def save(self, packet, header, decoded=None):
+        """save a packet
+
+        decoded is the packet's decode.Decoded tuple, which the
+        'records' writer, the payload filter and reassembly need to
+        find the payload.
+        """
+        if self._off_schedule:
+            return
+        if self._reassembler is not None and decoded is not None \
+           and decoded.payload is not None and decoded.service[1] == 6:
+            if self._writer is None:
+                return
+            _save_chunks(self._reassembler.add(
+                self, self._stats, packet, header, decoded, self._depth))
+            return
+        self._save(packet, header, decoded)
+    def _save(self, packet, header, decoded):
+        if self._filter is not None:
+            filtered = self._filter.apply(packet, header, decoded)
+            if filtered is None:
+                self._stats.count('payload_skipped')
+                self._stats.count('payload_skipped_bytes', header.len)
+                return
+            packet, header, accepted = filtered
+            self._stats.count('payload_accepted' if accepted
+                              else 'payload_truncated')
+        if self._anonymizer is not None:
+            packet = self._anonymizer.apply(packet, decoded, self._linktype)
+        with self._lock:
+            if self._writer is None:
+                # closed by a config reload after a capture thread
+                # looked this object up; drop the packet
+                return
+            # record the original packet length, not the capture length
+            self._stats.got_packet(header.len,
+                                   header.sec + header.nsec * 1e-9)
+            self._writer.write(packet, header, decoded)
+            if self._per_packet:
+                self._check(packet, decoded)
+
+    def save_batch(self, items):
+        """save a list of (packet, header, decoded) tuples
+
+        Like save() for each packet, but the lock is taken once and,
+        unless a quota or novelty has to be checked after every
+        packet, the writer gets the whole batch in one write_batch()
+        call.
+        """
+        if self._off_schedule:
+            return
+        if self._reassembler is not None:
+            for packet, header, decoded in items:
+                self.save(packet, header, decoded)
+            return
+        if self._filter is not None:
+            filtered = []
+            for packet, header, decoded in items:
+                f = self._filter.apply(packet, header, decoded)
+                if f is None:
+                    self._stats.count('payload_skipped')
+                    self._stats.count('payload_skipped_bytes', header.len)
+                    continue
+                packet, header, accepted = f
+                self._stats.count('payload_accepted' if accepted
+                                  else 'payload_truncated')
+                filtered.append((packet, header, decoded))
+            items = filtered
+        if self._anonymizer is not None:
+            items = [(self._anonymizer.apply(packet, decoded, self._linktype),
+                      header, decoded) for packet, header, decoded in items]
         with self._lock:
-            self._dumper.dump(packet, header)
+            if self._writer is None:
+                return
+            if self._per_packet:
+                for packet, header, decoded in items:
+                    self._stats.got_packet(header.len,
+                                           header.sec + header.nsec * 1e-9)
+                    self._writer.write(packet, header, decoded)
+                    self._check(packet, decoded)
+                    if self._writer is None:
+                        return
+                return
+            headers = [item[1] for item in items]
+            self._stats.got_packets(
+                [h.len for h in headers],
+                [h.sec + h.nsec * 1e-9 for h in headers])
+            self._writer.write_batch(items)
+
+class LibpcapWriter(object):
+    """writes packets with libpcap's pcap_dump()
+    """
+    def __init__(self, filename, linktype, snaplen):
+        self._pcap = pcap.pcap.open_dead(linktype, snaplen)
+        self._dumper = pcap.dumper(self._pcap, filename)
+    @property
+    def length(self):
+        # unknown because of libpcap's stdio buffer
+        return None
+    def write(self, packet, header, decoded=None):
+        self._dumper.dump(packet, header)
+    def write_batch(self, items):
+        for packet, header, decoded in items:
+            self._dumper.dump(bytes(packet), header)
+    def flush_if_due(self, now):
+        # libpcap flushes its stdio buffer whenever it fills up
+        pass
+    def flush(self):
+        pass
+    def close(self):
+        if self._dumper is not None:
+            self._dumper.close()
+            self._dumper = None
+        if self._pcap is not None:
+            self._pcap.close()
+            self._pcap = None
+
+# microsecond- and nanosecond-resolution pcap file formats
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+pcap_file_header = struct.Struct('=IHHiIII')
+pcap_record_header = struct.Struct('=IIII')
+
+class PcapWriter(object):
+    """pcap file writer that coalesces records into large writes
+
+    Record headers are packed with struct and appended, together with
+    the packet data, to in-memory chunks.  The chunks are written with
+    writev() (in as few calls as IOV_MAX allows) once block_size bytes
+    have accumulated, once flush_interval seconds have passed since
+    the last flush (see flush_if_due()), or on close.  Compared to
+    pcap_dump(), which goes through a small stdio buffer per file,
+    this issues far fewer and far larger write syscalls when many
+    outputs are open.
+
+    durability selects when the data is forced to disk:
+      * 'none':  never (left to the operating system)
+      * 'periodic':  fsync() after a flush if at least fsync_interval
+        seconds have passed since the last fsync(), and on close
+      * 'close':  fsync() on close only
+
+    If fadvise is true, the kernel is told that the file is written
+    sequentially and that the written data won't be read back soon
+    (so it doesn't crowd the page cache).  If preallocate is nonzero,
+    disk space is reserved that many bytes at a time with
+    posix_fallocate() to reduce fragmentation; the file is truncated
+    to its real length on close.
+
+    If append is true and the file is not empty, records are appended
+    to it in its existing timestamp resolution.  The file must have
+    been written on a host with the same byte order and with the same
+    linktype; see Dumpfile._resume() for dropping a partial trailing
+    record first.
+
+    These hints need Python 3.3 or later; on older versions they are
+    skipped and writev() is emulated with a single write().
+
+    Counts of write syscalls, flushes and fsyncs are kept in stats.
+    """
+    chunk_size = 1 << 16
+    durabilities = ('none', 'periodic', 'close')
+
+    def __init__(self, filename, linktype, snaplen, stats,
+                 block_size=1 << 20, flush_interval=5.0,
+                 durability='none', fsync_interval=60.0,
+                 fadvise=False, preallocate=0, append=False):
+        if durability not in self.durabilities:
+            raise ValueError('unknown durability policy: '
+                             + repr(durability))
+        self._stats = stats
+        self._block_size = block_size
+        self._flush_interval = flush_interval
+        self._durability = durability
+        self._fsync_interval = fsync_interval
+        self._fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self._preallocate = preallocate \
+            if hasattr(os, 'posix_fallocate') else 0
+        flags = os.O_RDWR | os.O_CREAT
+        if not append:
+            flags |= os.O_TRUNC
+        self._fd = os.open(filename, flags, 0o644)
+        # number of bytes in the file (not counting buffered data)
+        self._length = os.lseek(self._fd, 0, os.SEEK_END)
+        # divisor converting nanoseconds to the file's resolution
+        self._nsec_div = 1
+        if self._length:
+            try:
+                self._check_header(filename, linktype)
+            except:
+                os.close(self._fd)
+                raise
+        self._allocated = self._length
+        self._chunks = [bytearray()]
+        self._buffered = 0
+        now = time.time()
+        self._last_flush = now
+        self._last_fsync = now
+        if self._fadvise:
+            os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if self._length == 0:
+            self._append(self._file_header(linktype, snaplen))
+
+    def _file_header(self, linktype, snaplen):
+        return pcap_file_header.pack(
+            PCAP_MAGIC_NSEC, 2, 4, 0, 0, snaplen, linktype)
+
+    def _check_header(self, filename, linktype):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        raw = os.read(self._fd, pcap_file_header.size)
+        if len(raw) < pcap_file_header.size:
+            raise IOError('%s: truncated pcap file header' % filename)
+        fields = pcap_file_header.unpack(raw)
+        if fields[0] == PCAP_MAGIC_USEC:
+            self._nsec_div = 1000
+        elif fields[0] != PCAP_MAGIC_NSEC:
+            raise IOError('%s: not a native byte order pcap file'
+                          % filename)
+        if fields[6] != linktype:
+            raise IOError('%s: cannot append linktype %i to a file of'
+                          ' linktype %i' % (filename, linktype, fields[6]))
+
+    @property
+    def length(self):
+        """file length including data not yet flushed
+        """
+        return self._length + self._buffered
+
+    def _append(self, data):
+        chunk = self._chunks[-1]
+        if len(chunk) >= self.chunk_size:
+            chunk = bytearray()
+            self._chunks.append(chunk)
+        chunk += data
+        self._buffered += len(data)
+
+    def write(self, packet, header, decoded=None):
+        self._append(pcap_record_header.pack(
+            header.sec, header.nsec // self._nsec_div, header.caplen,
+            header.len))
+        # this copies the packet, so it is safe to pass libpcap's
+        # static buffer
+        self._append(packet)
+        if self._buffered >= self._block_size:
+            self.flush()
+
+    def write_batch(self, items):
+        """write a list of (packet, header, decoded) tuples
+        """
+        data = bytearray()
+        for packet, header, decoded in items:
+            data += pcap_record_header.pack(
+                header.sec, header.nsec // self._nsec_div, header.caplen,
+                header.len)
+            data += packet
+        self._append(data)
+        if self._buffered >= self._block_size:
+            self.flush()
+
+    def flush_if_due(self, now):
+        if self._buffered and now - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._buffered:
+            return
+        end = self._length + self._buffered
+        if self._preallocate and end > self._allocated:
+            size = max(self._preallocate, end - self._allocated)
+            os.posix_fallocate(self._fd, self._allocated, size)
+            self._allocated += size
+        # posix_fallocate() extends the file, so always write at the
+        # logical end instead of relying on O_APPEND
+        os.lseek(self._fd, self._length, os.SEEK_SET)
+        chunks = [memoryview(c) for c in self._chunks if c]
+        while chunks:
+            n = _writev(self._fd, chunks[:_IOV_MAX])
+            self._stats.count('writes')
+            while chunks and n >= len(chunks[0]):
+                n -= len(chunks[0])
+                chunks.pop(0)
+            if chunks and n:
+                chunks[0] = chunks[0][n:]
+        start = self._length
+        self._length = end
+        self._chunks = [bytearray()]
+        self._buffered = 0
+        self._stats.count('flushes')
+        if self._durability == 'periodic' \
+           and self._last_flush - self._last_fsync >= self._fsync_interval:
+            self._fsync()
+        if self._fadvise and self._durability != 'none':
+            # only clean pages can be dropped, so this is pointless
+            # unless the data has been synced
+            os.posix_fadvise(self._fd, start, end - start,
+                             os.POSIX_FADV_DONTNEED)
+
+    def _fsync(self):
+        os.fsync(self._fd)
+        self._last_fsync = time.time()
+        self._stats.count('fsyncs')
+
+    def close(self):
+        if self._fd is None:
+            return
+        try:
+            self.flush()
+            if self._allocated > self._length:
+                os.ftruncate(self._fd, self._length)
+            if self._durability != 'none':
+                self._fsync()
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+class RecordWriter(object):
+    """writes the L4 payloads of packets to payload record segments
+
+    See records.py for the file format.  Segments are named after
+    filename with segment_filename(); numbers already in use are
+    skipped, so a new run (or a resumed one) never touches old
+    segments.  A new segment is started once the current one would
+    grow past segment_size bytes.  The remaining keyword arguments
+    are passed to each segment's PcapWriter (buffering, durability
+    and so on).  Packets without an L4 payload are counted in the
+    'no_payload' counter and not written.
+    """
+    # record offsets in the footer index are 32 bits
+    max_segment_size = 0xffffffff
+
+    def __init__(self, filename, stats, segment_size=1 << 28, **kwargs):
+        self._filename = filename
+        self._stats = stats
+        self._segment_size = min(segment_size, self.max_segment_size)
+        self._kwargs = kwargs
+        self._segment = None
+        self._next = 0
+
+    @property
+    def length(self):
+        # spread over several files
+        return None
+
+    def write(self, packet, header, decoded=None):
+        if decoded is None or decoded.payload is None \
+           or decoded.payload >= len(packet):
+            self._stats.count('no_payload')
+            return
+        payload = packet[decoded.payload:]
+        # the record plus its footer index entry
+        size = record_header.size + len(payload) + 4
+        if self._segment is not None \
+           and self._segment.length + size > self._segment_size:
+            self._segment.close()
+            self._segment = None
+        if self._segment is None:
+            while os.path.exists(segment_filename(self._filename,
+                                                  self._next)):
+                self._next += 1
+            self._segment = _SegmentWriter(
+                segment_filename(self._filename, self._next), self._stats,
+                **self._kwargs)
+            self._next += 1
+        self._segment.write_record(
+            decoded.service, header.sec * 1000000000 + header.nsec, payload)
+
+    def write_batch(self, items):
+        # segments may have to be rotated between records
+        for packet, header, decoded in items:
+            self.write(packet, header, decoded)
+
+    def flush_if_due(self, now):
+        if self._segment is not None:
+            self._segment.flush_if_due(now)
+
+    def flush(self):
+        if self._segment is not None:
+            self._segment.flush()
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+class _SegmentWriter(PcapWriter):
+    """one payload record segment
+
+    Uses PcapWriter's buffering with a different file header, and
+    adds the footer index on close.
+    """
+    def __init__(self, filename, stats, **kwargs):
+        self._offsets = array.array('I')
+        super(_SegmentWriter, self).__init__(filename, 0, 0, stats,
+                                             **kwargs)
+
+    def _file_header(self, linktype, snaplen):
+        return segment_header.pack(SEGMENT_MAGIC, SEGMENT_VERSION)
+
+    def write_record(self, service, timestamp, payload):
+        self._offsets.append(self.length)
+        self._append(pack_record_header(service, timestamp, len(payload)))
+        self._append(payload)
+        if self._buffered >= self._block_size:
+            self.flush()
+
+    def close(self):
+        if self._fd is not None:
+            index = self.length
+            self._append(offsets_to_bytes(self._offsets))
+            self._append(footer_trailer.pack(index, len(self._offsets),
+                                             FOOTER_MAGIC))
+            self._offsets = None
+        super(_SegmentWriter, self).close()
+
+# the most buffers one writev() call takes
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX < 1:
+    _IOV_MAX = 1024
+
+def _writev(fd, buffers):
+    try:
+        writev = os.writev
+    except AttributeError:
+        return os.write(fd, b''.join(b.tobytes() for b in buffers))
+    return writev(fd, buffers)
 
 class DiscardDumpfile(object):
+    # discarding is already cheap, so never shed
+    priority = float('inf')
     def __init__(self, stats):
         self._stats = stats
-    def save(self, packet, header):
-        self._stats.got_packet(header.len)
+    def save(self, packet, header, decoded=None):
+        self._stats.got_packet(header.len, header.sec + header.nsec * 1e-9)
+    def save_batch(self, items):
+        for packet, header, decoded in items:
+            self.save(packet, header, decoded)
+
+class PcapReader(object):
+    """iterate over the records of a pcap file
+
+    Yields (sec, nsec, caplen, len, data) tuples.  Both byte orders
+    and both microsecond and nanosecond resolution files are
+    understood; microsecond timestamps are converted to nanoseconds.
+    A partial record at the end of the file (e.g., after a crash) is
+    silently ignored, as is anything from a record with an original
+    length of 0 on (such as zeroed space preallocated by PcapWriter
+    but never written).  The file header is available as the
+    (linktype, snaplen) tuple in the 'header' attribute of the reader.
+    The 'offset' attribute is the file offset just past the last
+    complete record read.
+
+    If offset is given, reading starts there instead of at the first
+    record; it must be the offset of a record header.
+    """
+    magics = {
+        PCAP_MAGIC_USEC: 1000,
+        PCAP_MAGIC_NSEC: 1,
+    }
+    def __init__(self, filename, offset=None):
+        self._f = open(filename, 'rb')
+        raw = self._f.read(pcap_file_header.size)
+        if len(raw) < pcap_file_header.size:
+            self._f.close()
+            raise IOError('%s: truncated pcap file header' % filename)
+        for order in ('<', '>'):
+            magic = struct.unpack_from(order + 'I', raw)[0]
+            if magic in self.magics:
+                break
+        else:
+            self._f.close()
+            raise IOError('%s: not a pcap file' % filename)
+        self._nsec_mult = self.magics[magic]
+        fields = struct.unpack(order + 'IHHiIII', raw)
+        self.header = (fields[6], fields[5])
+        self._record = struct.Struct(order + 'IIII')
+        # offset of the end of the last complete record
+        self.offset = pcap_file_header.size
+        if offset is not None:
+            self._f.seek(offset)
+            self.offset = offset
+    def __iter__(self):
+        return self
+    def __next__(self):
+        raw = self._f.read(self._record.size)
+        if len(raw) == self._record.size:
+            sec, frac, caplen, length = self._record.unpack(raw)
+            data = self._f.read(caplen)
+            # no real packet has a length of 0
+            if len(data) == caplen and length:
+                self.offset += self._record.size + caplen
+                return (sec, frac * self._nsec_mult, caplen, length, data)
+        self.close()
+        raise StopIteration
+    next = __next__
+    def close(self):
+        self._f.close()
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        from .capture import CaptureParams
+        self.capture_params = CaptureParams(linktype=1, snaplen=65535)
+        self.dir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _config(self, *outputs):
+        from .config import config_handle_outputs
+        return {
+            'outputs': config_handle_outputs(
+                [(os.path.join(self.dir, name), [protomatch])
+                 for name, protomatch in outputs]),
+            'writer': {'type': 'native'},
+        }
+
+    def test_reload(self):
+        from .decode import Header
+        from .stats import Stats
+        udp = ('a.pcap', ('ip', 'udp'))
+        tcp = ('b.pcap', ('ip', 'tcp'))
+        a = os.path.join(self.dir, 'a.pcap')
+        stats = Stats()
+        with Dumpfiles(self._config(udp, tcp), self.capture_params,
+                       stats) as dumpfiles:
+            for i in range(5):
+                dumpfiles[(0x800, 17, 53)].save(b'x' * 60,
+                                                Header(i, 0, 60, 60))
+            dumpfiles.reload(self._config(tcp))
+            self.assertEqual(dumpfiles.resource_counts()['open_outputs'],
+                             0)
+            # a.pcap comes back and is appended to
+            dumpfiles.reload(self._config(udp, tcp))
+            dumpfiles[(0x800, 17, 53)].save(b'y' * 60, Header(5, 0, 60, 60))
+        self.assertEqual(stats.get_child(a).packets, 6)
+        self.assertEqual([rec[0] for rec in PcapReader(a)], list(range(6)))
+
+    def test_pcap_writer(self):
+        from .decode import Header
+        from .stats import Stats
+        filename = os.path.join(self.dir, 'out.pcap')
+        stats = Stats()
+        w = PcapWriter(filename, 1, 65535, stats, block_size=1 << 30,
+                       durability='close', preallocate=1 << 20)
+        # more chunks than one writev() call takes
+        w.chunk_size = 16
+        for i in range(3000):
+            w.write(b'x' * 20, Header(i, 0, 20, 20))
+        w.flush()
+        if hasattr(os, 'writev'):
+            self.assertTrue(stats.counters['writes'] > 1)
+        if hasattr(os, 'posix_fallocate'):
+            self.assertEqual(os.path.getsize(filename), 1 << 20)
+        w.close()
+        length = pcap_file_header.size + 3000 * (pcap_record_header.size
+                                                 + 20)
+        self.assertEqual(os.path.getsize(filename), length)
+        self.assertEqual(stats.counters['fsyncs'], 1)
+        self.assertRaises(IOError, PcapWriter, filename, 113, 65535,
+                          stats, append=True)
+        w = PcapWriter(filename, 1, 65535, stats, append=True)
+        w.write(b'y' * 20, Header(3000, 0, 20, 20))
+        w.close()
+        recs = list(PcapReader(filename))
+        self.assertEqual(len(recs), 3001)
+        self.assertEqual((recs[-1][0], recs[-1][4]), (3000, b'y' * 20))
+
+    def test_reassemble(self):
+        from .capture import CaptureParams
+        from .reassembly import Tests as ReassemblyTests
+        from .stats import Stats
+        segment = ReassemblyTests._segment
+        name = os.path.join(self.dir, 'tcp.pcap')
+        config = self._config(('tcp.pcap', ('ip', 'tcp')))
+        config['output_options'] = {name: {'reassemble': {}}}
+        config['reassembly'] = {'idle': 0}
+        # the segments are bare IPv4 packets
+        capture_params = CaptureParams(linktype=101, snaplen=65535)
+        stats = Stats()
+        with Dumpfiles(config, capture_params, stats) as dumpfiles:
+            for seq, payload, flags in [(99, b'', 0x02),
+                                        (100, b'abc', 0x10),
+                                        (103, b'def', 0x10)]:
+                dumpfiles[(0x800, 6, 80)].save(*segment(seq, payload,
+                                                        flags))
+            self.assertEqual(stats.get_child(name).packets, 0)
+            # the idle flow is flushed as one chunk
+            dumpfiles.flush_if_due()
+            self.assertEqual(stats.get_child(name).packets, 1)
+            # and the rest of the stream ends at the FIN
+            dumpfiles[(0x800, 6, 80)].save(*segment(106, b'ghi', 0x11))
+        self.assertEqual(stats.get_child(name).packets, 2)
+        self.assertEqual([(rec[0], rec[4][40:]) for rec in PcapReader(name)],
+                         [(100, b'abcdef'), (106, b'ghi')])
+
+    def test_poll_schedules(self):
+        from .config import config_handle_output_options
+        from .decode import Header
+        from .stats import Stats
+        udp = ('a.pcap', ('ip', 'udp'))
+        a = os.path.join(self.dir, 'a.pcap')
+        b = os.path.join(self.dir, 'b.pcap')
+        # a collects for the first 20 s of every 100, b from 50 s on
+        base = float(int(time.time()))
+        config = self._config(udp, ('b.pcap', ('ip', 'tcp')))
+        config['output_options'] = config_handle_output_options(
+            [(a, {'schedule': {'period': 100, 'duration': 20,
+                               'offset': base}}),
+             (b, {'schedule': {'period': 100, 'duration': 20,
+                               'offset': base + 50}})])
+        stats = Stats()
+        with Dumpfiles(config, self.capture_params, stats) as dumpfiles:
+            self.assertFalse(dumpfiles.poll_schedules(base + 10))
+            dumpfiles[(0x800, 17, 53)].save(b'x' * 60, Header(0, 0, 60, 60))
+            self.assertTrue(dumpfiles.poll_schedules(base + 30))
+            dumpfiles[(0x800, 17, 53)].save(b'x' * 60, Header(1, 0, 60, 60))
+            self.assertTrue(dumpfiles.poll_schedules(base + 40))
+            self.assertFalse(dumpfiles.poll_schedules(base + 55))
+        self.assertEqual(stats.get_child(a).packets, 1)
+        with open(a + '.windows') as f:
+            self.assertEqual(f.read().split()[1], '%.6f' % (base + 30))
+        # an output without a schedule always collects
+        with Dumpfiles(self._config(udp), self.capture_params,
+                       Stats()) as dumpfiles:
+            self.assertFalse(dumpfiles.poll_schedules(base + 30))
+
+    def test_record_writer(self):
+        from .decode import Decoded, Header
+        from .records import RecordReader
+        from .stats import Stats
+        filename = os.path.join(self.dir, 'out')
+        # segment 1 is left over from an earlier run
+        with open(segment_filename(filename, 1), 'wb') as f:
+            f.write(b'old')
+        stats = Stats()
+        # room for two 10-byte records (and their index entries)
+        w = RecordWriter(filename, stats, segment_size=segment_header.size
+                         + 2 * (record_header.size + 10 + 4))
+        decoded = Decoded((0x800, 17, 53), 0, 20, 28)
+        for i in range(5):
+            packet = b'\0' * 28 + bytearray([i]) * 10
+            w.write(bytes(packet), Header(i, 5, 38, 38), decoded)
+        w.write(b'\0' * 28, Header(5, 0, 28, 28), decoded)
+        w.close()
+        self.assertEqual(stats.counters['no_payload'], 1)
+        with open(segment_filename(filename, 1), 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+        records = []
+        for n in (0, 2, 3):
+            with RecordReader(segment_filename(filename, n)) as r:
+                # closed properly, with the footer index
+                self.assertTrue(r.complete)
+                records.append([(s, t, bytes(p)) for s, t, p in r])
+        self.assertEqual(records, [
+            [((0x800, 17, 53), i * 1000000000 + 5, bytes(bytearray([i]) * 10))
+             for i in range(j, min(j + 2, 5))] for j in (0, 2, 4)])
+        self.assertFalse(os.path.exists(segment_filename(filename, 4)))
@@ -0,0 +1,146 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+from .capture import Capture
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import signal
+
+log = logging.getLogger(__name__)
+
+class EventLoop(object):
+    """single-threaded capture engine multiplexing all pcap handles
+
+    This is an alternative to running one CaptureThread per input.
+    Every live handle is put in nonblocking mode and its selectable
+    file descriptor is watched with epoll (or select() where epoll is
+    unavailable).  Whenever a handle becomes readable, a batch of up
+    to the handle's dispatch count (by default everything buffered) is
+    dispatched.  Saved files are not selectable; they are always
+    considered ready and are read one batch at a time, interleaved
+    with the live handles, until they run out.
+
+    The loop runs in the calling thread, which should be the main
+    thread.  Signals (including the SIGINT from Ctrl-C) are delivered
+    through a self-pipe registered with signal.set_wakeup_fd(), so
+    they interrupt the wait immediately instead of after the pcap
+    read timeout.  stop() writes to the same pipe, so shutdown
+    requested from another thread is just as prompt.
+    """
+    def __init__(self, inputs, shutdown_event, dumpfiles, capture_params,
+                 housekeeping=None, housekeeping_interval=1.0,
+                 offline_batch=1024, analysis=None, shedder=None):
+        """
+        housekeeping, if not None, is called with no arguments after
+        every wakeup, and at least every housekeeping_interval
+        seconds.  offline_batch is the number of packets read from a
+        saved file per iteration.  analysis and shedder are passed to
+        each Capture.
+        """
+        self._shutdown = shutdown_event
+        self._captures = [
+            Capture(i, shutdown_event, dumpfiles, capture_params,
+                    analysis, shedder)
+            for i in inputs]
+        self._housekeeping = housekeeping
+        self._interval = housekeeping_interval
+        self._offline_batch = offline_batch
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def stop(self):
+        """request shutdown; safe to call from any thread
+        """
+        self._shutdown.set()
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except OSError as e:
+            # pipe full means a wakeup is already pending
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _drain(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def run(self):
+        opened = []
+        old_wakeup_fd = signal.set_wakeup_fd(self._wake_w)
+        try:
+            for c in self._captures:
+                log.info('reading packets from %s', c.name)
+                c.open(nonblock=True)
+                opened.append(c)
+            self._loop(opened)
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            for c in opened:
+                c.close()
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            log.debug('event loop exited')
+
+    def _loop(self, captures):
+        live = dict((c.fileno(), c) for c in captures if c.live)
+        offline = [c for c in captures if not c.live]
+        poller = _Poller()
+        poller.register(self._wake_r)
+        for fd in live:
+            poller.register(fd)
+        while (live or offline) and not self._shutdown.is_set():
+            # don't block while saved files still have packets to read
+            timeout = self._interval
+            if offline:
+                timeout = 0
+            for fd in poller.poll(timeout):
+                if fd == self._wake_r:
+                    self._drain()
+                    continue
+                live[fd].dispatch()
+            for c in list(offline):
+                if self._shutdown.is_set():
+                    break
+                if c.dispatch(self._offline_batch) is None:
+                    log.debug('%s: end of file', c.name)
+                    offline.remove(c)
+            if self._housekeeping is not None:
+                self._housekeeping()
+        log.info('shutting down')
+
+class _Poller(object):
+    """minimal wrapper over epoll, falling back to select()
+    """
+    def __init__(self):
+        self._epoll = getattr(select, 'epoll', None)
+        if self._epoll is not None:
+            self._epoll = self._epoll()
+        self._fds = []
+    def register(self, fd):
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+        else:
+            self._fds.append(fd)
+    def poll(self, timeout):
+        try:
+            if self._epoll is not None:
+                return [fd for fd, _ in self._epoll.poll(timeout)]
+            return select.select(self._fds, [], [], timeout)[0]
+        except (IOError, OSError, select.error) as e:
+            # python 2 doesn't retry after a signal handler runs
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
@@ -0,0 +1,323 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+from .decode import Header
+from .dumpfiles import (Dumpfiles, PcapReader, PcapWriter,
+                        partition_filename)
+from .stats import Stats, StatsLoggerThread, add_snapshots, empty_snapshot
+from .util import signal_event
+
+import heapq
+import logging
+import multiprocessing
+import os
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+log = logging.getLogger(__name__)
+
+# from <linux/if_packet.h>
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+fanout_modes = {
+    'hash': 0,
+    'lb': 1,
+    'cpu': 2,
+}
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
+def fanout_arg(group, mode='hash', defrag=True):
+    """value of the PACKET_FANOUT socket option
+
+    In 'hash' mode the kernel picks the socket from a hash of the
+    flow, so both directions of a flow (and, with defrag, all
+    fragments of a datagram) go to the same worker.
+    """
+    type_flags = fanout_modes[mode]
+    if defrag:
+        type_flags |= PACKET_FANOUT_FLAG_DEFRAG
+    return (group & 0xffff) | (type_flags << 16)
+
+def join_fanout(fd, group, mode='hash', defrag=True):
+    """add the AF_PACKET socket fd to a fanout group
+    """
+    # socket.fromfd() duplicates the descriptor, so closing s leaves
+    # fd (owned by libpcap) open
+    s = socket.fromfd(fd, socket.AF_PACKET, socket.SOCK_RAW)
+    try:
+        # the flags can set the sign bit, so pass the value as an
+        # unsigned int rather than a (signed) Python int
+        s.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                     struct.pack('=I', fanout_arg(group, mode, defrag)))
+    finally:
+        s.close()
+
+class SharedQuotas(object):
+    """enforces output quotas on the sum of the workers' stats
+
+    Each worker only sees its share of an output's packets, so on its
+    own it would let the output grow to workers times its quota.  The
+    workers send the quotas of their outputs (see Dumpfiles.quotas())
+    with their stats snapshots; once the summed stats of an output
+    meet its quota, every worker is told to close it through its
+    queue in 'queues' (see stop_outputs()).  An output can overshoot
+    its quota by what the workers save between two reports.
+    """
+    def __init__(self, workers):
+        self.queues = [multiprocessing.Queue() for i in range(workers)]
+        # output filename -> quota
+        self._quotas = {}
+        # outputs whose quota was met
+        self.stopped = set()
+
+    def update(self, quotas, total):
+        """add a worker's quotas and check the summed snapshot total
+        """
+        self._quotas.update(quotas)
+        for name, quota in sorted(self._quotas.items()):
+            node = total['children'].get(name)
+            if name in self.stopped or node is None:
+                continue
+            if node['packets'] >= quota.get('max_packets', float('inf')) \
+               or node['bytes'] >= quota.get('max_bytes', float('inf')):
+                log.info('%s: quota met across workers (%i packets,'
+                         ' %i bytes)', name, node['packets'], node['bytes'])
+                self.stopped.add(name)
+                for q in self.queues:
+                    q.put(name)
+
+def ignore_sighup(hup_event, what):
+    """log a warning if hup_event was set by a SIGHUP, and clear it
+
+    With several worker processes the config can't be swapped in
+    while capturing, so the parent catches SIGHUP (which would
+    otherwise kill it and leave the workers running) and ignores it.
+    """
+    if hup_event.is_set():
+        hup_event.clear()
+        log.warning('ignoring SIGHUP: the config is not reloaded with %s',
+                    what)
+
+def stop_outputs(stop_q, dumpfiles):
+    """close the outputs named in stop_q (see SharedQuotas)
+    """
+    while True:
+        try:
+            filename = stop_q.get_nowait()
+        except queue.Empty:
+            return
+        dumpfiles.stop_output(filename)
+
+def run_fanout(config):
+    """capture with several worker processes sharing each interface
+
+    Each worker opens its own capture handle on every configured
+    interface and joins it to a PACKET_FANOUT group, so the kernel
+    spreads the packets across the workers by flow hash.  Each worker
+    classifies and writes its share into per-worker partition files;
+    once all workers have exited, the partitions of each output are
+    merged in timestamp order (unless 'merge' is False).  Workers
+    send Stats snapshots to this process, which logs their sum and
+    enforces output quotas on it (see SharedQuotas).
+    """
+    fanout = config['fanout']
+    workers = fanout['workers']
+    group = fanout.get('group', os.getpid())
+    for iface in config.get('interfaces', (None,)):
+        if iface is not None and os.path.isfile(iface):
+            raise ValueError('fanout requires live interfaces, not files')
+
+    mp_shutdown = multiprocessing.Event()
+    stats_q = multiprocessing.Queue()
+    shutdown_event = threading.Event()
+    stats = Stats()
+    snapshots = [empty_snapshot() for i in range(workers)]
+    quotas = SharedQuotas(workers)
+    hup_event = threading.Event()
+    procs = []
+    stats_thread = StatsLoggerThread(stats, shutdown_event)
+    stats_thread.start()
+    with signal_event(signal.SIGHUP, hup_event):
+        try:
+            for i in range(workers):
+                p = multiprocessing.Process(
+                    target=_worker, name='fanout.%i' % i,
+                    args=(i, config, group, mp_shutdown, stats_q,
+                          quotas.queues[i]))
+                p.start()
+                procs.append(p)
+            log.info('started %i fanout workers in group %i', workers, group)
+            while any(p.is_alive() for p in procs):
+                try:
+                    i, snap, worker_quotas = stats_q.get(timeout=0.25)
+                except queue.Empty:
+                    pass
+                else:
+                    snapshots[i] = snap
+                    total = snapshots[0]
+                    for other in snapshots[1:]:
+                        total = add_snapshots(total, other)
+                    stats.set_snapshot(total)
+                    quotas.update(worker_quotas, total)
+                ignore_sighup(hup_event, 'fanout')
+                for p in procs:
+                    if p.exitcode not in (None, 0):
+                        raise RuntimeError('fanout worker %s exited with %i'
+                                           % (p.name, p.exitcode))
+        finally:
+            log.info('shutting down')
+            mp_shutdown.set()
+            for p in procs:
+                p.join()
+            shutdown_event.set()
+            stats_thread.join()
+            if fanout.get('merge', True):
+                # the stats tree has one child per output filename
+                outputs = [n for n in stats.snapshot()['children']
+                           if n != '(discard)']
+                for filename in outputs:
+                    parts = [partition_filename(filename, i)
+                             for i in range(workers)]
+                    merge_partitions(filename,
+                                     [p for p in parts if os.path.exists(p)],
+                                     Stats())
+
+def _worker(index, config, group, mp_shutdown, stats_q, stop_q):
+    # the parent handles Ctrl-C and tells the workers to stop, and
+    # ignores SIGHUP (see ignore_sighup())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # avoid circular imports
+    from . import run_threads
+    from .capture import CaptureParams
+
+    fanout = config['fanout']
+    stats = Stats()
+    # checking a multiprocessing.Event costs a semaphore operation, so
+    # the capture threads check a local Event updated below
+    shutdown_event = threading.Event()
+    capture_settings = dict(linktype=None, snaplen=65535)
+    capture_settings.update(config.get('capture', {}))
+    capture_settings['fanout'] = (group, fanout.get('mode', 'hash'))
+    capture_params = CaptureParams(**capture_settings)
+    next_report = [0.0]
+
+    with Dumpfiles(config, capture_params, stats,
+                   partition=index) as dumpfiles:
+        def housekeeping():
+            if mp_shutdown.is_set():
+                shutdown_event.set()
+            dumpfiles.flush_if_due()
+            now = time.time()
+            if now >= next_report[0]:
+                next_report[0] = now + 1.0
+                stop_outputs(stop_q, dumpfiles)
+                stats_q.put((index, stats.snapshot(), dumpfiles.quotas()))
+        try:
+            run_threads(config.get('interfaces', (None,)), shutdown_event,
+                        dumpfiles, capture_params, housekeeping)
+        finally:
+            stats_q.put((index, stats.snapshot(), dumpfiles.quotas()))
+
+def merge_partitions(filename, parts, stats):
+    """merge pcap partition files into filename in timestamp order
+
+    The collection windows of scheduled outputs (the partitions'
+    '.windows' files) are appended to filename's, ordered by start;
+    each worker logs its own, so a window shows up once per worker.
+    The partition files are removed after a successful merge.
+    """
+    if not parts:
+        return
+    readers = [PcapReader(p) for p in parts]
+    linktype, snaplen = readers[0].header
+    log.info('merging %i partition(s) into %s', len(parts), filename)
+    writer = PcapWriter(filename, linktype, snaplen, stats)
+    try:
+        def keyed(i, reader):
+            for rec in reader:
+                yield (rec[0], rec[1], i) + rec[2:]
+        for sec, nsec, i, caplen, length, data in heapq.merge(
+                *[keyed(i, r) for i, r in enumerate(readers)]):
+            writer.write(data, Header(sec, nsec, caplen, length))
+    finally:
+        writer.close()
+        for r in readers:
+            r.close()
+    for p in parts:
+        os.remove(p)
+    windows = [p + '.windows' for p in parts
+               if os.path.exists(p + '.windows')]
+    if windows:
+        lines = []
+        for p in windows:
+            with open(p) as f:
+                lines.extend(f)
+        lines.sort(key=lambda line: float(line.split()[0]))
+        with open(filename + '.windows', 'a') as f:
+            f.writelines(lines)
+        for p in windows:
+            os.remove(p)
+
+class Tests(unittest.TestCase):
+    def test_fanout_arg(self):
+        self.assertEqual(fanout_arg(0x12345, 'hash', True), 0x80002345)
+        self.assertEqual(fanout_arg(7, 'lb', False), 0x10007)
+
+    def test_merge_partitions(self):
+        d = tempfile.mkdtemp()
+        out = os.path.join(d, 'out.pcap')
+        parts = [partition_filename(out, i) for i in range(2)]
+        for i, part in enumerate(parts):
+            w = PcapWriter(part, 1, 65535, Stats())
+            for sec in range(i, 6, 2):
+                # PcapReader stops at an empty record, so none are empty
+                w.write(b'x' * (sec + 1), Header(sec, 0, sec + 1, sec + 1))
+            w.close()
+            with open(part + '.windows', 'w') as f:
+                f.write('%i.000000 %i.000000\n' % (10 - i, 11 - i))
+        merge_partitions(out, parts, Stats())
+        self.assertEqual([rec[0] for rec in PcapReader(out)],
+                         list(range(6)))
+        with open(out + '.windows') as f:
+            self.assertEqual(f.read(), '9.000000 10.000000\n'
+                                       '10.000000 11.000000\n')
+        self.assertFalse(any(os.path.exists(p) or os.path.exists(
+            p + '.windows') for p in parts))
+        os.remove(out)
+        os.remove(out + '.windows')
+        os.rmdir(d)
+
+    def test_shared_quotas(self):
+        quotas = SharedQuotas(2)
+        node = {'packets': 3, 'bytes': 30, 'counters': {}, 'children': {}}
+        share = {'packets': 3, 'bytes': 30, 'counters': {},
+                 'children': {'dns.pcap': node}}
+        quotas.update({'dns.pcap': {'max_packets': 5}}, share)
+        self.assertEqual(quotas.stopped, set())
+        # neither worker is over the quota, but their sum is
+        total = add_snapshots(share, share)
+        quotas.update({}, total)
+        quotas.update({}, total)
+        self.assertEqual(quotas.stopped, set(['dns.pcap']))
+        for q in quotas.queues:
+            self.assertEqual(q.get(timeout=5), 'dns.pcap')
+            self.assertRaises(queue.Empty, q.get, timeout=0.1)
+
+    def test_ignore_sighup(self):
+        hup_event = threading.Event()
+        with signal_event(signal.SIGHUP, hup_event):
+            os.kill(os.getpid(), signal.SIGHUP)
+            self.assertTrue(hup_event.wait(5))
+            ignore_sighup(hup_event, 'fanout')
+            self.assertFalse(hup_event.is_set())
@@ -0,0 +1,217 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""early stop for outputs whose payloads stop adding new n-grams
+
+A NoveltyEstimator hashes the payload n-grams of the packets saved to
+an output, keeps a content-defined sample of the hashes (those whose
+hash is 0 modulo 'sample', so a repeated n-gram is sampled wherever
+it occurs) and looks each sampled hash up in a Bloom filter.  The
+novelty of a window is the fraction of its sampled n-grams that were
+not in the filter yet.  Once 'windows' consecutive windows are below
+the threshold, the output is saturated:  more data would mostly
+repeat what was already saved.
+
+Only one in 'every' payloads is examined.  The hashes are computed
+with NumPy when it is installed; without it the same hashes are
+computed one n-gram at a time, which is much slower.  A Bloom filter
+never forgets, but false positives grow as it fills, which makes
+novelty look lower than it is; the fill (fraction of bits set) is
+logged with each window so that an undersized filter can be spotted.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# multiplier of the polynomial n-gram hash
+_PRIME = 0x01000193
+_MASK = 0xffffffff
+
+def _mix(h):
+    """finalize a 32-bit hash (see MurmurHash3's fmix32)
+    """
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & _MASK
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & _MASK
+    h ^= h >> 16
+    return h
+
+def ngram_hashes(payload, n):
+    """return the mixed 32-bit hashes of every n-gram of payload
+
+    The result is a NumPy uint32 array if NumPy is available, or a
+    list otherwise; the values are the same either way.
+    """
+    if numpy is not None:
+        return _ngram_hashes_numpy(payload, n)
+    data = bytearray(payload)
+    ret = []
+    for i in range(len(data) - n + 1):
+        h = 0
+        for b in data[i:i + n]:
+            h = (h * _PRIME + b) & _MASK
+        ret.append(_mix(h))
+    return ret
+
+def _ngram_hashes_numpy(payload, n):
+    data = numpy.frombuffer(bytes(payload), dtype=numpy.uint8)
+    count = len(data) - n + 1
+    if count <= 0:
+        return numpy.zeros(0, dtype=numpy.uint32)
+    # uint64 so that products don't overflow before masking
+    h = numpy.zeros(count, dtype=numpy.uint64)
+    for j in range(n):
+        h = (h * _PRIME + data[j:j + count]) & _MASK
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & _MASK
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & _MASK
+    h ^= h >> 16
+    return h.astype(numpy.uint32)
+
+class NoveltyEstimator(object):
+    """tracks the fraction of never-seen payload n-grams of an output
+
+    Only one in 'every' payloads passed to add() is examined.  n is
+    the n-gram length in bytes; one in 'sample' n-gram hashes is
+    looked up in a Bloom filter of 'bits' bits with 'hashes' hash
+    functions.  Every 'window' sampled n-grams the window's novelty
+    is appended to 'curve' as a (packets, bytes, novelty, fill)
+    tuple, where packets and bytes are the totals passed to add().
+    'saturated' becomes true once 'windows' consecutive windows have
+    a novelty below 'threshold'.
+    """
+    def __init__(self, n=4, sample=16, bits=1 << 23, hashes=3,
+                 threshold=0.01, window=10000, windows=3, every=4):
+        if min(n, sample, hashes, window, windows, every) < 1 or bits < 8:
+            raise ValueError('novelty settings must be positive')
+        self._every = int(every)
+        self._skipped = 0
+        self._n = int(n)
+        self._sample = int(sample)
+        self._bits = int(bits)
+        self._hashes = int(hashes)
+        self._threshold = float(threshold)
+        self._window = int(window)
+        self._windows = int(windows)
+        self._filter = bytearray((self._bits + 7) // 8)
+        self._set = 0
+        self._seen = 0
+        self._novel = 0
+        self._below = 0
+        self.curve = []
+        self.saturated = False
+
+    @property
+    def fill(self):
+        """fraction of the Bloom filter's bits that are set
+        """
+        return float(self._set) / self._bits
+
+    def add(self, payload, packets, nbytes):
+        """add a saved payload; returns True once saturated
+
+        packets and bytes are the output's totals so far, recorded in
+        the saturation curve.
+        """
+        self._skipped += 1
+        if self._skipped < self._every:
+            return self.saturated
+        self._skipped = 0
+        hashes = ngram_hashes(payload, self._n)
+        if numpy is not None:
+            sampled = numpy.unique(hashes[hashes % self._sample == 0])
+            novel = self._add_numpy(sampled)
+        else:
+            sampled = set(h for h in hashes if h % self._sample == 0)
+            novel = sum(1 for h in sampled if self._add_one(h))
+        self._seen += len(sampled)
+        self._novel += novel
+        if self._seen >= self._window:
+            self._end_window(packets, nbytes)
+        return self.saturated
+
+    def _indexes(self, h):
+        # double hashing:  the hash and a rotation of it
+        h2 = ((h << 16) | (h >> 16)) & _MASK | 1
+        return [(h + i * h2) % self._bits for i in range(self._hashes)]
+
+    def _add_one(self, h):
+        f = self._filter
+        novel = False
+        for i in self._indexes(h):
+            bit = 1 << (i & 7)
+            if not f[i >> 3] & bit:
+                f[i >> 3] |= bit
+                self._set += 1
+                novel = True
+        return novel
+
+    def _add_numpy(self, sampled):
+        if not len(sampled):
+            return 0
+        f = numpy.frombuffer(self._filter, dtype=numpy.uint8)
+        h = sampled.astype(numpy.uint64)
+        h2 = ((h << 16) | (h >> 16)) & _MASK | 1
+        missing = numpy.zeros(len(h), dtype=bool)
+        for i in range(self._hashes):
+            idx = (h + i * h2) % self._bits
+            unset = (f[idx >> 3] >> (idx & 7)).astype(numpy.uint8) & 1 == 0
+            missing |= unset
+            new = numpy.unique(idx[unset])
+            self._set += len(new)
+            numpy.bitwise_or.at(
+                f, new >> 3, numpy.left_shift(1, new & 7).astype(numpy.uint8))
+        return int(missing.sum())
+
+    def _end_window(self, packets, nbytes):
+        novelty = float(self._novel) / self._seen
+        self.curve.append((packets, nbytes, novelty, self.fill))
+        log.debug('novelty %.4f after %i packets (%i bytes), filter %.1f%%'
+                  ' full', novelty, packets, nbytes, 100 * self.fill)
+        self._seen = self._novel = 0
+        if novelty < self._threshold:
+            self._below += 1
+            if self._below >= self._windows:
+                self.saturated = True
+        else:
+            self._below = 0
+
+    def log_curve(self, name):
+        """log the saturation curve
+        """
+        log.info('%s: novelty by window (packets, bytes, novelty,'
+                 ' filter fill):', name)
+        for packets, nbytes, novelty, fill in self.curve:
+            log.info('  %i %i %.4f %.3f', packets, nbytes, novelty, fill)
+
+class Tests(unittest.TestCase):
+    def test_hashes(self):
+        data = b'abcabcabcx'
+        hashes = list(ngram_hashes(data, 3))
+        self.assertEqual(len(hashes), 8)
+        self.assertEqual(hashes[0], hashes[3])
+        self.assertNotEqual(hashes[0], hashes[1])
+        h = 0
+        for b in bytearray(b'abc'):
+            h = (h * _PRIME + b) & _MASK
+        self.assertEqual(hashes[0], _mix(h))
+
+    def test_saturation(self):
+        e = NoveltyEstimator(n=4, sample=1, bits=1 << 16, window=30,
+                             windows=2, threshold=0.05, every=1)
+        text = b'the quick brown fox jumps over the lazy dog'
+        self.assertFalse(e.add(text, 1, len(text)))
+        for i in range(5):
+            e.add(text, i + 2, len(text) * (i + 2))
+        self.assertTrue(e.saturated)
+        self.assertEqual(e.curve[0][2], 1.0)
+        self.assertEqual(e.curve[-1][2], 0.0)
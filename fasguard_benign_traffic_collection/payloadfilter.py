@@ -0,0 +1,109 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+from .decode import Header
+
+import collections
+import logging
+import math
+import os
+import unittest
+
+log = logging.getLogger(__name__)
+
+# TLS record content type and protocol major version of encrypted
+# application data records (the handshake, content type 22, is kept
+# because it carries plaintext such as the server name)
+TLS_APPLICATION_DATA = 0x17
+TLS_MAJOR_VERSION = 0x03
+
+def byte_entropy(data):
+    """return the Shannon entropy of the bytes in data, in bits per byte
+    """
+    n = len(data)
+    if not n:
+        return 0.0
+    counts = collections.Counter(bytearray(data)).values()
+    return math.log(n, 2) - sum(c * math.log(c, 2) for c in counts) / n
+
+def is_tls_application_data(payload):
+    """True if payload starts with a TLS application data record header
+    """
+    if len(payload) < 5:
+        return False
+    content_type, major, minor = bytearray(payload[0:3])
+    # minor versions 0 (SSL 3.0) through 4 (TLS 1.3)
+    return content_type == TLS_APPLICATION_DATA \
+        and major == TLS_MAJOR_VERSION and minor <= 4
+
+class PayloadFilter(object):
+    """keeps ciphertext and other high-entropy payloads off the disk
+
+    A payload is rejected if it starts with a TLS application data
+    record header (if tls is true), or if the byte entropy of its
+    first 'prefix' bytes exceeds max_entropy bits per byte.  Payloads
+    shorter than min_length bytes are always accepted, because the
+    entropy of a short sample is too noisy to judge.  Note that even
+    uniformly random bytes only reach about 7.2 bits per byte in a
+    256-byte sample.
+
+    Rejected packets are dropped if action is 'drop', or cut to the
+    first 'keep' payload bytes (keeping all headers) if action is
+    'truncate'.
+    """
+    actions = ('drop', 'truncate')
+
+    def __init__(self, max_entropy=6.5, prefix=256, min_length=32,
+                 tls=True, action='drop', keep=0):
+        if action not in self.actions:
+            raise ValueError('unknown payload filter action: '
+                             + repr(action))
+        self._max_entropy = float(max_entropy)
+        self._prefix = int(prefix)
+        self._min_length = int(min_length)
+        self._tls = bool(tls)
+        self._truncate = action == 'truncate'
+        self._keep = int(keep)
+
+    def accepts(self, payload):
+        if self._tls and is_tls_application_data(payload):
+            return False
+        if len(payload) < self._min_length:
+            return True
+        return byte_entropy(payload[:self._prefix]) <= self._max_entropy
+
+    def apply(self, packet, header, decoded):
+        """filter one packet
+
+        Returns (packet, header, accepted), or None if the packet is
+        to be dropped.  Packets without a payload are accepted.
+        """
+        if decoded is None or decoded.payload is None \
+           or decoded.payload >= len(packet):
+            return (packet, header, True)
+        if self.accepts(packet[decoded.payload:]):
+            return (packet, header, True)
+        if not self._truncate:
+            return None
+        end = decoded.payload + self._keep
+        if end < len(packet):
+            packet = packet[:end]
+            header = Header(header.sec, header.nsec, end, header.len)
+        return (packet, header, False)
+
+class Tests(unittest.TestCase):
+    def test_entropy(self):
+        self.assertEqual(byte_entropy(b'aaaa'), 0.0)
+        self.assertAlmostEqual(byte_entropy(bytearray(range(256))), 8.0)
+
+    def test_filter(self):
+        text = b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        random = os.urandom(300)
+        tls = b'\x17\x03\x03\x00\x20' + b'a' * 32
+        f = PayloadFilter()
+        self.assertTrue(f.accepts(text))
+        self.assertFalse(f.accepts(random))
+        self.assertFalse(f.accepts(tls))
+        self.assertTrue(f.accepts(random[:16]))
+        self.assertTrue(PayloadFilter(tls=False).accepts(tls))
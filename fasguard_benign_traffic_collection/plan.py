@@ -0,0 +1,313 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""collection planning from a traffic rate analysis (--plan)
+
+A rate report (the file written by the 'analysis' config, see
+sketch.py) gives packet and byte counts per service over a known
+number of seconds.  Scaling those rates to the planned number of
+hours gives the traffic each service is expected to produce, which
+determines the size of the service's Bloom filter for a target false
+positive rate, the quota of its output and the disk space needed.
+
+plan_services() does the scaling, suggest_config() turns the result
+into an 'outputs' and 'output_options' config with one output and
+quota per service, and evaluate() checks a processed config against
+the expected traffic:  how much each output will hold (after
+quotas), the disk space that needs and the free space available, and
+the number of files each process will have open against its limit.
+Nothing is opened or captured.
+"""
+
+from __future__ import absolute_import
+
+from .config import config_handle_output_options, config_handle_outputs
+from .dumpfiles import (output_for_service, pcap_file_header,
+                        pcap_record_header)
+from .sketch import ServiceSketch
+
+import collections
+import logging
+import math
+import os
+import pprint
+import unittest
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# descriptors a collector holds besides its inputs and outputs
+# (standard streams, log files, sockets, ...)
+FD_MARGIN = 16
+
+ServicePlan = collections.namedtuple('ServicePlan', [
+    'service', 'packets', 'bytes', 'captured_bytes', 'bloom_bits',
+    'bloom_hashes',
+])
+
+def bloom_size(items, fp_rate):
+    """return (bits, hashes) of a Bloom filter for items at fp_rate
+    """
+    if items <= 0:
+        return (0, 0)
+    bits = int(math.ceil(-items * math.log(fp_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(float(bits) / items * math.log(2))))
+    return (bits, hashes)
+
+def plan_services(sketch, hours, fp_rate, snaplen=65535):
+    """return a ServicePlan for each service in a ServiceSketch
+
+    packets and bytes (original packet lengths) are scaled from the
+    sketch's observation time to hours; captured_bytes is what is
+    left after truncation to snaplen.  The Bloom filter of a service
+    is sized for one n-gram per byte, which bounds the number of
+    distinct n-grams from above.  Only the services tracked by the
+    sketch (its top-k tables) are planned.
+    """
+    if sketch.seconds <= 0:
+        raise ValueError('the rate report covers no time')
+    scale = hours * 3600.0 / sketch.seconds
+    plans = []
+    for service, packets, nbytes, _, _ in sketch.report():
+        if not packets:
+            continue
+        packets = int(math.ceil(packets * scale))
+        nbytes = int(math.ceil(nbytes * scale))
+        captured = min(float(nbytes) / packets, snaplen) * packets
+        bits, hashes = bloom_size(nbytes, fp_rate)
+        plans.append(ServicePlan(service, packets, nbytes, int(captured),
+                                 bits, hashes))
+    return plans
+
+def service_name(service):
+    """a filename-friendly name for a service description tuple
+    """
+    names = {0x800: 'ipv4', 0x86dd: 'ipv6', 0x806: 'arp'}
+    parts = [names.get(service[0], 'ethertype%#x' % service[0])]
+    if len(service) > 1:
+        parts.append({6: 'tcp', 17: 'udp'}.get(service[1],
+                                               'proto%i' % service[1]))
+    if len(service) > 2:
+        parts.append('fragment' if service[2] == -1 else str(service[2]))
+    return '-'.join(parts)
+
+def _protomatch(service):
+    names = {0x800: 'ipv4', 0x86dd: 'ipv6', 0x806: 'arp'}
+    ret = [names.get(service[0], service[0])]
+    if len(service) > 1:
+        ret.append({6: 'tcp', 17: 'udp'}.get(service[1], service[1]))
+    if len(service) > 2:
+        ret.append('fragment' if service[2] == -1 else service[2])
+    return tuple(ret)
+
+def suggest_config(plans, directory=''):
+    """return raw 'outputs' and 'output_options' settings for plans
+
+    Each service gets its own output file in directory, with a
+    max_bytes quota of its expected bytes.
+    """
+    outputs = []
+    options = []
+    for p in plans:
+        filename = os.path.join(directory, service_name(p.service) + '.pcap')
+        outputs.append((filename, (_protomatch(p.service),)))
+        options.append((filename, {'max_bytes': p.bytes}))
+    return {'outputs': outputs, 'output_options': options}
+
+def format_config(raw):
+    """return raw config settings as config file text
+    """
+    return pprint.pformat(raw) + '\n'
+
+def compile_config(config, raw):
+    """return config with the raw settings in raw processed and added
+    """
+    ret = dict(config)
+    ret['outputs'] = config_handle_outputs(raw['outputs'])
+    ret['output_options'] = config_handle_output_options(
+        raw['output_options'])
+    return ret
+
+def evaluate(config, plans):
+    """check a processed config against the expected traffic
+
+    Returns a dict with:
+      * 'outputs':  filename -> {'packets', 'bytes', 'disk', 'quota'}
+        with the packets and bytes each output is expected to save
+        (capped by its quotas) and the disk space that takes
+      * 'discarded':  expected bytes of services without an output
+      * 'disk':  directory -> (bytes needed, bytes free or None)
+      * 'open_files':  descriptors needed per process
+      * 'open_files_limit':  the soft RLIMIT_NOFILE, or None
+      * 'problems':  list of messages about needs exceeding limits
+    """
+    outputs = {}
+    discarded = 0
+    options = config.get('output_options', {})
+    for p in plans:
+        try:
+            filename, pattern = output_for_service(config, p.service)
+        except KeyError:
+            discarded += p.bytes
+            continue
+        out = outputs.setdefault(filename, {
+            'packets': 0, 'bytes': 0, 'captured': 0,
+            'quota': options.get(pattern, {}),
+        })
+        out['packets'] += p.packets
+        out['bytes'] += p.bytes
+        out['captured'] += p.captured_bytes
+    disk = {}
+    workers = max(config.get('fanout', {}).get('workers', 1),
+                  config.get('ring', {}).get('workers', 1))
+    merge = config.get('fanout', config.get('ring', {})).get('merge', False)
+    for filename, out in outputs.items():
+        scale = 1.0
+        quota = out['quota']
+        if out['packets'] and quota.get('max_packets') is not None:
+            scale = min(scale, float(quota['max_packets']) / out['packets'])
+        if out['bytes'] and quota.get('max_bytes') is not None:
+            scale = min(scale, float(quota['max_bytes']) / out['bytes'])
+        captured = out.pop('captured')
+        out['packets'] = int(out['packets'] * scale)
+        out['bytes'] = int(out['bytes'] * scale)
+        out['disk'] = pcap_file_header.size + int(
+            scale * captured) + out['packets'] * pcap_record_header.size
+        if workers > 1:
+            out['disk'] += (workers - 1) * pcap_file_header.size
+            if merge:
+                # the partitions and the merged file exist at once
+                out['disk'] *= 2
+        directory = os.path.dirname(os.path.abspath(filename))
+        disk.setdefault(directory, [0, None])[0] += out['disk']
+    problems = []
+    for directory, need in disk.items():
+        need[1] = _free_space(directory)
+        if need[1] is not None and need[0] > need[1]:
+            problems.append('%s needs %i bytes but has %i free'
+                            % (directory, need[0], need[1]))
+        disk[directory] = tuple(need)
+    inputs = len(config.get('interfaces', (None,)))
+    open_files = inputs + len(outputs) + FD_MARGIN
+    limit = None
+    if resource is not None:
+        limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if limit == resource.RLIM_INFINITY:
+            limit = None
+    if limit is not None and open_files > limit:
+        problems.append('%i open files needed per process but the limit'
+                        ' is %i (see ulimit -n)' % (open_files, limit))
+    return {
+        'outputs': outputs,
+        'discarded': discarded,
+        'disk': disk,
+        'open_files': open_files,
+        'open_files_limit': limit,
+        'problems': problems,
+    }
+
+def _free_space(directory):
+    # the directory may not exist yet; check the nearest one that does
+    while not os.path.isdir(directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+    try:
+        st = os.statvfs(directory)
+    except (AttributeError, OSError):
+        return None
+    return st.f_bavail * st.f_frsize
+
+def log_lines(plans, hours, fp_rate):
+    lines = ['plan for %g hours, Bloom filter false positive rate %g:'
+             % (hours, fp_rate)]
+    for p in plans:
+        lines.append('  %s: ~%i packets (~%i bytes), Bloom filter %i bits'
+                     ' (%i bytes), %i hashes' % (
+                         service_name(p.service), p.packets, p.bytes,
+                         p.bloom_bits, (p.bloom_bits + 7) // 8,
+                         p.bloom_hashes))
+    return lines
+
+def evaluation_lines(evaluation):
+    lines = []
+    for filename in sorted(evaluation['outputs']):
+        out = evaluation['outputs'][filename]
+        lines.append('  output %s: ~%i packets (~%i bytes), ~%i bytes on'
+                     ' disk' % (filename, out['packets'], out['bytes'],
+                                out['disk']))
+    if evaluation['discarded']:
+        lines.append('  ~%i bytes of traffic have no output'
+                     % evaluation['discarded'])
+    for directory in sorted(evaluation['disk']):
+        need, free = evaluation['disk'][directory]
+        lines.append('  disk %s: %i bytes needed, %s free' % (
+            directory, need, 'unknown' if free is None else '%i' % free))
+    lines.append('  open files per process: %i needed, limit %s' % (
+        evaluation['open_files'],
+        'unknown' if evaluation['open_files_limit'] is None
+        else evaluation['open_files_limit']))
+    return lines
+
+def plan(config, report, hours, fp_rate):
+    """plan a collection from the rate report in file report
+
+    Logs the plan and an evaluation of the suggested outputs (merged
+    into config) and, if config has its own 'outputs', of config
+    as is.  Returns (suggested config text, list of problems).
+    """
+    sketch = ServiceSketch.load(report)
+    snaplen = config.get('capture', {}).get('snaplen', 65535)
+    plans = plan_services(sketch, hours, fp_rate, snaplen)
+    for line in log_lines(plans, hours, fp_rate):
+        log.info(line)
+    raw = suggest_config(plans)
+    problems = []
+    configs = [('suggested', compile_config(config, raw))]
+    if 'outputs' in config:
+        configs.append(('current', config))
+    for name, c in configs:
+        evaluation = evaluate(c, plans)
+        log.info('%s config:', name)
+        for line in evaluation_lines(evaluation):
+            log.info(line)
+        for problem in evaluation['problems']:
+            log.warning('%s config: %s', name, problem)
+            problems.append(problem)
+    return format_config(raw), problems
+
+class Tests(unittest.TestCase):
+    def test_bloom_size(self):
+        bits, hashes = bloom_size(1000, 0.01)
+        self.assertEqual((bits, hashes), (9586, 7))
+        self.assertEqual(bloom_size(0, 0.01), (0, 0))
+
+    def test_plan(self):
+        from .decode import Decoded
+        sketch = ServiceSketch(256, 2, 10, 8)
+        pkt = b'\x00' * 12 + b'\x0a\x00\x00\x01\x0a\x00\x00\x02'
+        for i in range(10):
+            sketch.update(pkt, 100, Decoded((0x800, 6, 80), 0, 20, 40))
+        sketch.update(pkt, 60, Decoded((0x86dd, 17, 53), 0, 40, 48))
+        sketch.seconds = 360.0
+        plans = plan_services(sketch, 1, 0.01)
+        self.assertEqual([(p.service, p.packets, p.bytes) for p in plans],
+                         [((0x800, 6, 80), 100, 10000),
+                          ((0x86dd, 17, 53), 10, 600)])
+        raw = suggest_config(plans, '/nonexistent')
+        self.assertEqual(raw['outputs'][0], (
+            '/nonexistent/ipv4-tcp-80.pcap', (('ipv4', 'tcp', 80),)))
+        config = compile_config({'interfaces': ['eth0']}, raw)
+        # only the web traffic is saved, and only half of it
+        config['outputs'] = config_handle_outputs(raw['outputs'][:1])
+        config['output_options'] = config_handle_output_options(
+            [('/nonexistent/ipv4-tcp-80.pcap', {'max_bytes': 5000})])
+        e = evaluate(config, plans)
+        out = e['outputs']['/nonexistent/ipv4-tcp-80.pcap']
+        self.assertEqual((out['packets'], out['bytes']), (50, 5000))
+        self.assertEqual(out['disk'], 24 + 5000 + 50 * 16)
+        self.assertEqual(e['discarded'], 600)
+        self.assertEqual(e['open_files'], 1 + 1 + FD_MARGIN)
@@ -0,0 +1,314 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+from .decode import Decoded, Header
+
+import collections
+import logging
+import struct
+import threading
+import time
+import unittest
+
+log = logging.getLogger(__name__)
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+# bytes charged to the memory cap for each flow on top of its data
+FLOW_OVERHEAD = 256
+
+_u16 = struct.Struct('!H')
+_u32 = struct.Struct('!I')
+
+def _seq_diff(a, b):
+    """return a - b in 32-bit sequence number space
+    """
+    d = (a - b) & 0xffffffff
+    return d - 0x100000000 if d & 0x80000000 else d
+
+class _Flow(object):
+    __slots__ = ('sink', 'stats', 'depth', 'next_seq', 'data', 'template',
+                 'ahead', 'ahead_bytes', 'delivered', 'last_seen')
+
+    def __init__(self, sink, stats, depth, next_seq):
+        self.sink = sink
+        self.stats = stats
+        self.depth = depth
+        self.next_seq = next_seq
+        # contiguous bytes not emitted yet, and (headers up to the
+        # payload, pcap header, decoded) of the segment they start in
+        self.data = bytearray()
+        self.template = None
+        # sequence number -> payload of segments beyond a gap
+        self.ahead = {}
+        self.ahead_bytes = 0
+        # bytes emitted or buffered so far
+        self.delivered = 0
+        self.last_seen = 0.0
+
+class Reassembler(object):
+    """bounded-memory reassembly of TCP payloads into stream chunks
+
+    Segments are tracked per flow direction (addresses and ports).
+    In-order payload bytes are appended to the flow's buffer;
+    retransmitted bytes (anything before the next expected sequence
+    number) are dropped and counted in the 'retransmitted_bytes'
+    counter.  Segments beyond a gap are held until the gap is filled;
+    if more than 'chunk' bytes pile up behind a gap, the gap is given
+    up on and counted in 'gap_bytes'.  Only the first 'depth' bytes
+    of each flow direction are kept ('depth_skipped_bytes' counts the
+    rest).
+
+    The buffer is emitted as one chunk once it holds 'chunk' bytes,
+    when the flow ends (FIN or RST), after 'idle' seconds without a
+    segment (see flush_idle()), and when the flow is evicted:  the
+    flows' buffered data plus FLOW_OVERHEAD per flow is limited to
+    'memory' bytes, and the least recently active flows are evicted
+    (counted in 'evicted_flows') to stay under it.  A chunk is a
+    packet made of the headers of the segment the chunk starts in
+    followed by the chunk, with the IP length field adjusted (but not
+    the checksums); its timestamp is that segment's.
+
+    add() and the flush methods return the chunks as a list of (sink,
+    packet, header, decoded) tuples, where sink is the object passed
+    to add() for the flow.  Counters go to the stats passed to add().
+    """
+    def __init__(self, memory=64 << 20, depth=1 << 20, chunk=16384,
+                 idle=30.0):
+        self._memory_cap = memory
+        self._depth = depth
+        self._chunk = chunk
+        self._idle = idle
+        self._memory = 0
+        # flow key -> _Flow, least recently active first
+        self._flows = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def memory(self):
+        return self._memory
+
+    def __len__(self):
+        return len(self._flows)
+
+    def add(self, sink, stats, packet, header, decoded, depth=None):
+        """add a TCP segment (with decoded.payload not None)
+        """
+        l3, l4, off = decoded.l3, decoded.l4, decoded.payload
+        if len(packet) < l4 + 14:
+            return []
+        if decoded.service[0] == 0x800:
+            addresses = packet[l3 + 12:l3 + 20]
+        else:
+            addresses = packet[l3 + 8:l3 + 40]
+        key = bytes(addresses) + bytes(packet[l4:l4 + 4])
+        seq = _u32.unpack_from(packet, l4 + 4)[0]
+        flags = bytearray(packet[l4 + 13:l4 + 14])[0]
+        payload = bytes(packet[off:])
+        now = time.time()
+        out = []
+        with self._lock:
+            flow = self._flows.pop(key, None)
+            if flow is None:
+                if flags & TCP_RST:
+                    return []
+                flow = _Flow(sink, stats,
+                             self._depth if depth is None else depth,
+                             (seq + 1) & 0xffffffff if flags & TCP_SYN
+                             else seq)
+                self._memory += FLOW_OVERHEAD
+            else:
+                if flags & TCP_SYN:
+                    # the SYN itself takes a sequence number
+                    seq = (seq + 1) & 0xffffffff
+            self._flows[key] = flow
+            flow.last_seen = now
+            if payload:
+                template = (bytes(packet[:off]), header, decoded)
+                self._segment(flow, seq, payload, template, out)
+            if header.caplen < header.len:
+                # the rest of the segment wasn't captured; what
+                # follows can't be contiguous with the buffer
+                self._emit(flow, out)
+                flow.next_seq = (seq + header.len - off) & 0xffffffff
+            if flags & (TCP_FIN | TCP_RST):
+                self._remove(key, flow, out)
+            self._evict(key, out)
+        return out
+
+    def _segment(self, flow, seq, payload, template, out):
+        d = _seq_diff(seq, flow.next_seq)
+        if d < 0:
+            skip = min(-d, len(payload))
+            flow.stats.count('retransmitted_bytes', skip)
+            payload = payload[skip:]
+            seq = (seq + skip) & 0xffffffff
+            if not payload:
+                return
+        elif d > 0:
+            if seq not in flow.ahead \
+               and flow.delivered + d < flow.depth:
+                flow.ahead[seq] = (payload, template)
+                flow.ahead_bytes += len(payload)
+                self._memory += len(payload)
+            if flow.ahead_bytes > self._chunk:
+                self._skip_gap(flow, out)
+            return
+        self._append(flow, payload, template, out)
+        # segments held behind the gap may be contiguous now
+        while flow.ahead:
+            seq = min(flow.ahead, key=lambda s: _seq_diff(s, flow.next_seq))
+            if _seq_diff(seq, flow.next_seq) > 0:
+                break
+            payload, template = self._pop_ahead(flow, seq)
+            skip = -_seq_diff(seq, flow.next_seq)
+            if skip:
+                flow.stats.count('retransmitted_bytes',
+                                 min(skip, len(payload)))
+            if skip < len(payload):
+                self._append(flow, payload[skip:], template, out)
+
+    def _pop_ahead(self, flow, seq):
+        payload, template = flow.ahead.pop(seq)
+        flow.ahead_bytes -= len(payload)
+        self._memory -= len(payload)
+        return payload, template
+
+    def _skip_gap(self, flow, out):
+        self._emit(flow, out)
+        seq = min(flow.ahead, key=lambda s: _seq_diff(s, flow.next_seq))
+        gap = _seq_diff(seq, flow.next_seq)
+        flow.stats.count('gap_bytes', gap)
+        flow.delivered += gap
+        flow.next_seq = seq
+        payload, template = self._pop_ahead(flow, seq)
+        self._segment(flow, seq, payload, template, out)
+
+    def _append(self, flow, payload, template, out):
+        flow.next_seq = (flow.next_seq + len(payload)) & 0xffffffff
+        room = flow.depth - flow.delivered
+        if room < len(payload):
+            flow.stats.count('depth_skipped_bytes',
+                             len(payload) - max(room, 0))
+            payload = payload[:max(room, 0)]
+        if not payload:
+            return
+        if not flow.data:
+            flow.template = template
+        flow.data += payload
+        flow.delivered += len(payload)
+        self._memory += len(payload)
+        limit = min(self._chunk, 0xffff - len(template[0]))
+        if len(flow.data) >= limit:
+            self._emit(flow, out)
+
+    def _emit(self, flow, out):
+        if not flow.data:
+            return
+        headers, template_header, decoded = flow.template
+        packet = bytearray(headers)
+        packet += flow.data
+        l3 = decoded.l3
+        # fix up the IP length so the chunk parses as a packet
+        length = len(packet) - l3
+        if decoded.service[0] == 0x800:
+            _u16.pack_into(packet, l3 + 2, min(length, 0xffff))
+        else:
+            _u16.pack_into(packet, l3 + 4, min(length - 40, 0xffff))
+        self._memory -= len(flow.data)
+        flow.data = bytearray()
+        flow.template = None
+        out.append((flow.sink, bytes(packet),
+                    Header(template_header.sec, template_header.nsec,
+                           len(packet), len(packet)),
+                    Decoded(decoded.service, l3, decoded.l4, len(headers))))
+
+    def _remove(self, key, flow, out):
+        self._emit(flow, out)
+        if flow.ahead_bytes:
+            flow.stats.count('gap_bytes', flow.ahead_bytes)
+            self._memory -= flow.ahead_bytes
+        self._memory -= FLOW_OVERHEAD
+        del self._flows[key]
+
+    def _evict(self, keep, out):
+        while self._memory > self._memory_cap and len(self._flows) > 1:
+            key = next(iter(self._flows))
+            if key == keep:
+                # move the current flow to the end and try the next
+                self._flows[key] = self._flows.pop(key)
+                key = next(iter(self._flows))
+            flow = self._flows[key]
+            flow.stats.count('evicted_flows')
+            self._remove(key, flow, out)
+
+    def flush_idle(self, now=None):
+        """emit and forget flows idle for more than 'idle' seconds
+        """
+        if now is None:
+            now = time.time()
+        out = []
+        with self._lock:
+            while self._flows:
+                key, flow = next(iter(self._flows.items()))
+                if now - flow.last_seen < self._idle:
+                    break
+                self._remove(key, flow, out)
+        return out
+
+    def flush_all(self):
+        """emit and forget every flow
+        """
+        return self.flush_idle(float('inf'))
+
+class Tests(unittest.TestCase):
+    class FakeStats(object):
+        def __init__(self):
+            self.counters = {}
+        def count(self, counter, n=1):
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @staticmethod
+    def _segment(seq, payload, flags=0x10):
+        ip = bytearray(b'\x45\x00\x00\x00\x00\x01\x00\x00\x40\x06\x00\x00'
+                       b'\x0a\x00\x00\x01\x0a\x00\x00\x02')
+        tcp = bytearray(b'\xc0\x00\x00\x50' + _u32.pack(seq) + b'\0' * 4
+                        + b'\x50' + bytearray([flags]) + b'\x20\x00'
+                        + b'\0' * 4)
+        packet = bytes(ip + tcp) + payload
+        return (packet, Header(seq, 0, len(packet), len(packet)),
+                Decoded((0x800, 6, 80), 0, 20, 40))
+
+    def test_reassemble(self):
+        r = Reassembler(chunk=1000)
+        stats = self.FakeStats()
+        out = []
+        for seq, payload, flags in [(99, b'', 0x02), (100, b'abc', 0x10),
+                                    (106, b'ghi', 0x10),
+                                    (100, b'abc', 0x10),
+                                    (103, b'def', 0x10),
+                                    (109, b'', 0x11)]:
+            out += r.add('sink', stats, *self._segment(seq, payload, flags))
+        self.assertEqual(len(out), 1)
+        sink, packet, header, decoded = out[0]
+        self.assertEqual(packet[decoded.payload:], b'abcdefghi')
+        self.assertEqual(_u16.unpack_from(packet, 2)[0], 49)
+        self.assertEqual(header.sec, 100)
+        self.assertEqual(stats.counters, {'retransmitted_bytes': 3})
+        self.assertEqual((len(r), r.memory), (0, 0))
+
+    def test_depth_and_eviction(self):
+        r = Reassembler(memory=FLOW_OVERHEAD + 10, depth=4)
+        stats = self.FakeStats()
+        self.assertEqual(r.add('a', stats, *self._segment(0, b'abcdef')),
+                         [])
+        self.assertEqual(stats.counters, {'depth_skipped_bytes': 2})
+        # a second flow pushes the first one out
+        packet, header, decoded = self._segment(0, b'xy')
+        packet = packet[:12] + b'\x0b' + packet[13:]
+        out = r.add('b', stats, packet, header, decoded)
+        self.assertEqual([(o[0], o[1][40:]) for o in out], [('a', b'abcd')])
+        self.assertEqual(stats.counters['evicted_flows'], 1)
+        self.assertEqual(len(r), 1)
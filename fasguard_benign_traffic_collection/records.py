@@ -0,0 +1,267 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""payload record segment files
+
+The 'records' writer (see dumpfiles.RecordWriter) saves only what the
+n-gram extraction needs from each packet:  the service description,
+the capture timestamp and the L4 payload.  Records are appended to
+segment files named by segment_filename(); a new segment is started
+once the current one reaches the configured size, and every run
+starts a new segment instead of appending to an old one.
+
+A segment starts with the segment header (magic and version) and is
+followed by records.  Each record is a record header (payload length,
+timestamp in nanoseconds since the epoch, ethertype, IP protocol and
+port) followed by the payload bytes.  Packets without an L4 payload
+are not recorded.  When a segment is closed, a footer index is added:
+the offset of every record header as a 32-bit integer, followed by
+the footer trailer (offset of the index, number of records, magic).
+Everything is little-endian.
+
+A segment that was never closed (e.g., after a crash) has no footer;
+RecordReader then finds the records by scanning, stopping at the
+first partial or zero-length record.
+"""
+
+from __future__ import absolute_import
+
+import array
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SEGMENT_MAGIC = b'FGPR'
+FOOTER_MAGIC = b'FGPX'
+SEGMENT_VERSION = 1
+segment_header = struct.Struct('<4sI')
+record_header = struct.Struct('<IQHHi')
+footer_trailer = struct.Struct('<QI4s')
+# stand-ins for the parts of a service description that don't apply
+NO_PROTO = 0xffff
+NO_PORT = -2
+
+if numpy is not None:
+    record_dtype = numpy.dtype([
+        ('length', '<u4'),
+        ('timestamp', '<u8'),
+        ('ethertype', '<u2'),
+        ('proto', '<u2'),
+        ('port', '<i4'),
+    ])
+
+def segment_filename(filename, n):
+    return '%s.%06i' % (filename, n)
+
+def pack_record_header(service, timestamp, length):
+    """return the record header for a payload of a service
+    """
+    ethertype, proto, port = \
+        tuple(service) + (NO_PROTO, NO_PORT)[len(service) - 1:]
+    return record_header.pack(length, timestamp, ethertype, proto, port)
+
+def _service(ethertype, proto, port):
+    if proto == NO_PROTO:
+        return (ethertype,)
+    if port == NO_PORT:
+        return (ethertype, proto)
+    return (ethertype, proto, port)
+
+def offsets_to_bytes(offsets):
+    """return an array of record offsets in footer index byte order
+    """
+    if sys.byteorder != 'little':
+        offsets = array.array(offsets.typecode, offsets)
+        offsets.byteswap()
+    return offsets.tobytes() if hasattr(offsets, 'tobytes') \
+        else offsets.tostring()
+
+class RecordReader(object):
+    """read the records of one segment file through an mmap
+
+    Iterating yields (service, timestamp, payload) tuples, where
+    timestamp is in nanoseconds and payload is a zero-copy view of
+    the mapped file (a memoryview, or a buffer on Python 2) that is
+    only valid until close().  arrays() returns the whole segment as
+    NumPy arrays for batched processing.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < segment_header.size:
+                raise IOError('%s: truncated segment header' % filename)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version = segment_header.unpack_from(self._mm, 0)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                raise IOError('%s: not a payload record segment' % filename)
+            self._index = self._read_footer(size)
+            #: True if the segment was closed properly
+            self.complete = self._index is not None
+            if self._index is not None:
+                offset, count = self._index
+                self.offsets = array.array('I')
+                raw = self._mm[offset:offset + 4 * count]
+                if hasattr(self.offsets, 'frombytes'):
+                    self.offsets.frombytes(raw)
+                else:
+                    self.offsets.fromstring(raw)
+                if sys.byteorder != 'little':
+                    self.offsets.byteswap()
+            else:
+                self.offsets = self._scan(size)
+        except:
+            self._mm.close()
+            raise
+        try:
+            self._view = memoryview(self._mm)
+        except TypeError:
+            # Python 2's mmap only has the old buffer interface
+            self._view = None
+
+    def _read_footer(self, size):
+        if size < segment_header.size + footer_trailer.size:
+            return None
+        offset, count, magic = footer_trailer.unpack_from(
+            self._mm, size - footer_trailer.size)
+        if magic != FOOTER_MAGIC \
+           or offset + 4 * count + footer_trailer.size != size:
+            return None
+        return (offset, count)
+
+    def _scan(self, size):
+        offsets = array.array('I')
+        off = segment_header.size
+        while off + record_header.size <= size:
+            length = record_header.unpack_from(self._mm, off)[0]
+            end = off + record_header.size + length
+            # zero length marks zeroed preallocated space
+            if not length or end > size:
+                break
+            offsets.append(off)
+            off = end
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _payload(self, start, length):
+        if self._view is not None:
+            return self._view[start:start + length]
+        return buffer(self._mm, start, length)
+
+    def __iter__(self):
+        for off in self.offsets:
+            length, timestamp, ethertype, proto, port = \
+                record_header.unpack_from(self._mm, off)
+            yield (_service(ethertype, proto, port), timestamp,
+                   self._payload(off + record_header.size, length))
+
+    def arrays(self):
+        """return the segment as a dict of NumPy arrays
+
+        'buffer' is a uint8 array over the whole mapped file, and
+        'offsets' and 'lengths' locate each record's payload in it;
+        'timestamp', 'ethertype', 'proto' and 'port' hold the other
+        record header fields (see NO_PROTO and NO_PORT).  The record
+        headers are gathered with a single fancy-indexing operation,
+        and no payload bytes are copied.
+        """
+        if numpy is None:
+            raise ImportError('RecordReader.arrays() requires numpy')
+        buf = numpy.frombuffer(self._mm, dtype=numpy.uint8)
+        if self._index is not None:
+            offset, count = self._index
+            offsets = numpy.frombuffer(self._mm, dtype='<u4', count=count,
+                                       offset=offset).astype(numpy.int64)
+        else:
+            offsets = numpy.array(self.offsets, dtype=numpy.int64)
+        idx = offsets[:, numpy.newaxis] \
+            + numpy.arange(record_header.size, dtype=numpy.int64)
+        headers = numpy.ascontiguousarray(buf[idx]).view(record_dtype)
+        headers = headers.reshape(-1)
+        return {
+            'buffer': buf,
+            'offsets': offsets + record_header.size,
+            'lengths': headers['length'],
+            'timestamp': headers['timestamp'],
+            'ethertype': headers['ethertype'],
+            'proto': headers['proto'],
+            'port': headers['port'],
+        }
+
+    def close(self):
+        if self._mm is not None:
+            self._view = None
+            try:
+                self._mm.close()
+            except BufferError:
+                # payload views or arrays are still in use; the
+                # mapping goes away once they are garbage collected
+                pass
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+class Tests(unittest.TestCase):
+    records = [
+        ((0x800, 17, 53), 1000, b'query'),
+        ((0x86dd, 6, 80), 2000, b'GET / HTTP/1.1\r\n'),
+        ((0x800, 47), 3000, b'\x00\x01'),
+    ]
+
+    def _write(self, footer):
+        fd, filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(segment_header.pack(SEGMENT_MAGIC, SEGMENT_VERSION))
+            offsets = array.array('I')
+            for service, ts, payload in self.records:
+                offsets.append(f.tell())
+                f.write(pack_record_header(service, ts, len(payload)))
+                f.write(payload)
+            if footer:
+                index = f.tell()
+                f.write(offsets_to_bytes(offsets))
+                f.write(footer_trailer.pack(index, len(offsets),
+                                            FOOTER_MAGIC))
+            else:
+                # partial record left by a crash
+                f.write(b'\x05\0\0')
+        return filename
+
+    def test_read(self):
+        for footer in (True, False):
+            filename = self._write(footer)
+            try:
+                with RecordReader(filename) as r:
+                    self.assertEqual(r.complete, footer)
+                    self.assertEqual(
+                        [(s, t, bytes(p)) for s, t, p in r],
+                        self.records)
+            finally:
+                os.remove(filename)
+
+    @unittest.skipIf(numpy is None, 'numpy not available')
+    def test_arrays(self):
+        filename = self._write(True)
+        try:
+            with RecordReader(filename) as r:
+                a = r.arrays()
+                self.assertEqual(list(a['port']), [53, 80, NO_PORT])
+                start, length = a['offsets'][1], a['lengths'][1]
+                self.assertEqual(a['buffer'][start:start + length].tobytes(),
+                                 self.records[1][2])
+                del a
+        finally:
+            os.remove(filename)
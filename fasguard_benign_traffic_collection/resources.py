@@ -0,0 +1,226 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+from .stats import Stats
+
+import gc
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+try:
+    # imported under another name because ResourceMonitor has a
+    # tracemalloc argument
+    import tracemalloc as _tracemalloc
+except ImportError:
+    _tracemalloc = None
+
+log = logging.getLogger(__name__)
+
+RESOURCES_VERSION = 1
+
+def rss_bytes():
+    """return the resident set size of this process in bytes, or None
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+def open_fd_count():
+    """return the number of open file descriptors, or None
+    """
+    for d in ('/proc/self/fd', '/dev/fd'):
+        try:
+            # listing the directory takes a descriptor of its own
+            return len(os.listdir(d)) - 1
+        except OSError:
+            pass
+    return None
+
+class ResourceMonitor(object):
+    """periodic report of what a long-running collector holds on to
+
+    Every 'interval' seconds report() gathers the resident set size,
+    the number of open file descriptors, the sizes of the Dumpfiles
+    tables (cached service lookups, Dumpfile objects and how many of
+    those are open), the number of Stats nodes, the number of threads
+    and the garbage collector's generation counts.  The report is
+    logged and, if filename is given, saved there as JSON together
+    with a Stats snapshot (replaced atomically, like a checkpoint).
+
+    If tracemalloc is a positive number of frames (Python 3.4 or
+    later), memory allocations are traced from the start, and
+    whenever trace_event is set (see util.signal_event()) the 'top'
+    allocation sites that grew the most since the previous trace
+    are logged and included in the saved report.
+    """
+    def __init__(self, stats, dumpfiles, interval=60.0, filename=None,
+                 tracemalloc=0, top=10):
+        self._stats = stats
+        self._dumpfiles = dumpfiles
+        self._interval = interval
+        self._filename = filename
+        self._top = top
+        self._next = time.time() + interval
+        self._snapshot = None
+        self._last_trace = None
+        self.trace_event = threading.Event()
+        if tracemalloc:
+            if _tracemalloc is None:
+                log.warning('tracemalloc is not available in this Python;'
+                            ' not tracing allocations')
+            else:
+                if not _tracemalloc.is_tracing():
+                    _tracemalloc.start(tracemalloc)
+                self._snapshot = self._take_snapshot()
+
+    @property
+    def tracing(self):
+        return self._snapshot is not None
+
+    def report(self):
+        """return the current resource usage as a dict
+        """
+        ret = {
+            'time': time.time(),
+            'rss': rss_bytes(),
+            'open_fds': open_fd_count(),
+            'stats_nodes': self._stats.node_count(),
+            'threads': threading.active_count(),
+            'gc_counts': list(gc.get_count()),
+        }
+        ret.update(self._dumpfiles.resource_counts())
+        if self.tracing:
+            ret['traced'], ret['traced_peak'] = \
+                _tracemalloc.get_traced_memory()
+        return ret
+
+    def log_lines(self, report):
+        line = 'resources: rss %s, %s fds, %i services, %i/%i outputs' \
+            ' open, %i stats nodes, %i threads, gc counts %s' % (
+                'unknown' if report['rss'] is None
+                else '%i bytes' % report['rss'],
+                'unknown' if report['open_fds'] is None
+                else report['open_fds'],
+                report['services'], report['open_outputs'],
+                report['outputs'], report['stats_nodes'],
+                report['threads'], '/'.join(map(str, report['gc_counts'])))
+        if 'traced' in report:
+            line += ', traced %i bytes (peak %i)' % (
+                report['traced'], report['traced_peak'])
+        return [line]
+
+    def poll(self, now=None):
+        """trace if trace_event is set and report if due
+
+        Called periodically from the main thread.
+        """
+        if self.trace_event.is_set():
+            self.trace_event.clear()
+            self.trace()
+            self._next = 0
+        if now is None:
+            now = time.time()
+        if now >= self._next:
+            report = self.report()
+            for line in self.log_lines(report):
+                log.info(line)
+            self.save(report)
+            self._next = now + self._interval
+
+    @staticmethod
+    def _take_snapshot():
+        return _tracemalloc.take_snapshot().filter_traces((
+            _tracemalloc.Filter(False, _tracemalloc.__file__),
+            _tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+    def trace(self):
+        """log the allocation sites that grew most since the last trace
+
+        Returns a list of dicts (also kept for the saved report), or
+        None if allocations aren't traced.
+        """
+        if not self.tracing:
+            log.warning('not tracing allocations; set tracemalloc in the'
+                        ' resources config')
+            return None
+        snapshot = self._take_snapshot()
+        diffs = snapshot.compare_to(self._snapshot, 'lineno')[:self._top]
+        self._snapshot = snapshot
+        self._last_trace = []
+        log.info('top %i allocation sites by growth:', len(diffs))
+        for d in diffs:
+            frame = d.traceback[0]
+            entry = {
+                'location': '%s:%i' % (frame.filename, frame.lineno),
+                'size': d.size,
+                'size_diff': d.size_diff,
+                'count': d.count,
+                'count_diff': d.count_diff,
+            }
+            self._last_trace.append(entry)
+            log.info('  %(location)s: %(size)i bytes (%(size_diff)+i) in'
+                     ' %(count)i blocks (%(count_diff)+i)', entry)
+        return self._last_trace
+
+    def save(self, report):
+        if self._filename is None:
+            return
+        state = {
+            'version': RESOURCES_VERSION,
+            'resources': report,
+            'stats': self._stats.snapshot(),
+            'tracemalloc': self._last_trace,
+        }
+        tmp = self._filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        os.rename(tmp, self._filename)
+
+class Tests(unittest.TestCase):
+    class FakeDumpfiles(object):
+        def resource_counts(self):
+            return {'services': 3, 'outputs': 2, 'open_outputs': 1}
+
+    def test_report(self):
+        stats = Stats()
+        stats.get_child('a.pcap')
+        stats.get_child('b.pcap')
+        d = tempfile.mkdtemp()
+        filename = os.path.join(d, 'resources.json')
+        try:
+            m = ResourceMonitor(stats, self.FakeDumpfiles(),
+                                filename=filename)
+            m.poll(now=float('inf'))
+            with open(filename) as f:
+                state = json.load(f)
+            self.assertEqual(state['resources']['stats_nodes'], 3)
+            self.assertEqual(state['resources']['open_outputs'], 1)
+            self.assertIn('a.pcap', state['stats']['children'])
+        finally:
+            os.remove(filename)
+            os.rmdir(d)
+
+    @unittest.skipIf(_tracemalloc is None, 'tracemalloc not available')
+    def test_trace(self):
+        was_tracing = _tracemalloc.is_tracing()
+        m = ResourceMonitor(Stats(), self.FakeDumpfiles(), tracemalloc=1,
+                            top=3)
+        try:
+            hoard = [bytearray(1000) for i in range(100)]
+            trace = m.trace()
+            self.assertTrue(len(trace) <= 3)
+            self.assertIn('resources.py', trace[0]['location'])
+            self.assertTrue(trace[0]['size_diff'] >= 100000)
+            del hoard
+        finally:
+            if not was_tracing:
+                _tracemalloc.stop()
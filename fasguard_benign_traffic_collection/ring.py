@@ -0,0 +1,395 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""shared-memory packet rings between capture and processing
+
+With the 'ring' config setting, the libpcap callbacks of the capture
+threads do nothing but copy each packet and its header into a large
+preallocated PacketRing, so a burst only has to be absorbed by memory
+copies instead of by decoding and writing.  Worker processes (one per
+ring) take the packets out of their ring, classify them and write
+them to per-worker partition files, which are merged in timestamp
+order once capture stops, as with 'fanout'.
+
+A ring is a file (in /dev/shm if it exists) mapped into the capture
+process and its worker.  The first 64 bytes hold the write position,
+the read position, the high-water mark and the overrun count as
+native 64-bit integers; the rest is the data area.  Positions count
+bytes since the ring was created, so the occupancy is their
+difference.  Each record is a record header (capture length, original
+length, seconds, nanoseconds, input and output link type) followed by
+the packet, padded to a multiple of 8 bytes.  A record never wraps
+around the end of the data area; the rest of the area is skipped
+instead, marked by WRAP in place of a capture length.
+
+There is one writer (the capture process, which serializes its
+threads with a lock) and one reader per ring.  The writer only
+publishes a new write position after the record is in place, and the
+reader only publishes a new read position after copying the records
+out.  This relies on aligned 8-byte stores being atomic and on stores
+becoming visible in order, as on x86-64.  A packet that doesn't fit
+in the free space is dropped and counted as an overrun.
+"""
+
+from __future__ import absolute_import
+
+from .decode import Header, decoder_for_linktype, reframer_for_linktypes
+from .dumpfiles import Dumpfiles, partition_filename
+from .fanout import (SharedQuotas, ignore_sighup, merge_partitions,
+                     stop_outputs)
+from .stats import Stats, StatsLoggerThread, add_snapshots, empty_snapshot
+from .util import signal_event
+
+import itertools
+import logging
+import mmap
+import multiprocessing
+import os
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import signal
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+log = logging.getLogger(__name__)
+
+_DATA = 64
+_WRITE, _READ, _HIGH_WATER, _OVERRUNS = 0, 8, 16, 24
+_u32 = struct.Struct('=I')
+_u64 = struct.Struct('=Q')
+record_header = struct.Struct('=IIQIHH')
+WRAP = 0xffffffff
+
+def _align(n):
+    return (n + 7) & ~7
+
+class PacketRing(object):
+    """single-writer, single-reader packet ring in a shared file
+
+    If size is given, a new ring with a data area of (about) size
+    bytes is created in filename; otherwise the existing ring in
+    filename is opened.  See create().
+    """
+    def __init__(self, filename, size=None):
+        self.filename = filename
+        fd = os.open(filename, os.O_RDWR | (os.O_CREAT if size else 0),
+                     0o600)
+        try:
+            if size:
+                os.ftruncate(fd, _DATA + _align(size))
+            length = os.fstat(fd).st_size
+            self._mm = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+        self.capacity = length - _DATA
+
+    @classmethod
+    def create(cls, size, directory=None):
+        """create a ring in a new file in directory
+
+        directory defaults to /dev/shm (so the ring is never written
+        back to disk) if it exists, else the temporary directory.
+        """
+        if directory is None and os.path.isdir('/dev/shm'):
+            directory = '/dev/shm'
+        fd, filename = tempfile.mkstemp(prefix='fasguard-ring-',
+                                        dir=directory)
+        os.close(fd)
+        return cls(filename, size)
+
+    def _get(self, field):
+        return _u64.unpack_from(self._mm, field)[0]
+
+    def _set(self, field, value):
+        _u64.pack_into(self._mm, field, value)
+
+    def put(self, header, packet, linktype, out_linktype):
+        """append a packet; returns False (an overrun) if it doesn't fit
+        """
+        caplen = len(packet)
+        need = _align(record_header.size + caplen)
+        w = self._get(_WRITE)
+        used = w - self._get(_READ)
+        off = w % self.capacity
+        pad = self.capacity - off if self.capacity - off < need else 0
+        if used + pad + need > self.capacity:
+            self._set(_OVERRUNS, self._get(_OVERRUNS) + 1)
+            return False
+        if pad:
+            _u32.pack_into(self._mm, _DATA + off, WRAP)
+            off = 0
+        start = _DATA + off + record_header.size
+        record_header.pack_into(self._mm, _DATA + off, caplen, header.len,
+                                header.sec, header.nsec, linktype,
+                                out_linktype)
+        self._mm[start:start + caplen] = packet
+        self._set(_WRITE, w + pad + need)
+        used += pad + need
+        if used > self._get(_HIGH_WATER):
+            self._set(_HIGH_WATER, used)
+        return True
+
+    def get(self, max_records=1024):
+        """remove and return up to max_records packets
+
+        Returns a list of (header, packet, linktype, out_linktype)
+        tuples; the packets are copied out of the ring.
+        """
+        w = self._get(_WRITE)
+        r = self._get(_READ)
+        ret = []
+        while r < w and len(ret) < max_records:
+            off = r % self.capacity
+            if _u32.unpack_from(self._mm, _DATA + off)[0] == WRAP:
+                r += self.capacity - off
+                continue
+            caplen, length, sec, nsec, linktype, out_linktype = \
+                record_header.unpack_from(self._mm, _DATA + off)
+            start = _DATA + off + record_header.size
+            ret.append((Header(sec, nsec, caplen, length),
+                        self._mm[start:start + caplen], linktype,
+                        out_linktype))
+            r += _align(record_header.size + caplen)
+        self._set(_READ, r)
+        return ret
+
+    def status(self):
+        """return the occupancy, high-water mark (both in bytes),
+        overrun count and capacity as a dict
+        """
+        return {
+            'occupancy': self._get(_WRITE) - self._get(_READ),
+            'high_water': self._get(_HIGH_WATER),
+            'overruns': self._get(_OVERRUNS),
+            'capacity': self.capacity,
+        }
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def unlink(self):
+        self.close()
+        os.remove(self.filename)
+
+class RingSet(object):
+    """the capture side of the rings:  spreads packets over them
+
+    Packets are assigned round-robin, so consecutive packets of a
+    flow may be handled by different workers; the partition merge
+    restores the timestamp order in each output.
+    """
+    def __init__(self, rings):
+        self.rings = rings
+        self._locks = [threading.Lock() for r in rings]
+        self._next = itertools.cycle(range(len(rings)))
+
+    def put(self, header, packet, linktype, out_linktype):
+        i = next(self._next)
+        with self._locks[i]:
+            return self.rings[i].put(header, packet, linktype, out_linktype)
+
+    def counters(self):
+        """return the ring status summed over all rings, as counters
+        """
+        ret = {}
+        for ring in self.rings:
+            for k, v in ring.status().items():
+                if k != 'capacity':
+                    ret['ring_' + k] = ret.get('ring_' + k, 0) + v
+        return ret
+
+def run_ring(config):
+    """capture into shared-memory rings drained by worker processes
+
+    The capture threads run in this process and only copy packets
+    into the rings (see Capture); each worker decodes and saves the
+    packets of its ring into partition files.  Workers send Stats
+    snapshots to this process, which logs their sum together with the
+    ring counters, enforces output quotas on the sum (see
+    fanout.SharedQuotas), and merges the partitions when done (unless
+    'merge' is False).
+    """
+    # avoid circular imports
+    from . import run_threads
+    from .capture import CaptureParams
+
+    settings = config['ring']
+    workers = settings['workers']
+    capture_settings = dict(linktype=None, snaplen=65535)
+    capture_settings.update(config.get('capture', {}))
+    capture_params = CaptureParams(**capture_settings)
+    rings = [PacketRing.create(settings['size'], settings.get('directory'))
+             for i in range(workers)]
+    ringset = RingSet(rings)
+
+    mp_shutdown = multiprocessing.Event()
+    stats_q = multiprocessing.Queue()
+    shutdown_event = threading.Event()
+    stats = Stats()
+    snapshots = [empty_snapshot() for i in range(workers)]
+    quotas = SharedQuotas(workers)
+    hup_event = threading.Event()
+    procs = []
+
+    def collect_stats(timeout=0):
+        worker_quotas = {}
+        while True:
+            try:
+                i, snap, q = stats_q.get(timeout=timeout)
+            except queue.Empty:
+                break
+            snapshots[i] = snap
+            worker_quotas.update(q)
+        total = snapshots[0]
+        for other in snapshots[1:]:
+            total = add_snapshots(total, other)
+        total['counters'].update(ringset.counters())
+        stats.set_snapshot(total)
+        quotas.update(worker_quotas, total)
+
+    def housekeeping():
+        collect_stats()
+        ignore_sighup(hup_event, 'ring')
+        for p in procs:
+            if p.exitcode not in (None, 0):
+                raise RuntimeError('ring worker %s exited with %i'
+                                   % (p.name, p.exitcode))
+
+    stats_thread = StatsLoggerThread(stats, shutdown_event)
+    stats_thread.start()
+    with signal_event(signal.SIGHUP, hup_event):
+        try:
+            for i, ring in enumerate(rings):
+                p = multiprocessing.Process(
+                    target=_worker, name='ring.%i' % i,
+                    args=(i, config, ring.filename, mp_shutdown, stats_q,
+                          quotas.queues[i]))
+                p.start()
+                procs.append(p)
+            log.info('started %i ring workers with %i-byte rings', workers,
+                     rings[0].capacity)
+            run_threads(config.get('interfaces', (None,)), shutdown_event,
+                        None, capture_params, housekeeping, ring=ringset)
+        finally:
+            log.info('shutting down')
+            shutdown_event.set()
+            # the workers drain their rings before exiting
+            mp_shutdown.set()
+            while any(p.is_alive() for p in procs):
+                collect_stats(0.25)
+            for p in procs:
+                p.join()
+            collect_stats()
+            stats_thread.join()
+            for i, ring in enumerate(rings):
+                status = ring.status()
+                log.info('ring %i: high water %i of %i bytes, %i overruns', i,
+                         status['high_water'], status['capacity'],
+                         status['overruns'])
+                ring.unlink()
+            if settings.get('merge', True):
+                for filename in stats.snapshot()['children']:
+                    if filename == '(discard)':
+                        continue
+                    parts = [partition_filename(filename, i)
+                             for i in range(workers)]
+                    merge_partitions(filename,
+                                     [p for p in parts if os.path.exists(p)],
+                                     Stats())
+
+def _worker(index, config, ring_filename, mp_shutdown, stats_q,
+            stop_q):
+    # the parent handles Ctrl-C and tells the workers to stop, and
+    # ignores SIGHUP (see fanout.ignore_sighup())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    from .capture import CaptureParams
+
+    ring = PacketRing(ring_filename)
+    stats = Stats()
+    capture_settings = dict(linktype=None, snaplen=65535)
+    capture_settings.update(config.get('capture', {}))
+    capture_params = CaptureParams(**capture_settings)
+    # (linktype, output linktype) -> (decoder, reframer or None)
+    handlers = {}
+    next_report = 0.0
+    with Dumpfiles(config, capture_params, stats,
+                   partition=index) as dumpfiles:
+        try:
+            while True:
+                records = ring.get()
+                if not records:
+                    if mp_shutdown.is_set():
+                        # the capture threads are done; anything they
+                        # put in the ring is visible now
+                        records = ring.get()
+                        if not records:
+                            break
+                    else:
+                        time.sleep(0.001)
+                # the capture side can't pause for idle schedules, but
+                # windows still open and close
+                dumpfiles.poll_schedules()
+                for header, packet, linktype, out_linktype in records:
+                    if capture_params.linktype is None:
+                        capture_params.linktype = out_linktype
+                    try:
+                        decode, reframe = handlers[linktype, out_linktype]
+                    except KeyError:
+                        decode = decoder_for_linktype(linktype)
+                        reframe = None
+                        if linktype != out_linktype:
+                            reframe = reframer_for_linktypes(linktype,
+                                                             out_linktype)
+                        handlers[linktype, out_linktype] = (decode, reframe)
+                    _save(dumpfiles, decode, reframe, packet, header)
+                dumpfiles.flush_if_due()
+                now = time.time()
+                if now >= next_report:
+                    next_report = now + 1.0
+                    stop_outputs(stop_q, dumpfiles)
+                    stats_q.put((index, stats.snapshot(),
+                                 dumpfiles.quotas()))
+        finally:
+            stats_q.put((index, stats.snapshot(), dumpfiles.quotas()))
+            ring.close()
+
+def _save(dumpfiles, decode, reframe, packet, header):
+    decoded = decode(packet)
+    if reframe is not None:
+        reframed = reframe(packet, header, decoded)
+        if reframed is None:
+            return
+        packet, header, decoded = reframed
+    try:
+        dumpfile = dumpfiles[decoded.service]
+    except KeyError:
+        return
+    dumpfile.save(packet, header, decoded)
+
+class Tests(unittest.TestCase):
+    def test_put_get(self):
+        ring = PacketRing.create(200)
+        try:
+            # 24-byte header + 50 bytes, padded:  80 bytes per record
+            for i in range(2):
+                self.assertTrue(ring.put(Header(i, 0, 50, 60),
+                                         bytes(bytearray([i]) * 50), 1, 1))
+            self.assertFalse(ring.put(Header(2, 0, 50, 60), b'x' * 50, 1, 1))
+            got = ring.get(1)
+            self.assertEqual((got[0][0].sec, got[0][1]), (0, b'\0' * 50))
+            # doesn't fit before the end, so it wraps around
+            self.assertTrue(ring.put(Header(3, 0, 50, 60), b'y' * 50, 1, 1))
+            self.assertEqual([(h.sec, p[:1]) for h, p, l, o in ring.get()],
+                             [(1, b'\1'), (3, b'y')])
+            status = ring.status()
+            self.assertEqual((status['occupancy'], status['overruns'],
+                              status['high_water']), (0, 1, 200))
+        finally:
+            ring.unlink()
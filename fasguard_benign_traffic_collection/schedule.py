@@ -0,0 +1,126 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+"""collection windows for outputs with a 'schedule' option
+
+A Schedule says when an output collects packets:  during time-of-day
+windows, during a duty cycle ("5 minutes out of every hour"), or
+during the part of a duty cycle that falls in a time-of-day window if
+both are given.  It has no state of its own; state() tells whether a
+time is inside the schedule and when that next changes, so callers
+only need to look at the schedule again once that time has passed
+(see Dumpfiles.poll_schedules()).
+"""
+
+from __future__ import absolute_import
+
+import logging
+import time
+import unittest
+
+log = logging.getLogger(__name__)
+
+DAY = 86400
+
+def parse_time_of_day(value):
+    """return seconds after midnight for 'HH:MM', 'HH:MM:SS' or seconds
+    """
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        parts = str(value).split(':')
+        if len(parts) not in (2, 3):
+            raise ValueError('bad time of day: %r' % (value,))
+        seconds = 0.0
+        for part, unit in zip(parts, (3600, 60, 1)):
+            seconds += float(part) * unit
+    if not 0 <= seconds <= DAY:
+        raise ValueError('time of day out of range: %r' % (value,))
+    return seconds
+
+class Schedule(object):
+    """when an output collects packets
+
+    windows is a list of (start, end) times of day (see
+    parse_time_of_day()); a window whose end is before its start runs
+    past midnight.  Times of day are local unless utc is true, and
+    are taken from the clock as is, so a window may be an hour longer
+    or shorter on the day daylight saving time changes.
+
+    period and duration (seconds) give a duty cycle:  the first
+    duration seconds of every period, counted from offset seconds
+    after the epoch.  Aligning to the epoch rather than to the start
+    of the run keeps collectors with the same schedule in step.
+
+    If neither is given the schedule is always active.
+    """
+    def __init__(self, windows=None, period=None, duration=None, offset=0,
+                 utc=False):
+        self._windows = []
+        for start, end in windows or ():
+            start, end = parse_time_of_day(start), parse_time_of_day(end)
+            if start % DAY == end % DAY:
+                raise ValueError('empty or full-day window')
+            self._windows.append((start, end))
+        self._boundaries = sorted(set(t % DAY for w in self._windows
+                                      for t in w))
+        if (period is None) != (duration is None):
+            raise ValueError('period and duration go together')
+        self._period = self._duration = None
+        if period is not None:
+            self._period = float(period)
+            self._duration = float(duration)
+            if not 0 < self._duration < self._period:
+                raise ValueError('duration must be positive and shorter'
+                                 ' than period')
+        self._offset = float(offset)
+        self._localtime = time.gmtime if utc else time.localtime
+
+    def state(self, now):
+        """return (whether now is in the schedule, time of the next
+        possible change)
+        """
+        active = True
+        change = float('inf')
+        if self._windows:
+            t = self._localtime(now)
+            sod = t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec + now % 1
+            active = any(start <= sod < end if start < end
+                         else sod >= start or sod < end
+                         for start, end in self._windows)
+            change = now + min((b - sod) % DAY or DAY
+                               for b in self._boundaries)
+        if self._period is not None:
+            phase = (now - self._offset) % self._period
+            in_cycle = phase < self._duration
+            active = active and in_cycle
+            change = min(change, now - phase + (
+                self._duration if in_cycle else self._period))
+        return active, change
+
+class Tests(unittest.TestCase):
+    def test_duty_cycle(self):
+        s = Schedule(period=3600, duration=300, offset=60)
+        self.assertEqual(s.state(7200 + 60), (True, 7200 + 360))
+        self.assertEqual(s.state(7200 + 359.5), (True, 7200 + 360))
+        self.assertEqual(s.state(7200 + 360), (False, 10800 + 60))
+        self.assertEqual(s.state(7200 + 30), (False, 7200 + 60))
+        self.assertEqual(Schedule().state(0), (True, float('inf')))
+        self.assertRaises(ValueError, Schedule, period=60, duration=60)
+
+    def test_windows(self):
+        s = Schedule(windows=[('22:00', '02:00'), ('12:00', '12:30:00')],
+                     utc=True)
+        day = 10 * DAY
+        self.assertEqual(s.state(day + 3600), (True, day + 7200))
+        self.assertEqual(s.state(day + 7200), (False, day + 12 * 3600))
+        self.assertEqual(s.state(day + 12 * 3600 + 60),
+                         (True, day + 12.5 * 3600))
+        self.assertEqual(s.state(day + 23 * 3600),
+                         (True, day + 26 * 3600))
+        # a duty cycle inside the windows
+        s = Schedule(windows=[('12:00', '13:00')], period=600,
+                     duration=60, utc=True)
+        self.assertEqual(s.state(day + 11 * 3600), (False, day + 39660))
+        self.assertEqual(s.state(day + 12 * 3600), (True, day + 43260))
+        self.assertEqual(s.state(day + 12 * 3600 + 120),
+                         (False, day + 43800))
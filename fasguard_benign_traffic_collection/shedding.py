@@ -0,0 +1,142 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import unittest
+
+log = logging.getLogger(__name__)
+
+class LoadShedder(object):
+    """decides which outputs to shed when capture falls behind
+
+    Each live Capture reports, once per dispatch call, how long the
+    call took (which includes decoding and writing, so a saturated
+    disk shows up as well as a saturated CPU) and the kernel's drop
+    counter.  Every 'window' seconds a capture is judged overloaded
+    if the kernel dropped packets or if it spent at least busy_high
+    of the window dispatching.
+
+    Outputs have a priority (see the 'output_options' config).  While
+    any capture is overloaded the shedding level rises, at most once
+    per window:  level i sheds every output whose priority is below
+    the i-th lowest configured priority, so the most valuable outputs
+    are never shed.  Once no capture has been overloaded for 'hold'
+    seconds and a capture is below busy_low, the level drops again,
+    at most once per 'hold' seconds.  Shed packets are decoded (to
+    find their output) but not analyzed, reframed or written, and are
+    counted in the output's 'shed' and 'shed_bytes' counters.
+    """
+    def __init__(self, priorities, busy_high=0.9, busy_low=0.5,
+                 window=1.0, hold=10.0):
+        self._levels = sorted(set(priorities))
+        self._busy_high = busy_high
+        self._busy_low = busy_low
+        self._window = window
+        self._hold = hold
+        self._lock = threading.Lock()
+        # source -> [window start, busy seconds, new drops, last drops]
+        self._sources = {}
+        self._level = 0
+        self._last_change = None
+        self._last_overload = None
+        # outputs with a priority below this are shed; None sheds
+        # nothing.  read without locking by the capture threads.
+        self.shed_below = None
+
+    @property
+    def level(self):
+        return self._level
+
+    def set_priorities(self, priorities):
+        """replace the configured priorities (after a config reload)
+
+        The current level is kept if there are still that many,
+        otherwise it drops to the highest one left.
+        """
+        with self._lock:
+            self._levels = sorted(set(priorities))
+            level = min(self._level, len(self._levels) - 1)
+            self._level = level
+            self.shed_below = self._levels[level] if level else None
+
+    def update(self, source, busy, now, drops=None):
+        """account for one dispatch call of source that took busy seconds
+
+        drops is the kernel's cumulative drop count, or None if it
+        wasn't queried this time.
+        """
+        with self._lock:
+            w = self._sources.get(source)
+            if w is None:
+                w = self._sources[source] = [now - busy, 0.0, 0, drops]
+            w[1] += busy
+            if drops is not None:
+                if w[3] is not None and drops > w[3]:
+                    w[2] += drops - w[3]
+                w[3] = drops
+            elapsed = now - w[0]
+            if elapsed < self._window:
+                return
+            fraction = w[1] / elapsed
+            overloaded = w[2] > 0 or fraction >= self._busy_high
+            w[0:3] = [now, 0.0, 0]
+            if overloaded:
+                self._last_overload = now
+                if self._level < len(self._levels) - 1 \
+                   and self._since(self._last_change, now) >= self._window:
+                    self._set_level(self._level + 1, now)
+            elif fraction < self._busy_low and self._level > 0 \
+                 and self._since(self._last_overload, now) >= self._hold \
+                 and self._since(self._last_change, now) >= self._hold:
+                self._set_level(self._level - 1, now)
+
+    @staticmethod
+    def _since(then, now):
+        return float('inf') if then is None else now - then
+
+    def _set_level(self, level, now):
+        self._level = level
+        self._last_change = now
+        self.shed_below = self._levels[level] if level else None
+        if self.shed_below is None:
+            log.info('load back to normal; no longer shedding')
+        else:
+            log.warning('overloaded; shedding outputs with priority'
+                        ' below %s', self.shed_below)
+
+class Tests(unittest.TestCase):
+    def test_escalate_and_recover(self):
+        s = LoadShedder([0, 5, 10], window=1.0, hold=3.0)
+        t = 0.0
+        # fully busy:  escalates once per window, never sheds 10
+        for i in range(50):
+            t += 0.1
+            s.update('eth0', 0.1, t)
+        self.assertEqual(s.shed_below, 10)
+        self.assertEqual(s.level, 2)
+        # idle:  steps down once per hold period
+        for i in range(100):
+            t += 0.1
+            s.update('eth0', 0.0, t)
+        self.assertEqual(s.shed_below, None)
+        self.assertEqual(s.level, 0)
+
+    def test_drops_overload(self):
+        s = LoadShedder([0, 5])
+        s.update('eth1', 0.0, 0.0, drops=0)
+        s.update('eth1', 0.0, 1.0, drops=3)
+        self.assertEqual(s.shed_below, 5)
+
+    def test_set_priorities(self):
+        s = LoadShedder([0, 5])
+        s.update('eth1', 0.0, 0.0, drops=0)
+        s.update('eth1', 0.0, 1.0, drops=3)
+        s.set_priorities([0, 2, 5])
+        self.assertEqual((s.level, s.shed_below), (1, 2))
+        # escalates to the new top priority
+        s.update('eth1', 0.0, 2.0, drops=6)
+        self.assertEqual((s.level, s.shed_below), (2, 5))
+        s.set_priorities([0])
+        self.assertEqual((s.level, s.shed_below), (0, None))
@@ -0,0 +1,452 @@
+# Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
+
+from __future__ import absolute_import
+
+from .decode import ETHERTYPE_IPV4, ETHERTYPE_IPV6
+
+import array
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import threading
+import time
+import unittest
+import zlib
+
+log = logging.getLogger(__name__)
+
+def _array_to_text(a):
+    raw = a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+    return base64.b64encode(zlib.compress(raw)).decode('ascii')
+
+def _array_from_text(typecode, text):
+    a = array.array(typecode)
+    raw = zlib.decompress(base64.b64decode(text))
+    if hasattr(a, 'frombytes'):
+        a.frombytes(raw)
+    else:
+        a.fromstring(raw)
+    return a
+
+_service_key = struct.Struct('!iii')
+
+def service_key(service):
+    """fixed-size byte string identifying a service description tuple
+    """
+    return _service_key.pack(*(tuple(service) + (-2, -2))[0:3])
+
+def service_from_key(key):
+    return tuple(x for x in _service_key.unpack(key) if x != -2)
+
+class CountMinSketch(object):
+    """approximate per-key counters in fixed memory
+
+    Estimates never undercount; with width w and depth d they
+    overcount by more than e/w of the total with probability at most
+    e**-d.  Rows are indexed with seeded CRC-32 so that sketches built
+    by different processes and runs with the same dimensions can be
+    merged.
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = array.array('L', [0]) * (width * depth)
+    def _cells(self, key):
+        w = self.width
+        return [row * w + (zlib.crc32(key, row) & 0xffffffff) % w
+                for row in range(self.depth)]
+    def add(self, key, n=1):
+        """add n to key's count and return the new estimate
+        """
+        table = self.table
+        est = None
+        for i in self._cells(key):
+            v = table[i] + n
+            table[i] = v
+            if est is None or v < est:
+                est = v
+        return est
+    def estimate(self, key):
+        table = self.table
+        return min(table[i] for i in self._cells(key))
+    def merge(self, other):
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('cannot merge sketches of different sizes')
+        table = self.table
+        for i, v in enumerate(other.table):
+            table[i] += v
+    def to_dict(self):
+        return {'width': self.width, 'depth': self.depth,
+                'table': _array_to_text(self.table)}
+    @classmethod
+    def from_dict(cls, d):
+        self = cls(d['width'], d['depth'])
+        self.table = _array_from_text('L', d['table'])
+        return self
+
+class TopK(object):
+    """the k keys with the largest estimates from a CountMinSketch
+    """
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = {}
+        self._min = 0
+    def offer(self, key, est):
+        """note that key's estimate is now est
+
+        Returns the key that was evicted to make room, if any.
+        """
+        counts = self.counts
+        if key in counts:
+            counts[key] = est
+            return None
+        if len(counts) < self.k:
+            counts[key] = est
+            self._min = min(self._min, est) if len(counts) > 1 else est
+            return None
+        if est <= self._min:
+            return None
+        # the cached minimum is a lower bound because tracked counts
+        # only grow; look for the real one
+        victim = min(counts, key=counts.get)
+        if est <= counts[victim]:
+            self._min = counts[victim]
+            return None
+        del counts[victim]
+        counts[key] = est
+        self._min = min(counts.values())
+        return victim
+    def items(self):
+        """(key, estimate) pairs, largest first
+        """
+        return sorted(self.counts.items(), key=lambda kv: -kv[1])
+
+class HyperLogLog(object):
+    """approximate count of distinct items in 2**precision bytes
+
+    The standard error is about 1.04 / sqrt(2**precision).
+    """
+    def __init__(self, precision=10):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+    def add(self, item):
+        x, = struct.unpack('!Q', hashlib.md5(item).digest()[:8])
+        idx = x >> (64 - self.p)
+        rest = (x << self.p) & 0xffffffffffffffff
+        rank = 1
+        while rank <= 64 - self.p and not rest & 0x8000000000000000:
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b'\0')
+        if est <= 2.5 * m and zeros:
+            # small range correction (linear counting)
+            est = m * math.log(m / float(zeros))
+        return int(round(est))
+    def merge(self, other):
+        if self.p != other.p:
+            raise ValueError('cannot merge HyperLogLogs of different sizes')
+        regs = self.registers
+        for i, r in enumerate(other.registers):
+            if r > regs[i]:
+                regs[i] = r
+    def to_dict(self):
+        return {'p': self.p, 'registers': base64.b64encode(
+            zlib.compress(bytes(self.registers))).decode('ascii')}
+    @classmethod
+    def from_dict(cls, d):
+        self = cls(d['p'])
+        self.registers = bytearray(zlib.decompress(
+            base64.b64decode(d['registers'])))
+        return self
+
+class ServiceSketch(object):
+    """fixed-memory traffic rate analysis of all observed services
+
+    For every packet, the packet and byte counts of its service are
+    added to two count-min sketches, and the services with the most
+    packets and the most bytes are tracked in two TopK tables.  For
+    each service currently in either table, the distinct source and
+    destination IP addresses are counted with HyperLogLogs.  Memory
+    use depends only on the sketch dimensions, not on the number of
+    services seen.
+
+    Sketches with the same dimensions can be merged, so results from
+    several runs or several collectors can be combined (see merge(),
+    save() and load()).
+    """
+    def __init__(self, width=2048, depth=4, top_k=100, hll_precision=10):
+        self.packets = CountMinSketch(width, depth)
+        self.bytes = CountMinSketch(width, depth)
+        self.top_packets = TopK(top_k)
+        self.top_bytes = TopK(top_k)
+        self.hll_precision = hll_precision
+        # service key -> (sources, destinations)
+        self.addresses = {}
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, packet, length, decoded):
+        key = service_key(decoded.service)
+        with self._lock:
+            evicted = (
+                self.top_packets.offer(key, self.packets.add(key)),
+                self.top_bytes.offer(key, self.bytes.add(key, length)),
+            )
+            for victim in evicted:
+                if victim is not None \
+                   and victim not in self.top_packets.counts \
+                   and victim not in self.top_bytes.counts:
+                    self.addresses.pop(victim, None)
+            if key not in self.top_packets.counts \
+               and key not in self.top_bytes.counts:
+                return
+            ethertype = decoded.service[0]
+            if ethertype == ETHERTYPE_IPV4:
+                src = packet[decoded.l3 + 12:decoded.l3 + 16]
+                dst = packet[decoded.l3 + 16:decoded.l3 + 20]
+            elif ethertype == ETHERTYPE_IPV6:
+                src = packet[decoded.l3 + 8:decoded.l3 + 24]
+                dst = packet[decoded.l3 + 24:decoded.l3 + 40]
+            else:
+                return
+            try:
+                hlls = self.addresses[key]
+            except KeyError:
+                hlls = (HyperLogLog(self.hll_precision),
+                        HyperLogLog(self.hll_precision))
+                self.addresses[key] = hlls
+            hlls[0].add(bytes(src))
+            hlls[1].add(bytes(dst))
+
+    def merge(self, other):
+        with self._lock:
+            self.packets.merge(other.packets)
+            self.bytes.merge(other.bytes)
+            self.seconds += other.seconds
+            for key, (src, dst) in other.addresses.items():
+                if key in self.addresses:
+                    self.addresses[key][0].merge(src)
+                    self.addresses[key][1].merge(dst)
+                else:
+                    self.addresses[key] = (src, dst)
+            # re-rank every candidate against the merged sketches
+            candidates = set(self.top_packets.counts) \
+                | set(self.top_bytes.counts) \
+                | set(other.top_packets.counts) | set(other.top_bytes.counts)
+            self.top_packets.counts.clear()
+            self.top_bytes.counts.clear()
+            for key in candidates:
+                self.top_packets.offer(key, self.packets.estimate(key))
+                self.top_bytes.offer(key, self.bytes.estimate(key))
+            for key in list(self.addresses):
+                if key not in self.top_packets.counts \
+                   and key not in self.top_bytes.counts:
+                    del self.addresses[key]
+
+    def report(self):
+        """list of (service, packets, bytes, sources, destinations)
+
+        One entry per tracked service, most packets first.  seconds
+        (the total observation time) can be used to turn the counts
+        into rates.
+        """
+        with self._lock:
+            keys = set(self.top_packets.counts) | set(self.top_bytes.counts)
+            rows = []
+            for key in keys:
+                src, dst = None, None
+                if key in self.addresses:
+                    src = self.addresses[key][0].count()
+                    dst = self.addresses[key][1].count()
+                rows.append((service_from_key(key),
+                             self.packets.estimate(key),
+                             self.bytes.estimate(key), src, dst))
+        rows.sort(key=lambda r: -r[1])
+        return rows
+
+    def log_lines(self):
+        seconds = self.seconds or 1.0
+        for service, pkts, nbytes, src, dst in self.report():
+            yield '%s: ~%i packets (~%i bytes, ~%f pps, ~%f Bps),' \
+                ' ~%s sources, ~%s destinations' % (
+                    service, pkts, nbytes, pkts / seconds, nbytes / seconds,
+                    src, dst)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'version': 1,
+                'seconds': self.seconds,
+                'top_k': self.top_packets.k,
+                'hll_precision': self.hll_precision,
+                'packets': self.packets.to_dict(),
+                'bytes': self.bytes.to_dict(),
+                'top_packets': [[base64.b64encode(k).decode('ascii'), v]
+                                for k, v in self.top_packets.items()],
+                'top_bytes': [[base64.b64encode(k).decode('ascii'), v]
+                              for k, v in self.top_bytes.items()],
+                'addresses': [[base64.b64encode(k).decode('ascii'),
+                               s.to_dict(), d.to_dict()]
+                              for k, (s, d) in self.addresses.items()],
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get('version') != 1:
+            raise ValueError('unsupported sketch file version')
+        self = cls(d['packets']['width'], d['packets']['depth'],
+                   d['top_k'], d['hll_precision'])
+        self.seconds = d['seconds']
+        self.packets = CountMinSketch.from_dict(d['packets'])
+        self.bytes = CountMinSketch.from_dict(d['bytes'])
+        for k, v in d['top_packets']:
+            self.top_packets.counts[base64.b64decode(k)] = v
+        for k, v in d['top_bytes']:
+            self.top_bytes.counts[base64.b64decode(k)] = v
+        for table in (self.top_packets, self.top_bytes):
+            table._min = min(table.counts.values()) if table.counts else 0
+        for k, s, dst in d['addresses']:
+            self.addresses[base64.b64decode(k)] = (
+                HyperLogLog.from_dict(s), HyperLogLog.from_dict(dst))
+        return self
+
+    def save(self, filename):
+        """atomically write the sketch to filename as JSON
+        """
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+class AnalysisOutput(object):
+    """a ServiceSketch of every captured packet, saved periodically
+
+    If merge_existing is true and filename already exists, the sketch
+    saved there (e.g., by a previous run) is merged in first.  The
+    remaining keyword arguments give the sketch dimensions.
+    """
+    def __init__(self, filename, interval=60.0, merge_existing=False,
+                 **dimensions):
+        self._filename = filename
+        self._interval = interval
+        self.sketch = ServiceSketch(**dimensions)
+        if merge_existing and os.path.exists(filename):
+            log.info('merging existing analysis from %s', filename)
+            self.sketch.merge(ServiceSketch.load(filename))
+        self._base_seconds = self.sketch.seconds
+        self._start = time.time()
+        self._next_save = self._start + interval
+        self.update = self.sketch.update
+    def save_if_due(self):
+        now = time.time()
+        if now >= self._next_save:
+            self._next_save = now + self._interval
+            self._save(now)
+    def _save(self, now):
+        self.sketch.seconds = self._base_seconds + (now - self._start)
+        self.sketch.save(self._filename)
+    def close(self):
+        self._save(time.time())
+        log.info('traffic rate analysis saved to %s', self._filename)
+        for line in self.sketch.log_lines():
+            log.info(line)
+
+def merge_sketch_files(output, inputs):
+    """merge the sketch files in inputs into the sketch file output
+
+    output is created if it doesn't exist yet, in which case inputs
+    must not be empty.
+    """
+    filenames = list(inputs)
+    if os.path.exists(output):
+        filenames.insert(0, output)
+    if not filenames:
+        raise ValueError('%s does not exist and there is nothing to'
+                         ' merge into it' % output)
+    merged = None
+    for filename in filenames:
+        sketch = ServiceSketch.load(filename)
+        if merged is None:
+            merged = sketch
+        else:
+            merged.merge(sketch)
+    merged.save(output)
+    return merged
+
+class Tests(unittest.TestCase):
+    def test_count_min_never_undercounts(self):
+        cms = CountMinSketch(64, 3)
+        for i in range(1000):
+            cms.add(service_key((0x800, 6, i % 50)), i)
+        for port in range(50):
+            true = sum(i for i in range(1000) if i % 50 == port)
+            self.assertTrue(cms.estimate(service_key((0x800, 6, port)))
+                            >= true)
+
+    def test_top_k(self):
+        top = TopK(3)
+        for key, n in [(b'a', 1), (b'b', 5), (b'c', 3), (b'd', 4),
+                       (b'a', 2), (b'e', 9)]:
+            top.offer(key, n)
+        self.assertEqual([k for k, v in top.items()], [b'e', b'b', b'd'])
+
+    def test_hyperloglog(self):
+        a, b = HyperLogLog(10), HyperLogLog(10)
+        for i in range(5000):
+            (a if i % 2 else b).add(struct.pack('!I', i))
+        a.merge(b)
+        self.assertTrue(abs(a.count() - 5000) < 5000 * 0.1)
+
+    def test_roundtrip_and_merge(self):
+        from .decode import Decoded
+        pkt = b'\x00' * 12 + b'\x0a\x00\x00\x01\x0a\x00\x00\x02'
+        s = ServiceSketch(256, 2, 10, 8)
+        for port in range(30):
+            for i in range(port):
+                s.update(pkt, 100, Decoded((0x800, 17, port), 0, 20, 28))
+        t = ServiceSketch.from_dict(json.loads(json.dumps(s.to_dict())))
+        t.merge(s)
+        top = t.report()[0]
+        self.assertEqual(top[0], (0x800, 17, 29))
+        self.assertTrue(top[1] >= 58)
+        self.assertEqual(top[3], 1)
+
+    def test_merge_files(self):
+        import shutil
+        import tempfile
+        from . import main
+        from .decode import Decoded
+        pkt = b'\x00' * 12 + b'\x0a\x00\x00\x01\x0a\x00\x00\x02'
+        d = tempfile.mkdtemp()
+        package_log = logging.getLogger(__package__)
+        handlers = list(package_log.handlers)
+        try:
+            filenames = [os.path.join(d, name) for name in 'ab']
+            for filename in filenames:
+                s = ServiceSketch(256, 2, 10, 8)
+                s.update(pkt, 100, Decoded((0x800, 6, 80), 0, 20, 40))
+                s.save(filename)
+            self.assertEqual(main(['x', '--merge-sketches'] + filenames), 0)
+            top = ServiceSketch.load(filenames[0]).report()[0]
+            self.assertEqual(top[:3], ((0x800, 6, 80), 2, 200))
+            self.assertEqual(main(['x', '--merge-sketches',
+                                   os.path.join(d, 'missing')]), 1)
+        finally:
+            package_log.handlers = handlers
+            shutil.rmtree(d)
@@ -2,21 +2,136 @@
 
 from __future__ import absolute_import
 
+import array
+import csv
 import datetime
 import itertools
 import logging
+import math
+import os
+import struct
+import sys
+import tempfile
 import threading
+import time
+import unittest
 
 log = logging.getLogger(__name__)
 
+class RateSeries(object):
+    """packet and byte counts per fixed-length time bucket
+
+    The counts of the most recent 'length' buckets of 'interval'
+    seconds each are kept in preallocated arrays used as a ring
+    buffer, so memory use is fixed (16 bytes per bucket) no matter how
+    long capture runs.  Bucket b covers the time range
+    [b * interval, (b + 1) * interval).  Not thread-safe; Stats
+    serializes access with its lock.
+    """
+    def __init__(self, interval, length):
+        self.interval = float(interval)
+        self.length = int(length)
+        if self.interval <= 0 or self.length < 1:
+            raise ValueError('invalid rate series dimensions')
+        self.packets = array.array('d', [0.0]) * self.length
+        self.bytes = array.array('d', [0.0]) * self.length
+        # bucket numbers of the oldest and newest buckets seen so far
+        self._first = None
+        self._head = None
+
+    def add(self, timestamp, packets, nbytes):
+        b = int(timestamp // self.interval)
+        head = self._head
+        if head is None:
+            self._first = self._head = b
+        elif b > head:
+            # clear the buckets being reused
+            for i in range(head + 1, head + 1 + min(b - head, self.length)):
+                self.packets[i % self.length] = 0.0
+                self.bytes[i % self.length] = 0.0
+            self._head = b
+        elif b <= head - self.length:
+            # older than anything still held
+            return
+        elif b < self._first:
+            self._first = b
+        i = b % self.length
+        self.packets[i] += packets
+        self.bytes[i] += nbytes
+
+    def buckets(self, seconds=None, end=None):
+        """return [(start_time, packets, bytes), ...] oldest first
+
+        Only the buckets that end at or before the time 'end' are
+        returned; if end is None the newest (probably still filling)
+        bucket is included.  If 'seconds' is given, only the buckets
+        covering the last that many seconds before 'end' are returned.
+        """
+        if self._head is None:
+            return []
+        if end is None:
+            last = self._head
+        else:
+            last = min(self._head, int(end // self.interval) - 1)
+        first = max(self._first, self._head - self.length + 1)
+        if seconds is not None:
+            first = max(first,
+                        last - int(math.ceil(seconds / self.interval)) + 1)
+        return [(b * self.interval,
+                 self.packets[b % self.length],
+                 self.bytes[b % self.length])
+                for b in range(first, last + 1)]
+
+    def summary(self, field='packets', seconds=None, end=None,
+                percentiles=(50, 95, 99)):
+        """return rate statistics over a window as a dict
+
+        The dict holds the 'min', 'mean' and 'max' per-second rate of
+        'field' ('packets' or 'bytes') over the buckets selected by
+        'seconds' and 'end' (see buckets()), plus 'p<N>' for each
+        nearest-rank percentile in 'percentiles'.  Returns None if no
+        bucket is selected.
+        """
+        col = 1 if field == 'packets' else 2
+        rates = sorted(bucket[col] / self.interval
+                       for bucket in self.buckets(seconds, end))
+        if not rates:
+            return None
+        ret = {
+            'buckets': len(rates),
+            'min': rates[0],
+            'mean': sum(rates) / len(rates),
+            'max': rates[-1],
+        }
+        for p in percentiles:
+            k = int(math.ceil(p / 100.0 * len(rates))) - 1
+            ret['p%g' % p] = rates[max(0, k)]
+        return ret
+
 class Stats(object):
     packets = 0
     bytes = 0
 
-    def __init__(self, name=None, parent=None):
+    def __init__(self, name=None, parent=None, short_name=None,
+                 rates=None):
+        """create a stats node
+
+        rates, if not None, is a sequence of (interval, length) pairs;
+        the node (and each child later created by get_child()) then
+        keeps a RateSeries of each size in self.rates.
+        """
         self._name = name
+        # name relative to the parent (used in snapshots)
+        self._short_name = short_name
         self._parent = parent
         self._children = {}
+        # named event counters (e.g., write syscalls); see count()
+        self.counters = {}
+        if parent is not None:
+            rates = parent._rate_specs
+        self._rate_specs = tuple(rates or ())
+        self.rates = [RateSeries(interval, length)
+                      for interval, length in self._rate_specs]
         if parent is None:
             self._lock = threading.RLock()
         else:
@@ -25,19 +140,157 @@ class Stats(object):
             # performance bottleneck
             self._lock = parent._lock
 
-    def got_packet(self, length):
+    def got_packet(self, length, timestamp=None):
+        """count a packet
+
+        timestamp is the packet's capture time, which places it in the
+        rate series buckets; it defaults to the current time.
+        """
         with self._lock:
             if self._parent is not None:
-                self._parent.got_packet(length)
+                self._parent.got_packet(length, timestamp)
             self.packets += 1
             self.bytes += length
+            if self.rates:
+                if timestamp is None:
+                    timestamp = time.time()
+                for series in self.rates:
+                    series.add(timestamp, 1, length)
+
+    def got_packets(self, lengths, timestamps):
+        """count several packets at once, like got_packet() for each
+        """
+        with self._lock:
+            if self._parent is not None:
+                self._parent.got_packets(lengths, timestamps)
+            self.packets += len(lengths)
+            self.bytes += sum(lengths)
+            for series in self.rates:
+                for length, timestamp in zip(lengths, timestamps):
+                    series.add(timestamp, 1, length)
+
+    def add_totals(self, packets, nbytes):
+        """add to the packet and byte totals (and the parent's)
+
+        Used to correct the totals after restoring a checkpoint; the
+        rate series are left alone.
+        """
+        with self._lock:
+            if self._parent is not None:
+                self._parent.add_totals(packets, nbytes)
+            self.packets += packets
+            self.bytes += nbytes
+
+    def count(self, counter, n=1):
+        """add n to the named event counter
+
+        Like the packet and byte totals, counters are also added to
+        the parent so that each node holds the sum of its children.
+        """
+        with self._lock:
+            if self._parent is not None:
+                self._parent.count(counter, n)
+            self.counters[counter] = self.counters.get(counter, 0) + n
 
     def get_child(self, name=None):
+        short_name = name
         if self._name is not None:
             name = self._name + '.' + name
-        child = Stats(name, self)
-        self._children[name] = child
-        return child
+        with self._lock:
+            # an output that is closed by a config reload and later
+            # reopened keeps accumulating into the same node
+            try:
+                return self._children[name]
+            except KeyError:
+                pass
+            child = Stats(name, self, short_name)
+            self._children[name] = child
+            return child
+
+    def node_count(self):
+        """return the number of nodes in this subtree
+        """
+        with self._lock:
+            return 1 + sum(c.node_count() for c in self._children.values())
+
+    def snapshot(self):
+        """return the totals of this node and its children as plain data
+
+        The returned dict only holds dicts, strings and numbers so it
+        can be pickled or serialized as JSON.  See add_snapshots() and
+        set_snapshot().
+        """
+        with self._lock:
+            return {
+                'packets': self.packets,
+                'bytes': self.bytes,
+                'counters': dict(self.counters),
+                'children': dict(
+                    (c._short_name, c.snapshot())
+                    for c in self._children.values()),
+            }
+
+    def set_snapshot(self, snap):
+        """overwrite the totals of this subtree with those in snap
+
+        Children in snap that don't exist yet are created; existing
+        children missing from snap are left alone.
+        """
+        with self._lock:
+            self.packets = snap['packets']
+            self.bytes = snap['bytes']
+            self.counters = dict(snap['counters'])
+            for name, child_snap in snap['children'].items():
+                self.get_child(name).set_snapshot(child_snap)
+
+    def add_snapshot(self, snap, timestamp=None):
+        """add the totals in snap (such as a delta) to this subtree
+
+        Unlike got_packet(), nothing is added to the parent, because
+        snap already holds the totals of every node.  The packets and
+        bytes added to a node also go into its rate series bucket for
+        timestamp (default: the current time).
+        """
+        with self._lock:
+            self.packets += snap['packets']
+            self.bytes += snap['bytes']
+            for k, v in snap['counters'].items():
+                self.counters[k] = self.counters.get(k, 0) + v
+            if self.rates and (snap['packets'] or snap['bytes']):
+                if timestamp is None:
+                    timestamp = time.time()
+                for series in self.rates:
+                    series.add(timestamp, snap['packets'], snap['bytes'])
+            for name, child_snap in snap['children'].items():
+                self.get_child(name).add_snapshot(child_snap, timestamp)
+
+    def iter_rates(self):
+        """yield (name, RateSeries) for this node and its descendants
+        """
+        with self._lock:
+            for series in self.rates:
+                yield (self._name or '(total)', series)
+            for n in sorted(self._children):
+                for item in self._children[n].iter_rates():
+                    yield item
+
+    def export_rates(self, filename, format='csv'):
+        """write the rate series of this subtree to filename
+
+        In 'csv' format each row holds the node name, the bucket
+        interval, the bucket start time (seconds since the epoch) and
+        the packet and byte counts.  The 'binary' format is more
+        compact; see write_rates() and read_rates().
+        """
+        if format == 'binary':
+            return write_rates(filename, self.iter_rates())
+        with open(filename, 'wb' if sys.version_info[0] < 3 else 'w') as f:
+            w = csv.writer(f)
+            w.writerow(('name', 'interval', 'start', 'packets', 'bytes'))
+            for name, series in self.iter_rates():
+                for start, packets, nbytes in series.buckets():
+                    w.writerow((name, repr(series.interval), repr(start),
+                                '%i' % packets, '%i' % nbytes))
 
     def log_lines(self, elapsed, prefix=""):
         if elapsed == 0.0:
@@ -51,12 +304,122 @@ class Stats(object):
             Bps = self.bytes / float(elapsed)
             line += '%i packets (%i bytes) in %f seconds (%f pps, %f Bps)' % (
                 self.packets, self.bytes, elapsed, pps, Bps)
+            if self.counters:
+                line += ' [%s]' % ', '.join(
+                    '%s=%i' % (k, self.counters[k])
+                    for k in sorted(self.counters))
             return itertools.chain(
                 (line,),
                 itertools.chain.from_iterable(
                     (self._children[n].log_lines(elapsed, prefix=(prefix+'  '))
                      for n in sorted(self._children))))
 
+def add_snapshots(a, b):
+    """return the element-wise sum of two Stats snapshots
+    """
+    counters = dict(a['counters'])
+    for k, v in b['counters'].items():
+        counters[k] = counters.get(k, 0) + v
+    children = dict(a['children'])
+    for name, snap in b['children'].items():
+        children[name] = add_snapshots(children[name], snap) \
+            if name in children else snap
+    return {
+        'packets': a['packets'] + b['packets'],
+        'bytes': a['bytes'] + b['bytes'],
+        'counters': counters,
+        'children': children,
+    }
+
+def subtract_snapshots(a, b):
+    """return the change from snapshot b to the later snapshot a
+
+    Counters and children that didn't change are left out, so the
+    result stays small no matter how many outputs there are.
+    """
+    counters = dict((k, v - b['counters'].get(k, 0))
+                    for k, v in a['counters'].items()
+                    if v != b['counters'].get(k, 0))
+    children = {}
+    for name, snap in a['children'].items():
+        if name in b['children']:
+            snap = subtract_snapshots(snap, b['children'][name])
+            if not (snap['packets'] or snap['bytes'] or snap['counters']
+                    or snap['children']):
+                continue
+        children[name] = snap
+    return {
+        'packets': a['packets'] - b['packets'],
+        'bytes': a['bytes'] - b['bytes'],
+        'counters': counters,
+        'children': children,
+    }
+
+def empty_snapshot():
+    return {'packets': 0, 'bytes': 0, 'counters': {}, 'children': {}}
+
+# binary rate series files start with this magic and version number,
+# followed by one record per series:  the name length and the UTF-8
+# name, the interval, the number of the first bucket and the number
+# of buckets n, then n packet counts and n byte counts as doubles.
+# Everything is little-endian.
+_RATES_MAGIC = b'FGRS'
+_RATES_VERSION = 1
+
+def _doubles_to_bytes(values):
+    a = array.array('d', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+def _bytes_to_doubles(data):
+    a = array.array('d')
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+def write_rates(filename, named_series):
+    """write (name, RateSeries) pairs to a binary rate series file
+    """
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<4sI', _RATES_MAGIC, _RATES_VERSION))
+        for name, series in named_series:
+            buckets = series.buckets()
+            first = int(round(buckets[0][0] / series.interval)) \
+                if buckets else 0
+            name = name.encode('utf-8')
+            f.write(struct.pack('<H', len(name)) + name)
+            f.write(struct.pack('<dqI', series.interval, first,
+                                len(buckets)))
+            f.write(_doubles_to_bytes([b[1] for b in buckets]))
+            f.write(_doubles_to_bytes([b[2] for b in buckets]))
+
+def read_rates(filename):
+    """return the [(name, RateSeries), ...] in a binary rate series file
+    """
+    ret = []
+    with open(filename, 'rb') as f:
+        magic, version = struct.unpack('<4sI', f.read(8))
+        if magic != _RATES_MAGIC or version != _RATES_VERSION:
+            raise ValueError(filename + ': not a rate series file')
+        while True:
+            raw = f.read(2)
+            if not raw:
+                break
+            name = f.read(struct.unpack('<H', raw)[0]).decode('utf-8')
+            interval, first, n = struct.unpack('<dqI', f.read(20))
+            packets = _bytes_to_doubles(f.read(8 * n))
+            nbytes = _bytes_to_doubles(f.read(8 * n))
+            series = RateSeries(interval, max(n, 1))
+            for i in range(n):
+                series.add((first + i) * interval, packets[i], nbytes[i])
+            ret.append((name, series))
+    return ret
+
 class StatsLoggerThread(threading.Thread):
 
     def __init__(self, stats, shutdown_event):
@@ -71,3 +434,46 @@ class StatsLoggerThread(threading.Thread):
             elapsed = (datetime.datetime.utcnow() - start).total_seconds()
             for line in self._stats.log_lines(elapsed):
                 log.info(line)
+
+class Tests(unittest.TestCase):
+    def test_rate_series(self):
+        r = RateSeries(10, 3)
+        for t in (0, 5, 12, 25, 27, 29):
+            r.add(t, 1, 100)
+        self.assertEqual([b[1] for b in r.buckets()], [2, 1, 3])
+        # 50..59 evicts 0..9 and clears the skipped bucket 30..39
+        r.add(55, 1, 100)
+        self.assertEqual([(b[0], b[1]) for b in r.buckets()],
+                         [(30.0, 0), (40.0, 0), (50.0, 1)])
+        r.add(5, 1, 100)
+        self.assertEqual(len(r.buckets()), 3)
+        self.assertEqual([b[1] for b in r.buckets(end=50)], [0, 0])
+        self.assertEqual(len(r.buckets(seconds=10)), 1)
+        s = r.summary('bytes', percentiles=(50, 100))
+        self.assertEqual((s['min'], s['max'], s['p50'], s['p100']),
+                         (0.0, 10.0, 0.0, 10.0))
+
+    def test_export_rates(self):
+        stats = Stats(rates=[(1, 60), (60, 10)])
+        child = stats.get_child('out.pcap')
+        child.got_packet(10, 100.5)
+        child.got_packet(20, 102.0)
+        stats.get_child('(discard)').got_packet(5, 101.0)
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            stats.export_rates(filename, 'binary')
+            rates = read_rates(filename)
+            self.assertEqual([n for n, r in rates],
+                             ['(total)', '(total)', '(discard)',
+                              '(discard)', 'out.pcap', 'out.pcap'])
+            self.assertEqual(rates[0][1].buckets(),
+                             [(100.0, 1, 10), (101.0, 1, 5), (102.0, 1, 20)])
+            self.assertEqual(rates[5][1].buckets(), [(60.0, 2, 30)])
+            stats.export_rates(filename, 'csv')
+            with open(filename) as f:
+                # header plus 3 + 1 buckets for the total and out.pcap, 1 + 1
+                # for (discard)
+                self.assertEqual(len(f.readlines()), 11)
+        finally:
+            os.remove(filename)
@@ -1,6 +1,6 @@
 # Copyright (c) 2015 Raytheon BBN Technologies Corp.  All rights reserved.
 
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 
 import os
 import traceback
@@ -9,24 +9,23 @@ import unittest
 class TAPTestResult(unittest.TestResult):
     def stopTestRun(self):
         super(TAPTestResult, self).stopTestRun()
-        print '1..' + str(self.testsRun)
+        print('1..' + str(self.testsRun))
 
     def _print_line(self, status, test, directive=None):
         if directive is None:
             directive = ''
         else:
             directive = '# ' + directive
-        print \
-            status, \
-            str(self.testsRun), \
-            test.shortDescription() or str(test), \
-            directive
+        print(status,
+              str(self.testsRun),
+              test.shortDescription() or str(test),
+              directive)
 
     def _print_bad(self, test, err):
         self._print_line('not ok', test)
         tb = traceback.format_exception(*err)
         for line in ''.join(tb).splitlines():
-            print '#', line
+            print('#', line)
 
     def _print_exp(self, test, ok):
         testMethod = getattr(test, test._testMethodName)
@@ -61,7 +60,7 @@ class TAPTestResult(unittest.TestResult):
 class TAPTestRunner(unittest.TextTestRunner):
     resultclass = TAPTestResult
     def __init__(self):
-        super(TAPTestRunner, self).__init__(stream=open(os.devnull, 'wb'))
+        super(TAPTestRunner, self).__init__(stream=open(os.devnull, 'w'))
 
 def expectedFailure(note):
     """decorator to mark a test method as expected to fail (with a note)
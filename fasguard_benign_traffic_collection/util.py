@@ -7,6 +7,7 @@ try:
 except ImportError:
     import collections as abc
 import contextlib
+import signal
 import six
 import threading
 
@@ -22,6 +23,21 @@ def close_when_done(obj):
     yield obj
     obj.close()
 
+@contextlib.contextmanager
+def signal_event(signum, event):
+    """set a threading.Event whenever signal signum is received
+
+    The previous handler is restored on exit.  Like signal.signal(),
+    this must be used from the main thread.
+    """
+    def handler(signum, frame):
+        event.set()
+    old = signal.signal(signum, handler)
+    try:
+        yield event
+    finally:
+        signal.signal(signum, old)
+
 def ensure_tuple(obj):
     if iterable_not_string(obj):
         return tuple(obj)